@@ -237,7 +237,6 @@ class ElectrumWindow(QMainWindow):
 
 
     def backup_wallet(self):
-        import shutil
         path = self.wallet.storage.path
         wallet_folder = os.path.dirname(path)
         filename = unicode( QFileDialog.getSaveFileName(self, _('Enter a filename for the copy of your wallet'), wallet_folder) )
@@ -247,7 +246,7 @@ class ElectrumWindow(QMainWindow):
         new_path = os.path.join(wallet_folder, filename)
         if new_path != path:
             try:
-                shutil.copy2(path, new_path)
+                self.wallet.storage.copy_to(new_path)
                 QMessageBox.information(None,"Wallet backup created", _("A copy of your wallet file was created in")+" '%s'" % str(new_path))
             except (IOError, os.error), reason:
                 QMessageBox.critical(None,"Unable to create backup", _("Electrum was unable to copy your wallet file to the specified location.")+"\n" + str(reason))
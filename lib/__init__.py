@@ -15,3 +15,5 @@ from mnemonic import mn_encode as mnemonic_encode
 from mnemonic import mn_decode as mnemonic_decode
 from commands import Commands, known_commands
 from daemon import NetworkProxy, NetworkServer
+from account import start_derivation_pool
+from blockchain import start_verification_pool
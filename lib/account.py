@@ -16,9 +16,56 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import threading, multiprocessing, atexit
 from bitcoin import *
 from i18n import _
 from transaction import Transaction
+from util import LRUCache, print_error
+
+
+POOL_MIN_ADDRESSES = 100     # smaller ranges are derived in the calling thread
+
+
+def derive_addresses(args):
+    """ addresses n to m-1 of an account. runs in the derivation pool """
+    account, for_change, n, m = args
+    return [account.get_address(for_change, i) for i in range(n, m)]
+
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+def start_derivation_pool(n=None):
+    """ start the process pool used to derive long ranges of addresses.
+    it must be called before other threads are started, since the worker
+    processes are forked. without it, addresses are derived in the
+    calling thread """
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is not None:
+            return
+        try:
+            n = n or multiprocessing.cpu_count()
+            if n > 1:
+                _pool = multiprocessing.Pool(n)
+                _pool_size = n
+                atexit.register(stop_derivation_pool)
+        except Exception:
+            print_error("cannot start derivation processes")
+
+def stop_derivation_pool():
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+            _pool_size = 0
+
+def get_derivation_pool():
+    with _pool_lock:
+        return _pool, _pool_size
 
 
 
@@ -41,6 +88,33 @@ class Account(object):
         print address
         return address
 
+    def create_new_addresses(self, for_change, k):
+        addresses = self.change if for_change else self.addresses
+        n = len(addresses)
+        new = self.get_address_range(for_change, n, n + k)
+        addresses.extend(new)
+        return new
+
+    def get_address_range(self, for_change, n, m):
+        """ addresses n to m-1. long ranges are split between worker processes """
+        if m - n >= POOL_MIN_ADDRESSES:
+            pool, size = get_derivation_pool()
+            if pool:
+                step = (m - n + size - 1) // size
+                jobs = [(self, for_change, i, min(i + step, m)) for i in range(n, m, step)]
+                try:
+                    return sum(pool.map(derive_addresses, jobs), [])
+                except Exception as e:
+                    print_error("derivation pool failed:", e)
+        return derive_addresses((self, for_change, n, m))
+
+    def __getstate__(self):
+        # sent to the derivation pool, which does not need the address lists
+        d = self.__dict__.copy()
+        d['addresses'] = []
+        d['change'] = []
+        return d
+
     def get_address(self, for_change, n):
         pass
         
@@ -136,10 +210,8 @@ class OldAccount(Account):
 
     @classmethod
     def mpk_from_seed(klass, seed):
-        curve = SECP256k1
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string().encode('hex')
+        master_public_key = ecc.point_to_ser( ecc.generator_mul(secexp), False )[1:].encode('hex')
         return master_public_key
 
     @classmethod
@@ -158,13 +230,9 @@ class OldAccount(Account):
         return address
 
     def get_pubkey(self, for_change, n):
-        curve = SECP256k1
-        mpk = self.mpk
         z = self.get_sequence(for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string( mpk, curve = SECP256k1 )
-        pubkey_point = master_public_key.pubkey.point + z*curve.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
-        return '04' + public_key2.to_string().encode('hex')
+        pubkey_point = ecc.point_add( ecc.ser_to_point(self.mpk), ecc.generator_mul(z) )
+        return ecc.point_to_ser(pubkey_point, False).encode('hex')
 
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
@@ -184,10 +252,8 @@ class OldAccount(Account):
 
 
     def check_seed(self, seed):
-        curve = SECP256k1
         secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        master_public_key = ecc.point_to_ser( ecc.generator_mul(secexp), False )[1:]
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise Exception('Invalid password')
@@ -213,12 +279,25 @@ class BIP32_Account(Account):
     def __init__(self, v):
         Account.__init__(self, v)
         self.xpub = v['xpub']
+        self.branch_nodes = {}              # (xpub, for_change) -> (cK, c)
+        self.pubkeys = LRUCache(1000)       # (xpub, for_change, n) -> pubkey
+        self.lock = threading.Lock()        # the caches are used by the gui and the synchronizer
 
     def dump(self):
         d = Account.dump(self)
         d['xpub'] = self.xpub
         return d
 
+    def __getstate__(self):
+        d = Account.__getstate__(self)
+        d['pubkeys'] = LRUCache(self.pubkeys.size)
+        d.pop('lock')
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.lock = threading.Lock()
+
     def get_address(self, for_change, n):
         pubkey = self.get_pubkey(for_change, n)
         address = public_key_to_bc_address( pubkey.decode('hex') )
@@ -230,11 +309,27 @@ class BIP32_Account(Account):
     def get_master_pubkeys(self):
         return [self.xpub]
 
+    def get_branch_node(self, xpub, for_change):
+        with self.lock:
+            node = self.branch_nodes.get((xpub, for_change))
+        if node is None:
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            node = CKD_pub(cK, c, for_change)
+            with self.lock:
+                self.branch_nodes[(xpub, for_change)] = node
+        return node
+
     def get_pubkey_from_x(self, xpub, for_change, n):
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        for i in [for_change, n]:
-            cK, c = CKD_pub(cK, c, i)
-        return cK.encode('hex')
+        key = xpub, for_change, n
+        with self.lock:
+            pubkey = self.pubkeys.get(key)
+        if pubkey is None:
+            cK, c = self.get_branch_node(xpub, for_change)
+            cK, c = CKD_pub(cK, c, n)
+            pubkey = cK.encode('hex')
+            with self.lock:
+                self.pubkeys.put(key, pubkey)
+        return pubkey
 
     def get_pubkeys(self, sequence):
         return sorted(map(lambda x: self.get_pubkey_from_x(x, *sequence), self.get_master_pubkeys()))
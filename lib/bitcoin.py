@@ -18,10 +18,11 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import hashlib, base64, ecdsa, re
+import hashlib, base64, ecdsa, re, threading, time
 import hmac
 import aes
-from util import print_error
+import ecc
+from util import print_error, LRUCache
 
 # AES encryption
 EncodeAES = lambda secret, s: base64.b64encode(aes.encryptData(secret,s))
@@ -183,66 +184,91 @@ def public_key_to_bc_address(public_key):
     h160 = hash_160(public_key)
     return hash_160_to_bc_address(h160)
 
+# conversions between addresses and hash160, which are done for every
+# output of every transaction we look at
+_address_lock = threading.Lock()
+_address_cache = LRUCache(10000)      # (h160, addrtype) -> address
+_hash_160_cache = LRUCache(10000)     # address -> (addrtype, h160)
+
 def hash_160_to_bc_address(h160, addrtype = 70):
-    vh160 = chr(addrtype) + h160
-    h = Hash(vh160)
-    addr = vh160 + h[0:4]
-    return b58encode(addr)
+    key = h160, addrtype
+    with _address_lock:
+        addr = _address_cache.get(key)
+    if addr is None:
+        vh160 = chr(addrtype) + h160
+        h = Hash(vh160)
+        addr = b58encode(vh160 + h[0:4])
+        with _address_lock:
+            _address_cache.put(key, addr)
+    return addr
 
 def bc_address_to_hash_160(addr):
-    bytes = b58decode(addr, 25)
-    return ord(bytes[0]), bytes[1:21]
+    with _address_lock:
+        r = _hash_160_cache.get(addr)
+    if r is None:
+        bytes = b58decode(addr, 25)
+        r = ord(bytes[0]), bytes[1:21]
+        with _address_lock:
+            _hash_160_cache.put(addr, r)
+    return r
 
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 __b58base = len(__b58chars)
+__b58values = dict((c, i) for i, c in enumerate(__b58chars))
+
+# the long value is split into chunks of 10 base58 digits, so that only
+# one long division or multiplication is needed per chunk. chunks are
+# encoded two digits at a time
+__b58chunk = 10
+__b58powers = [__b58base**i for i in range(__b58chunk + 1)]
+__b58pairs = [a + b for a in __b58chars for b in __b58chars]
 
 def b58encode(v):
     """ encode v, which is a string of bytes, to base58."""
-
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-
-    result = ''
-    while long_value >= __b58base:
-        div, mod = divmod(long_value, __b58base)
-        result = __b58chars[mod] + result
-        long_value = div
-    result = __b58chars[long_value] + result
+    long_value = int(v.encode('hex'), 16) if v else 0
+    pairs = []
+    while long_value:
+        long_value, chunk = divmod(long_value, __b58powers[__b58chunk])
+        for i in range(__b58chunk / 2):
+            chunk, mod = divmod(chunk, __b58powers[2])
+            pairs.append(__b58pairs[mod])
+    result = ''.join(reversed(pairs)).lstrip(__b58chars[0])
 
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
-
+    nPad = len(v) - len(v.lstrip('\0'))
     return (__b58chars[0]*nPad) + result
 
 def b58decode(v, length):
     """ decode v into a string of len bytes."""
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += __b58chars.find(c) * (__b58base**i)
-
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-
-    nPad = 0
-    for c in v:
-        if c == __b58chars[0]: nPad += 1
-        else: break
-
-    result = chr(0)*nPad + result
-    if length is not None and len(result) != length:
+    long_value = 0
+    i = len(v) % __b58chunk or __b58chunk
+    try:
+        for chunk in [v[:i]] + [v[j:j+__b58chunk] for j in range(i, len(v), __b58chunk)]:
+            value = 0
+            for c in chunk:
+                value = value * __b58base + __b58values[c]
+            long_value = long_value * __b58powers[len(chunk)] + value
+    except KeyError:
         return None
 
-    return result
+    nPad = len(v) - len(v.lstrip(__b58chars[0]))
+    if length is None:
+        h = '%x' % long_value if long_value else ''
+        return chr(0)*nPad + ('0'*(len(h) % 2) + h).decode('hex')
+
+    # fixed size payloads (addresses, extended keys) are formatted to
+    # their width directly. the first byte must not be zero, since leading
+    # zeros are encoded as 1s
+    width = length - nPad
+    if width < 0 or long_value >> (8*width):
+        return None
+    if width == 0:
+        return chr(0)*nPad if long_value == 0 else None
+    if not long_value >> (8*width - 8):
+        return None
+    return chr(0)*nPad + ('%0*x' % (2*width, long_value)).decode('hex')
 
 
 def EncodeBase58Check(vchIn):
@@ -251,6 +277,8 @@ def EncodeBase58Check(vchIn):
 
 def DecodeBase58Check(psz):
     vchRet = b58decode(psz, None)
+    if vchRet is None:
+        return None
     key = vchRet[0:-4]
     csum = vchRet[-4:]
     hash = Hash(key)
@@ -315,8 +343,9 @@ def is_valid(addr):
     return is_address(addr)
 
 
+ADDRESS_RE = re.compile('[1-9A-HJ-NP-Za-km-z]{26,}\\Z')
+
 def is_address(addr):
-    ADDRESS_RE = re.compile('[1-9A-HJ-NP-Za-km-z]{26,}\\Z')
     if not ADDRESS_RE.match(addr): return False
     try:
         addrtype, h = bc_address_to_hash_160(addr)
@@ -421,10 +450,19 @@ def ser_to_point(Aser):
 
 
 
+class Public_key(ecdsa.ecdsa.Public_key):
+    """ ecdsa public key for a point computed by ecc, which does not need the order check """
+    def __init__(self, point):
+        self.curve = curve_secp256k1
+        self.generator = generator_secp256k1
+        self.point = point
+
+
 class EC_KEY(object):
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        x, y = ecc.generator_mul(secret)
+        self.pubkey = Public_key( Point( curve_secp256k1, x, y, generator_secp256k1.order() ) )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -432,10 +470,10 @@ class EC_KEY(object):
         return point_to_ser(self.pubkey.point, compressed).encode('hex')
 
     def sign_message(self, message, compressed, address):
-        private_key = ecdsa.SigningKey.from_secret_exponent( self.secret, curve = SECP256k1 )
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic( Hash( msg_magic(message) ), hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string )
-        assert public_key.verify_digest( signature, Hash( msg_magic(message) ), sigdecode = ecdsa.util.sigdecode_string)
+        h = Hash( msg_magic(message) )
+        r, s = ecc.sign_digest( self.secret, h )
+        assert ecc.verify_digest( (self.pubkey.point.x(), self.pubkey.point.y()), h, r, s )
+        signature = ecdsa.util.sigencode_string( r, s, ecc.N )
         for i in range(4):
             sig = base64.b64encode( chr(27 + i + (4 if compressed else 0)) + signature )
             try:
@@ -450,11 +488,8 @@ class EC_KEY(object):
     @classmethod
     def verify_message(self, address, signature, message):
         """ See http://www.secg.org/download/aid-780/sec1-v2.pdf for the math """
-        from ecdsa import numbertheory, util
-        import msqr
-        curve = curve_secp256k1
-        G = generator_secp256k1
-        order = G.order()
+        from ecdsa import util
+        order = ecc.N
         # extract r,s from signature
         sig = base64.b64decode(signature)
         if len(sig) != 65: raise Exception("Wrong encoding")
@@ -471,24 +506,20 @@ class EC_KEY(object):
         recid = nV - 27
         # 1.1
         x = r + (recid/2) * order
-        # 1.3
-        alpha = ( x * x * x  + curve.a() * x + curve.b() ) % curve.p()
-        beta = msqr.modular_sqrt(alpha, curve.p())
-        y = beta if (beta - recid) % 2 == 0 else curve.p() - beta
-        # 1.4 the constructor checks that nR is at infinity
-        R = Point(curve, x, y, order)
+        # 1.3, 1.4 the curve has prime order, any point on it will do
+        if x >= ecc.P: raise Exception("Bad signature")
+        R = ecc.point_from_x(x, recid % 2)
         # 1.5 compute e from message:
         h = Hash( msg_magic(message) )
         e = string_to_number(h)
-        minus_e = -e % order
         # 1.6 compute Q = r^-1 (sR - eG)
-        inv_r = numbertheory.inverse_mod(r,order)
-        Q = inv_r * ( s * R + minus_e * G )
-        public_key = ecdsa.VerifyingKey.from_public_point( Q, curve = SECP256k1 )
+        inv_r = ecc.inverse(r, order)
+        Q = ecc.mul_add(-e * inv_r % order, s * inv_r % order, R)
         # check that Q is the public key
-        public_key.verify_digest( sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if Q is None or not ecc.verify_digest(Q, h, r, s):
+            raise Exception("Bad signature")
         # check that we get the original signing address
-        addr = public_key_to_bc_address( point_to_ser(public_key.pubkey.point, compressed) )
+        addr = public_key_to_bc_address( ecc.point_to_ser(Q, compressed) )
         if address != addr:
             raise Exception("Bad signature")
 
@@ -581,10 +612,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    point = ecc.generator_mul( string_to_number(secret) )
+    K = ecc.point_to_ser(point, False)[1:]
+    K_compressed = ecc.point_to_ser(point, True)
     return K, K_compressed
 
 
@@ -628,11 +658,9 @@ def _CKD_pub(cK, c, s):
     from ecdsa.util import string_to_number, number_to_string
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    pubkey_point = ecc.point_add( ecc.generator_mul(string_to_number(I[0:32])), ecc.ser_to_point(cK) )
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = ecc.point_to_ser(pubkey_point, True)
     return cK_n, c_n
 
 
@@ -779,8 +807,44 @@ def test_crypto():
     EC_KEY.verify_message(addr_c, signature, message)
 
 
+def test_base58(n=10000):
+    """ check base58 round trips and time the conversions of addresses and extended keys """
+    import os
+    h160s = [os.urandom(20) for i in range(n)]
+    addrs = [hash_160_to_bc_address(h) for h in h160s]
+    xkeys = [EncodeBase58Check("0488B21E".decode('hex') + os.urandom(74)) for i in range(n)]
+    for h, addr in zip(h160s, addrs):
+        assert bc_address_to_hash_160(addr) == (70, h)
+        assert b58encode(b58decode(addr, 25)) == addr
+    for v in ['', '\0', '\0\0\1', '\1\0', '\0' + os.urandom(100)]:
+        assert b58decode(b58encode(v), None) == v
+        assert b58decode(b58encode(v), len(v)) == v
+    assert b58decode(addrs[0], 24) is None and b58decode(addrs[0] + '0', None) is None
+
+    def bench(name, f, args):
+        t = time.time()
+        for x in args:
+            f(x)
+        print "%-30s %.2f us" % (name, (time.time() - t) * 1e6 / len(args))
+
+    payloads = [b58decode(a, 25) for a in addrs]
+    bench("b58encode 25 bytes", b58encode, payloads)
+    bench("b58decode 25 bytes", lambda a: b58decode(a, 25), addrs)
+    bench("b58encode 82 bytes", b58encode, [b58decode(x, 82) for x in xkeys])
+    bench("b58decode 82 bytes", lambda x: b58decode(x, 82), xkeys)
+    bench("deserialize_xkey", deserialize_xkey, xkeys)
+    _address_cache.clear()
+    _hash_160_cache.clear()
+    bench("hash_160_to_bc_address", hash_160_to_bc_address, h160s)
+    bench("hash_160_to_bc_address cached", hash_160_to_bc_address, h160s)
+    bench("bc_address_to_hash_160", bc_address_to_hash_160, addrs)
+    bench("bc_address_to_hash_160 cached", bc_address_to_hash_160, addrs)
+    bench("is_address", is_address, addrs)
+
+
 if __name__ == '__main__':
     #test_crypto()
+    test_base58()
     test_bip32("000102030405060708090a0b0c0d0e0f", "m/0'/1/2'/2/1000000000")
     test_bip32("fffcf9f6f3f0edeae7e4e1dedbd8d5d2cfccc9c6c3c0bdbab7b4b1aeaba8a5a29f9c999693908d8a8784817e7b7875726f6c696663605d5a5754514e4b484542","m/0/2147483647'/1/2147483646'/2")
 
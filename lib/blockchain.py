@@ -17,15 +17,248 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
-from util import user_dir, appdata_dir, print_error, print_msg
+import threading, time, Queue, os, sys, shutil, multiprocessing, mmap, struct, json, atexit, itertools
+from util import user_dir, appdata_dir, print_error, print_msg, LRUCache
 from bitcoin import *
+from checkpoints import CHECKPOINTS
 
 try:
     from ltc_scrypt import getPoWHash
+    getPoWHashes = lambda headers: map(getPoWHash, headers)
 except ImportError:
     print_msg("Warning: ltc_scrypt not available, using fallback")
     from scrypt import scrypt_1024_1_1_80 as getPoWHash
+    # hashes a whole chunk in lock-step if numpy is available
+    from scrypt import scrypt_1024_1_1_80_batch as getPoWHashes
+
+
+def pow_hash_chunk(data):
+    """ return the PoW hashes of a raw chunk. runs in the verification pool """
+    raw_headers = [data[i:i+80] for i in range(0, len(data), 80)]
+    return map(lambda h: h[::-1].encode('hex'), getPoWHashes(raw_headers))
+
+
+def checkpoints_from_headers(data, pool=None):
+    """ (height, hash, bits) of the last header of each complete chunk of
+    data, the content of a blockchain_headers file. every chunk is verified
+    first, proof of work included, as if there were no checkpoints """
+    import tempfile
+    from simple_config import SimpleConfig
+    chunks = [data[i:i+2016*80] for i in range(0, len(data) - len(data) % (2016*80), 2016*80)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        b = Blockchain(SimpleConfig({'electrum_path': tmp_dir}), None)
+        open(b.path(), 'wb').close()
+        b.set_checkpoints([])
+        checkpoints = []
+        try:
+            for index, pow_hashes in enumerate((pool.imap if pool else itertools.imap)(pow_hash_chunk, chunks)):
+                try:
+                    b.verify_chunk(index, chunks[index].encode('hex'), pow_hashes)
+                except Exception:
+                    raise Exception("chunk %d does not verify" % index)
+                last = b.read_header(index*2016 + 2015)
+                checkpoints.append((last.block_height, last.hash(), last.bits))
+        finally:
+            b.stop()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return checkpoints
+
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+def start_verification_pool(n=None):
+    """ start the process pool that checks the PoW of downloaded chunks.
+    like the derivation pool, it must be started before other threads.
+    without it, chunks are checked in the blockchain thread """
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is not None:
+            return
+        try:
+            n = n or multiprocessing.cpu_count()
+            if n > 1:
+                _pool = multiprocessing.Pool(n)
+                _pool_size = n
+                atexit.register(stop_verification_pool)
+        except Exception:
+            print_error("cannot start verification processes")
+
+def stop_verification_pool():
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+            _pool_size = 0
+
+def get_verification_pool():
+    with _pool_lock:
+        return _pool, _pool_size
+
+
+class Header(object):
+    """ block header kept as its raw 80 bytes. fields are decoded when
+    accessed; get() lets it stand in for the old header dicts. """
+
+    __slots__ = ('raw', 'block_height', '_hash')
+    fields = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nonce', 'block_height')
+
+    def __init__(self, raw, block_height=None):
+        assert len(raw) == 80
+        self.raw = raw
+        self.block_height = block_height
+        self._hash = None
+
+    @classmethod
+    def from_dict(klass, d):
+        s = int_to_hex(d.get('version'),4) \
+            + rev_hex(d.get('prev_block_hash')) \
+            + rev_hex(d.get('merkle_root')) \
+            + int_to_hex(int(d.get('timestamp')),4) \
+            + int_to_hex(int(d.get('bits')),4) \
+            + int_to_hex(int(d.get('nonce')),4)
+        return klass(s.decode('hex'), d.get('block_height'))
+
+    @property
+    def version(self):
+        return struct.unpack_from('<I', self.raw, 0)[0]
+
+    @property
+    def prev_block_hash(self):
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self):
+        return hash_encode(self.raw[36:68])
+
+    @property
+    def timestamp(self):
+        return struct.unpack_from('<I', self.raw, 68)[0]
+
+    @property
+    def bits(self):
+        return struct.unpack_from('<I', self.raw, 72)[0]
+
+    @property
+    def nonce(self):
+        return struct.unpack_from('<I', self.raw, 76)[0]
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        v = getattr(self, key)
+        return default if v is None else v
+
+    def hash_raw(self):
+        """ double sha256 of the header, in internal byte order """
+        if self._hash is None:
+            self._hash = Hash(self.raw)
+        return self._hash
+
+    def hash(self):
+        return hash_encode(self.hash_raw())
+
+    def as_dict(self):
+        d = {}
+        for k in self.fields:
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v
+        return d
+
+
+
+class HeaderStore(object):
+    """ the blockchain_headers file, read through one long-lived mmap.
+    decoded headers are kept in an LRU cache; writes update the map,
+    the cache and the chain tip in place. """
+
+    def __init__(self, path, decode, cache_size=10000):
+        self.path = path
+        self.decode = decode
+        self.lock = threading.Lock()
+        self.cache = LRUCache(cache_size)
+        self.file = None
+        self.map = None
+        self.size = 0
+
+    def open(self):
+        if self.file is None:
+            if not os.path.exists(self.path):
+                return False
+            self.file = open(self.path, 'rb+')
+            self.file.seek(0, os.SEEK_END)
+            self.size = self.file.tell()
+            self.remap()
+        return True
+
+    def remap(self):
+        if self.map:
+            self.map.close()
+        # a file of size 0 cannot be mapped
+        self.map = mmap.mmap(self.file.fileno(), self.size) if self.size else None
+
+    def close(self):
+        with self.lock:
+            if self.map:
+                self.map.close()
+                self.map = None
+            if self.file:
+                self.file.close()
+                self.file = None
+            self.cache.clear()
+
+    def height(self):
+        with self.lock:
+            if not self.open():
+                return None
+            return self.size/80 - 1
+
+    def read_raw(self, height):
+        with self.lock:
+            if height < 0 or not self.open():
+                return None
+            if (height + 1)*80 > self.size:
+                return None
+            return self.map[height*80:(height+1)*80]
+
+    def read(self, height):
+        with self.lock:
+            h = self.cache.get(height)
+            if h is not None:
+                return h
+        raw = self.read_raw(height)
+        if raw is None:
+            return None
+        h = self.decode(raw, height)
+        with self.lock:
+            # a write may have happened while decoding
+            if self.map and self.map[height*80:(height+1)*80] == raw:
+                self.cache.put(height, h)
+        return h
+
+    def write(self, height, data):
+        with self.lock:
+            self.open()
+            start = height*80
+            end = start + len(data)
+            if end <= self.size:
+                self.map[start:end] = data
+            else:
+                self.file.seek(start)
+                self.file.write(data)
+                self.file.flush()
+                self.size = end
+                self.remap()
+            for h in range(height, end/80):
+                self.cache.pop(h)
+            return self.size/80 - 1
+
 
 
 class Blockchain(threading.Thread):
@@ -39,7 +272,11 @@ class Blockchain(threading.Thread):
         self.local_height = 0
         self.running = False
         self.headers_url = 'http://electrum1.viorcoin.com/blockchain_headers'
+        self.set_checkpoints(CHECKPOINTS)
+        self.store = HeaderStore(self.path(), Header)
         self.set_local_height()
+        self.targets = []   # period index -> (bits, target, hash of the last header)
+        self.load_targets()
         self.queue = Queue.Queue()
 
     
@@ -47,8 +284,15 @@ class Blockchain(threading.Thread):
         return self.local_height
 
 
+    def set_checkpoints(self, checkpoints):
+        """ checkpoints is a list of (height, hash, bits) """
+        self.checkpoints = dict((height/2016, (height, _hash, bits)) for height, _hash, bits in checkpoints)
+        self.checkpoint_height = max([-1] + [cp[0] for cp in checkpoints])
+
+
     def stop(self):
         with self.lock: self.running = False
+        self.store.close()
 
 
     def is_running(self):
@@ -58,6 +302,7 @@ class Blockchain(threading.Thread):
     def run(self):
         self.init_headers_file()
         self.set_local_height()
+        self.update_targets()
         print_error( "blocks:", self.local_height )
 
         with self.lock:
@@ -112,19 +357,21 @@ class Blockchain(threading.Thread):
     def verify_chain(self, chain):
 
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') -1)
+        prev_header = self.read_header(first_header.block_height -1)
         
         for header in chain:
 
-            height = header.get('block_height')
+            height = header.block_height
 
-            prev_hash = self.hash_header(prev_header)
             bits, target = self.get_target(height/2016, chain)
             _hash = self.pow_hash_header(header)
+            checkpoint = self.checkpoints.get(height/2016)
             try:
-                assert prev_hash == header.get('prev_block_hash')
-                assert bits == header.get('bits')
+                assert prev_header.hash_raw() == header.raw[4:36]
+                assert bits == header.bits
                 assert int('0x'+_hash,16) < target
+                if checkpoint and checkpoint[0] == height:
+                    assert header.hash() == checkpoint[1]
             except Exception:
                 return False
 
@@ -134,31 +381,39 @@ class Blockchain(threading.Thread):
 
 
 
-    def verify_chunk(self, index, hexdata):
+    def verify_chunk(self, index, hexdata, pow_hashes=None):
         data = hexdata.decode('hex')
         height = index*2016
         num = len(data)/80
 
         if index == 0:  
-            previous_hash = ("0"*64)
+            previous_hash = '\0'*32
         else:
             prev_header = self.read_header(index*2016-1)
             if prev_header is None: raise
-            previous_hash = self.hash_header(prev_header)
+            previous_hash = prev_header.hash_raw()
 
         bits, target = self.get_target(index)
 
+        # below a checkpoint, hash linkage to it is enough
+        checkpoint = self.checkpoints.get(index)
+        if pow_hashes is None and not checkpoint:
+            pow_hashes = pow_hash_chunk(data)
+
+        # work on the raw bytes; no header objects are built
         for i in range(num):
             height = index*2016 + i
             raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
-            _hash = self.pow_hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
-            assert int('0x'+_hash,16) < target
+            assert previous_hash == raw_header[4:36]
+            assert bits == struct.unpack_from('<I', raw_header, 72)[0]
+            if not checkpoint:
+                assert int('0x'+pow_hashes[i],16) < target
+            previous_hash = Hash(raw_header)
 
-            previous_header = header
-            previous_hash = self.hash_header(header)
+        if checkpoint:
+            assert num == 2016
+            assert hash_encode(previous_hash) == checkpoint[1]
+            assert bits == checkpoint[2]
 
         self.save_chunk(index, data)
         print_error("validated chunk %d"%height)
@@ -166,31 +421,23 @@ class Blockchain(threading.Thread):
         
 
     def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
+        if isinstance(res, Header):
+            return res.raw.encode('hex')
+        return Header.from_dict(res).raw.encode('hex')
 
 
     def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
+        return Header(s)
 
     def hash_header(self, header):
-        return rev_hex(Hash(self.header_to_string(header).decode('hex')).encode('hex'))
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        return header.hash()
 
     def pow_hash_header(self, header):
-        return rev_hex(getPoWHash(self.header_to_string(header).decode('hex')).encode('hex'))
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        return hash_encode(getPoWHash(header.raw))
 
     def path(self):
         return os.path.join( self.config.path, 'blockchain_headers')
@@ -209,48 +456,115 @@ class Blockchain(threading.Thread):
         except Exception:
             print_error( "download failed. creating file", filename )
             open(filename,'wb+').close()
+            return
+        self.check_headers_file()
 
-    def save_chunk(self, index, chunk):
+    def check_headers_file(self):
+        """ keep the downloaded headers only as far as they are anchored
+        by checkpoints; what comes after is downloaded and verified """
+        if not self.checkpoints:
+            return
         filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-        self.set_local_height()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        prev_hash = '\0'*32
+        good = 0
+        for height in range(min(len(data)/80, self.checkpoint_height + 1)):
+            raw = data[height*80:(height+1)*80]
+            if raw[4:36] != prev_hash:
+                break
+            prev_hash = Hash(raw)
+            if height % 2016 == 2015:
+                checkpoint = self.checkpoints.get(height/2016)
+                if not checkpoint or hash_encode(prev_hash) != checkpoint[1]:
+                    break
+                good = height + 1
+        print_error("headers anchored by checkpoints:", good)
+        self.store.close()
+        with open(filename, 'rb+') as f:
+            f.truncate(good*80)
+
+    def save_chunk(self, index, chunk):
+        self.truncate_targets(index*2016)
+        self.local_height = self.store.write(index*2016, chunk)
+        self.update_targets()
 
     def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
-        self.set_local_height()
+        if not isinstance(header, Header):
+            header = Header.from_dict(header)
+        data = header.raw
+        height = header.block_height
+        self.truncate_targets(height)
+        self.local_height = self.store.write(height, data)
+        self.update_targets()
 
 
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
-            if self.local_height != h:
-                self.local_height = h
+        h = self.store.height()
+        if h is not None and self.local_height != h:
+            self.local_height = h
 
 
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h 
+        return self.store.read(block_height)
+
+
+    def targets_path(self):
+        return os.path.join( self.config.path, 'blockchain_targets')
+
+    def load_targets(self):
+        """ read the retarget table, keeping only the periods that still
+        match the last header of their period in blockchain_headers """
+        self.targets = [ self.compute_target(0) + (None,) ]
+        try:
+            with open(self.targets_path()) as f:
+                saved = json.load(f)
+        except Exception:
+            saved = []
+        for index, (bits, target, last_hash) in enumerate(saved):
+            if index == 0:
+                continue
+            last = self.read_header(index*2016-1)
+            if last is None or last.hash() != last_hash:
+                break
+            self.targets.append((bits, target, last_hash))
+        self.update_targets(len(self.targets) != len(saved))
+
+    def save_targets(self):
+        try:
+            with open(self.targets_path(), 'w') as f:
+                json.dump(self.targets, f)
+        except IOError:
+            print_error("cannot save", self.targets_path())
+
+    def update_targets(self, changed=False):
+        """ extend the table for each period whose headers are all saved """
+        while True:
+            index = len(self.targets)
+            last = self.read_header(index*2016-1)
+            if last is None:
+                break
+            self.targets.append(self.compute_target(index) + (last.hash(),))
+            changed = True
+        if changed:
+            self.save_targets()
+
+    def truncate_targets(self, height):
+        """ forget the periods that depend on headers from height on """
+        n = height/2016 + 1
+        if len(self.targets) > n:
+            del self.targets[n:]
+            self.save_targets()
 
 
     def get_target(self, index, chain=[]):
+        if index < len(self.targets):
+            bits, target, _ = self.targets[index]
+            return bits, target
+        return self.compute_target(index, chain)
+
+
+    def compute_target(self, index, chain=[]):
 
         max_target = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
         if index == 0: return 0x1e0ffff0, 0x00000FFFF0000000000000000000000000000000000000000000000000000000
@@ -263,15 +577,15 @@ class Blockchain(threading.Thread):
         last = self.read_header(index*2016-1)
         if last is None:
             for h in chain:
-                if h.get('block_height') == index*2016-1:
+                if h.block_height == index*2016-1:
                     last = h
  
-        nActualTimespan = last.get('timestamp') - first.get('timestamp')
+        nActualTimespan = last.timestamp - first.timestamp
         nTargetTimespan = 84*60*60
         nActualTimespan = max(nActualTimespan, nTargetTimespan/4)
         nActualTimespan = min(nActualTimespan, nTargetTimespan*4)
 
-        bits = last.get('bits') 
+        bits = last.bits
         # convert to bignum
         MM = 256*256*256
         a = bits%MM
@@ -282,14 +596,9 @@ class Blockchain(threading.Thread):
         # new target
         new_target = min( max_target, (target * nActualTimespan)/nTargetTimespan )
         
-        # convert it to bits
-        c = ("%064X"%new_target)[2:]
-        i = 31
-        while c[0:2]=="00":
-            c = c[2:]
-            i -= 1
-
-        c = int('0x'+c[0:6],16)
+        # convert it to bits: size in bytes, and the 3 most significant bytes
+        i = (new_target.bit_length() + 7)/8
+        c = new_target >> 8*(i - 3) if i > 3 else new_target
         if c >= 0x800000: 
             c /= 256
             i += 1
@@ -298,70 +607,118 @@ class Blockchain(threading.Thread):
         return new_bits, new_target
 
 
-    def request_header(self, i, h, queue):
-        print_error("requesting header %d from %s"%(h, i.server))
-        i.send([ ('blockchain.block.get_header',[h])], lambda i,r: queue.put((i,r)))
-
-    def retrieve_header(self, i, queue):
-        while True:
+    def request_batch(self, i, messages):
+        """ send messages in one batch and wait for all the replies, keyed by first param """
+        queue = Queue.Queue()
+        i.send(messages, lambda i,r: queue.put(r))
+        timeout = self.config.get('chunk_timeout', 30)
+        deadline = time.time() + timeout
+        result = {}
+        while len(result) < len(messages):
+            if not self.is_running() or not i.is_connected or time.time() > deadline:
+                print_error('timeout', i.server)
+                return
             try:
-                ir = queue.get(timeout=1)
+                r = queue.get(timeout=1)
             except Queue.Empty:
-                print_error('timeout')
                 continue
-
-            if not ir: 
+            if not r:
                 continue
-
-            i, r = ir
-
-            if r.get('error'):
-                print_error('Verifier received an error:', r)
-                continue
-
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r['result']
-
-            if method == 'blockchain.block.get_header':
-                return result
-                
+            if r.get('error') or r.get('result') is None:
+                print_error('Blockchain received an error:', r)
+                return
+            result[r['params'][0]] = r['result']
+        return result
+
+
+    def request_headers(self, i, heights):
+        print_error("requesting headers %s from %s"%(heights, i.server))
+        result = self.request_batch(i, [ ('blockchain.block.get_header',[h]) for h in heights ])
+        if result is None: return
+        return dict((h, Header.from_dict(r)) for h, r in result.items())
+
+
+    def find_fork_point(self, i, height):
+        """ highest height at or below height where the chain of i meets ours """
+        # headers up to the last checkpoint cannot be reorganized
+        good = max(self.checkpoint_height, 0)
+        if height <= good:
+            return height
+        # look back exponentially in one batch, then narrow the interval
+        # (good, bad) with several probes per round-trip
+        probes = []
+        step = 1
+        h = height
+        while h > good:
+            probes.append(h)
+            h = height - step
+            step *= 2
+        bad = height + 1
+        while True:
+            headers = self.request_headers(i, probes)
+            if headers is None: return
+            for h in sorted(probes):
+                local = self.read_header(h)
+                if local and local.hash_raw() == headers[h].hash_raw():
+                    good = max(good, h)
+                else:
+                    bad = min(bad, h)
+                    break
+            if bad <= good:
+                print_error("inconsistent chain from", i.server)
+                return
+            if bad == good + 1:
+                return good
+            n = min(bad - good - 1, self.config.get('fork_probes', 8))
+            probes = sorted(set(good + (bad - good)*k/(n + 1) for k in range(1, n + 1)))
+
+
+    def get_segment(self, i, start, end):
+        """ headers from start to end included, as a chunk when the segment is long """
+        if end < start:
+            return []
+        if end - start < 50:
+            headers = self.request_headers(i, range(start, end + 1))
+            if headers is None: return
+            return [headers[h] for h in range(start, end + 1)]
+        print_error("requesting chunks %d-%d from %s"%(start/2016, end/2016, i.server))
+        chunks = self.request_batch(i, [ ('blockchain.block.get_chunk',[k]) for k in range(start/2016, end/2016 + 1) ])
+        if chunks is None: return
+        chunks = dict((k, hexdata.decode('hex')) for k, hexdata in chunks.items())
+        segment = []
+        for h in range(start, end + 1):
+            raw = chunks[h/2016][(h%2016)*80:(h%2016)*80 + 80]
+            if len(raw) != 80: return
+            segment.append(Header(raw, h))
+        return segment
 
 
     def get_chain(self, interface, final_header):
 
-        header = final_header
-        chain = [ final_header ]
-        requested_header = False
-        queue = Queue.Queue()
+        header = Header.from_dict(final_header)
+        height = header.block_height
+        previous_header = self.read_header(height -1)
+        if previous_header and previous_header.hash_raw() == header.raw[4:36]:
+            return [ header ]
 
-        while self.is_running():
+        # the server is ahead of us or there was a reorg: find where its
+        # chain meets ours and fetch what is missing above that point
+        fork = self.find_fork_point(interface, min(height - 1, self.local_height))
+        if fork is None: return
+        if fork < height - 1:
+            print_error("reorg" if fork < self.local_height else "catching up", fork, height)
+        chain = self.get_segment(interface, fork + 1, height - 1)
+        if chain is None: return
+        return chain + [ header ]
 
-            if requested_header:
-                header = self.retrieve_header(interface, queue)
-                if not header: return
-                chain = [ header ] + chain
-                requested_header = False
 
-            height = header.get('block_height')
-            previous_header = self.read_header(height -1)
-            if not previous_header:
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
-
-            # verify that it connects to my chain
-            prev_hash = self.hash_header(previous_header)
-            if prev_hash != header.get('prev_block_hash'):
-                print_error("reorg")
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
-
-            else:
-                # the chain is complete
-                return chain
+    def chunk_servers(self, i):
+        """ connected interfaces that chunks can be requested from, i first """
+        servers = [i]
+        for s in self.network.interfaces.values():
+            if s is not i and s.is_connected:
+                servers.append(s)
+        return servers
 
 
     def get_and_verify_chunks(self, i, header, height):
@@ -369,20 +726,97 @@ class Blockchain(threading.Thread):
         queue = Queue.Queue()
         min_index = (self.local_height + 1)/2016
         max_index = (height + 1)/2016
+
+        # chunks are spread over every connected server and fetched ahead
+        # while the pool checks their PoW. only the linkage checks and
+        # save_chunk run in order.
+        pool, pool_size = get_verification_pool()
+        verify_timeout = self.config.get('verify_timeout', 300)
+        per_server = self.config.get('chunk_requests_per_server', 2)
+        timeout = self.config.get('chunk_timeout', 30)
+        requested = {}    # index -> (interface, time of request)
+        fetched = {}      # index -> (hexdata, async PoW result, interface)
+        failed = {}       # index -> servers that did not deliver a valid chunk
+
         n = min_index
         while n < max_index + 1:
-            print_error( "Requesting chunk:", n )
-            r = i.synchronous_get([ ('blockchain.block.get_chunk',[n])])[0]
-            if not r: 
+            if not self.is_running() or not i.is_connected:
+                return False
+
+            servers = self.chunk_servers(i)
+            window = self.config.get('chunk_window', max(2, 2*pool_size, per_server*len(servers)))
+            now = time.time()
+            for k, (s, t) in requested.items():
+                if not s.is_connected or now - t > timeout:
+                    print_error("chunk %d timed out on %s" % (k, s.server))
+                    failed.setdefault(k, set()).add(s)
+                    requested.pop(k)
+
+            load = dict((s, 0) for s in servers)
+            for s, t in requested.values():
+                if s in load:
+                    load[s] += 1
+
+            for k in range(n, min(n + window, max_index + 1)):
+                if k in requested or k in fetched:
+                    continue
+                candidates = [s for s in servers if load[s] < per_server and s not in failed.get(k, ())]
+                if not candidates:
+                    if all(s in failed.get(k, ()) for s in servers):
+                        # every server failed on that chunk, try them again
+                        failed.pop(k, None)
+                    continue
+                s = min(candidates, key=lambda s: load[s])
+                print_error( "Requesting chunk:", k, s.server )
+                s.send([ ('blockchain.block.get_chunk',[k])], lambda s,r: queue.put((s,r)))
+                requested[k] = s, now
+                load[s] += 1
+
+            if n not in fetched:
+                try:
+                    s, r = queue.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                if not r:
+                    continue
+                k = r.get('params')[0]
+                if requested.get(k, (None,))[0] is not s:
+                    continue
+                requested.pop(k)
+                hexdata = r.get('result')
+                if r.get('error') or not hexdata:
+                    print_error("chunk %d not served by %s" % (k, s.server))
+                    failed.setdefault(k, set()).add(s)
+                    continue
+                if k < n:
+                    continue
+                if pool and k not in self.checkpoints:
+                    job = pool.apply_async(pow_hash_chunk, (hexdata.decode('hex'),))
+                else:
+                    job = None
+                fetched[k] = hexdata, job, s
                 continue
+
+            hexdata, job, s = fetched.pop(n)
+            pow_hashes = None
+            if job:
+                try:
+                    pow_hashes = job.get(verify_timeout)
+                except multiprocessing.TimeoutError:
+                    # a worker died, its job is lost
+                    print_error("PoW check of chunk %d timed out, checking it here" % n)
             try:
-                self.verify_chunk(n, r)
+                self.verify_chunk(n, hexdata, pow_hashes)
+                failed.pop(n, None)
                 n = n + 1
             except Exception:
-                print_error('Verify chunk failed!')
+                print_error('Verify chunk failed!', s.server)
+                # fetch it again from another server; chunks that build
+                # on a bad one are checked again
+                failed.setdefault(n, set()).add(s)
+                fetched.clear()
                 n = n - 1
                 if n < 0:
                     return False
 
         return True
-
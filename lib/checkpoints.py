@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2014 thomasv@ecdsa.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# (height, hash, bits) of the last block of each 2016-block period.
+# Headers up to the last checkpoint are only checked by hash linkage;
+# proof of work is verified above it.
+# Regenerate this list with scripts/checkpoints from a verified
+# blockchain_headers file. While it is empty, the proof of work of every
+# header is checked.
+
+CHECKPOINTS = [
+]
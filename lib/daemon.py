@@ -25,7 +25,8 @@ import traceback
 import json
 import Queue
 from network import Network
-from util import print_msg, print_stderr
+from blockchain import start_verification_pool
+from util import print_msg, print_stderr, LineBuffer
 from simple_config import SimpleConfig
 
 
@@ -43,6 +44,7 @@ class NetworkProxy(threading.Thread):
         self.message_id = 0
         self.unanswered_requests = {}
         self.subscriptions = {}
+        self.callbacks = {}
         self.debug = False
         self.lock = threading.Lock()
         self.pending_transactions_for_notifications = []
@@ -82,32 +84,19 @@ class NetworkProxy(threading.Thread):
 
 
 
-    def parse_json(self, message):
-        s = message.find('\n')
-        if s==-1: 
-            return None, message
-        j = json.loads( message[0:s] )
-        return j, message[s+1:]
-
-
     def run(self):
         # read responses and trigger callbacks
-        message = ''
+        lines = LineBuffer()
         while True:
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(65536)
             except:
                 data = ''
             if not data:
                 break
 
-            message += data
-            while True:
-                response, message = self.parse_json(message)
-                if response is not None: 
-                    self.process(response)
-                else:
-                    break
+            for line in lines.feed(data):
+                self.process(json.loads(line))
 
         print "NetworkProxy: exiting"
 
@@ -154,7 +143,7 @@ class NetworkProxy(threading.Thread):
         return ids
 
 
-    def synchronous_get(self, requests, timeout=100000000):
+    def synchronous_get(self, requests, timeout=None):
         queue = Queue.Queue()
         ids = self.send(requests, lambda i,x: queue.put(x))
         id2 = ids[:]
@@ -193,8 +182,17 @@ class NetworkProxy(threading.Thread):
         return self.synchronous_get([('daemon.shutdown',[])])[0]
 
 
-    def trigger_callback(self, cb):
-        pass
+    def register_callback(self, event, callback):
+        # events of the daemon's network are not forwarded, only those
+        # triggered in this process
+        with self.lock:
+            self.callbacks.setdefault(event, []).append(callback)
+
+    def trigger_callback(self, event):
+        with self.lock:
+            callbacks = self.callbacks.get(event, [])[:]
+        for callback in callbacks:
+            callback()
 
 
 
@@ -218,35 +216,23 @@ class ClientThread(threading.Thread):
 
 
     def run(self):
-        message = ''
+        lines = LineBuffer()
         while True:
             self.send_responses()
             try:
-                data = self.s.recv(1024)
+                data = self.s.recv(65536)
             except socket.timeout:
                 continue
 
             if not data:
                 break
-            message += data
 
-            while True:
-                cmd, message = self.parse_json(message)
-                if not cmd:
-                    break
-                self.process(cmd)
+            for line in lines.feed(data):
+                self.process(json.loads(line))
 
         #print "client thread terminating"
 
 
-    def parse_json(self, message):
-        n = message.find('\n')
-        if n==-1: 
-            return None, message
-        j = json.loads( message[0:n] )
-        return j, message[n+1:]
-
-
     def process(self, request):
         if self.debug: print "<--", request
         method = request['method']
@@ -300,6 +286,7 @@ class ClientThread(threading.Thread):
 class NetworkServer:
 
     def __init__(self, config):
+        start_verification_pool(config.get('verify_processes'))
         network = Network(config)
         if not network.start(wait=True):
             print_msg("Not connected, aborting.")
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" secp256k1 arithmetic for key derivation and signing.
+
+points are (x, y) tuples of integers, None is the point at infinity.
+scalar multiplications are done by a backend: libsecp256k1 or OpenSSL
+through ctypes when they can be loaded (see ecc_native), else the pure
+python implementation below. it computes sums in jacobian coordinates
+(X, Y, Z), with x = X/Z^2 and y = Y/Z^3, so that only one inversion is
+needed per result.
+"""
+
+import threading
+import hashlib
+import ecc_native
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+WINDOW = 5         # width of the signed digits of point_mul
+COMB_BITS = 4      # the generator table has 2^COMB_BITS - 1 points per window
+
+
+def inverse(a, m=P):
+    return pow(a, m - 2, m)
+
+
+def jacobian_double(p):
+    if p is None:
+        return None
+    X1, Y1, Z1 = p
+    if Y1 == 0:
+        return None
+    YY = Y1 * Y1 % P
+    S = 4 * X1 * YY % P
+    M = 3 * X1 * X1 % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y1 * Z1 % P
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(p, q):
+    """ p + q, with p in jacobian and q in affine coordinates """
+    if q is None:
+        return p
+    if p is None:
+        return q[0], q[1], 1
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    ZZ = Z1 * Z1 % P
+    H = (x2 * ZZ - X1) % P
+    R = (y2 * ZZ * Z1 - Y1) % P
+    if H == 0:
+        return jacobian_double(p) if R == 0 else None
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return X3, Y3, Z3
+
+
+def to_affine(p):
+    if p is None:
+        return None
+    X, Y, Z = p
+    zi = inverse(Z)
+    zi2 = zi * zi % P
+    return X * zi2 % P, Y * zi2 * zi % P
+
+
+def batch_to_affine(points):
+    """ convert a list of finite jacobian points with a single inversion """
+    acc = 1
+    prefix = []
+    for X, Y, Z in points:
+        prefix.append(acc)
+        acc = acc * Z % P
+    acc = inverse(acc)
+    out = [None] * len(points)
+    for i in xrange(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        zi = acc * prefix[i] % P
+        acc = acc * Z % P
+        zi2 = zi * zi % P
+        out[i] = X * zi2 % P, Y * zi2 * zi % P
+    return out
+
+
+def negate(q):
+    return None if q is None else (q[0], (P - q[1]) % P)
+
+
+def wnaf(k, w=WINDOW):
+    """ signed digits of k, least significant first, non-zero digits are odd and less than 2^(w-1) in absolute value """
+    digits = []
+    half = 1 << (w - 1)
+    full = 1 << w
+    while k:
+        if k & 1:
+            d = k & (full - 1)
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def odd_multiples(q, w=WINDOW):
+    """ q, 3q, 5q, ... (2^(w-1) - 1)q in affine coordinates """
+    q2 = to_affine(jacobian_double((q[0], q[1], 1)))
+    table = [(q[0], q[1], 1)]
+    for i in xrange((1 << (w - 2)) - 1):
+        table.append(jacobian_add_affine(table[-1], q2))
+    return batch_to_affine(table)
+
+
+def python_point_mul(k, q):
+    """ k*q, using a width-w non-adjacent form of k """
+    k %= N
+    if k == 0 or q is None:
+        return None
+    table = odd_multiples(q)
+    r = None
+    for d in reversed(wnaf(k)):
+        r = jacobian_double(r)
+        if d > 0:
+            r = jacobian_add_affine(r, table[d >> 1])
+        elif d < 0:
+            r = jacobian_add_affine(r, negate(table[(-d) >> 1]))
+    return to_affine(r)
+
+
+_generator_table = None
+_generator_lock = threading.Lock()
+
+def generator_table():
+    """ table[i][j-1] = j * 2^(COMB_BITS*i) * G, computed once """
+    global _generator_table
+    with _generator_lock:
+        if _generator_table is None:
+            table = []
+            base = G
+            size = 1 << COMB_BITS
+            for i in xrange((256 + COMB_BITS - 1) // COMB_BITS):
+                row = [(base[0], base[1], 1)]
+                for j in xrange(size - 1):
+                    row.append(jacobian_add_affine(row[-1], base))
+                row = batch_to_affine(row)
+                table.append(row[:-1])
+                base = row[-1]
+            _generator_table = table
+    return _generator_table
+
+
+def python_generator_mul(k):
+    """ k*G, one addition per non-zero window of k and no doublings """
+    k %= N
+    table = generator_table()
+    mask = (1 << COMB_BITS) - 1
+    r = None
+    i = 0
+    while k:
+        d = k & mask
+        if d:
+            r = jacobian_add_affine(r, table[i][d - 1])
+        k >>= COMB_BITS
+        i += 1
+    return to_affine(r)
+
+
+def point_add(p, q):
+    if p is None:
+        return q
+    return to_affine(jacobian_add_affine((p[0], p[1], 1), q))
+
+
+class PythonBackend(object):
+
+    name = 'python'
+
+    def generator_mul(self, k):
+        return python_generator_mul(k)
+
+    def mul_add(self, a, b, q):
+        return point_add(python_generator_mul(a), python_point_mul(b, q))
+
+
+backend = None
+
+def get_backends():
+    """ the available backends, fastest first """
+    return ecc_native.load_backends(G, N, python_generator_mul) + [PythonBackend()]
+
+def set_backend(name=None):
+    """ use the named backend, or the fastest one available """
+    global backend
+    backends = [b for b in get_backends() if name in [None, b.name]]
+    if not backends:
+        raise Exception("ecc backend not available: %s"%name)
+    backend = backends[0]
+    return backend.name
+
+
+def generator_mul(k):
+    """ k*G """
+    k %= N
+    return backend.generator_mul(k) if k else None
+
+
+def point_mul(k, q):
+    k %= N
+    return backend.mul_add(0, k, q) if k and q else None
+
+
+def mul_add(a, b, q):
+    """ a*G + b*q """
+    a %= N
+    b %= N
+    if not b or q is None:
+        return generator_mul(a)
+    return backend.mul_add(a, b, q)
+
+
+def is_on_curve(q):
+    x, y = q
+    return 0 <= x < P and 0 <= y < P and (y * y - x * x * x - 7) % P == 0
+
+
+def point_from_x(x, odd):
+    y2 = (x * x * x + 7) % P
+    y = pow(y2, (P + 1) // 4, P)
+    if y * y % P != y2:
+        raise ValueError("x is not on the curve")
+    if (y & 1) != bool(odd):
+        y = P - y
+    return x, y
+
+
+def ser_to_point(s):
+    """ decode a serialized public key: 33 bytes compressed, 65 bytes with the 04 prefix or 64 bytes x|y """
+    if len(s) == 33 and s[0] in '\x02\x03':
+        return point_from_x(int(s[1:].encode('hex'), 16), s[0] == '\x03')
+    if len(s) == 65 and s[0] == '\x04':
+        s = s[1:]
+    if len(s) != 64:
+        raise ValueError("invalid public key")
+    q = int(s[:32].encode('hex'), 16), int(s[32:].encode('hex'), 16)
+    if not is_on_curve(q):
+        raise ValueError("point is not on the curve")
+    return q
+
+
+def point_to_ser(q, compressed=True):
+    x, y = q
+    if compressed:
+        return ('03' if y & 1 else '02').decode('hex') + ('%064x' % x).decode('hex')
+    return ('04%064x%064x' % (x, y)).decode('hex')
+
+
+def sign_digest(secexp, digest):
+    """ deterministic (rfc6979) signature of a 32 bytes digest, returns (r, s) """
+    from ecdsa import rfc6979
+    from ecdsa.ecdsa import generator_secp256k1
+    k = rfc6979.generate_k(generator_secp256k1, secexp, hashlib.sha256, digest)
+    e = int(digest.encode('hex'), 16)
+    r = generator_mul(k)[0] % N
+    s = inverse(k, N) * (e + secexp * r) % N
+    if r == 0 or s == 0:
+        raise RuntimeError("amazingly unlucky random number")
+    return r, s
+
+
+def verify_digest(q, digest, r, s):
+    if not (0 < r < N and 0 < s < N):
+        return False
+    e = int(digest.encode('hex'), 16)
+    w = inverse(s, N)
+    R = mul_add(e * w % N, r * w % N, q)
+    return R is not None and R[0] % N == r
+
+
+set_backend()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" ecc backends using libsecp256k1 or OpenSSL through ctypes.
+
+a backend computes k*G and a*G + b*Q, with scalars in [1, N-1] (a may be
+0) and points as (x, y) tuples. nonces and signatures are computed in
+ecc, so that all backends produce the same signatures. this module does
+not import ecc: the curve is passed to load_backends.
+"""
+
+import ctypes
+import ctypes.util
+from util import print_error
+
+
+def number_to_bytes(k):
+    return ('%064x' % k).decode('hex')
+
+
+def bytes_to_number(s):
+    return int(s.encode('hex'), 16)
+
+
+def load_library(names):
+    for name in names:
+        path = ctypes.util.find_library(name)
+        for p in ([path] if path else []) + ['lib%s.so' % name, 'lib%s.dylib' % name, '%s.dll' % name]:
+            try:
+                return ctypes.cdll.LoadLibrary(p)
+            except OSError:
+                continue
+    return None
+
+
+class Secp256k1Backend(object):
+
+    name = 'libsecp256k1'
+
+    CONTEXT_SIGN = (1 << 0) | (1 << 9)
+    CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+    EC_UNCOMPRESSED = (1 << 1)
+
+    def __init__(self):
+        lib = load_library(['secp256k1', 'libsecp256k1'])
+        if lib is None:
+            raise ImportError("libsecp256k1 not found")
+        lib.secp256k1_context_create.argtypes = [ctypes.c_uint]
+        lib.secp256k1_context_create.restype = ctypes.c_void_p
+        lib.secp256k1_ec_pubkey_create.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        lib.secp256k1_ec_pubkey_parse.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t]
+        lib.secp256k1_ec_pubkey_serialize.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t), ctypes.c_char_p, ctypes.c_uint]
+        lib.secp256k1_ec_pubkey_tweak_mul.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        lib.secp256k1_ec_pubkey_combine.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_size_t]
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(self.CONTEXT_SIGN | self.CONTEXT_VERIFY)
+        if not self.ctx:
+            raise ImportError("cannot create secp256k1 context")
+
+    def to_point(self, pubkey):
+        out = ctypes.create_string_buffer(65)
+        size = ctypes.c_size_t(65)
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), pubkey, self.EC_UNCOMPRESSED)
+        return bytes_to_number(out.raw[1:33]), bytes_to_number(out.raw[33:65])
+
+    def from_point(self, q):
+        pubkey = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, pubkey, '\x04' + number_to_bytes(q[0]) + number_to_bytes(q[1]), 65):
+            raise ValueError("invalid point")
+        return pubkey
+
+    def create(self, k):
+        pubkey = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_create(self.ctx, pubkey, number_to_bytes(k)):
+            raise ValueError("invalid scalar")
+        return pubkey
+
+    def generator_mul(self, k):
+        return self.to_point(self.create(k))
+
+    def mul_add(self, a, b, q):
+        pubkey = self.from_point(q)
+        if not self.lib.secp256k1_ec_pubkey_tweak_mul(self.ctx, pubkey, number_to_bytes(b)):
+            raise ValueError("invalid scalar")
+        if not a:
+            return self.to_point(pubkey)
+        ins = (ctypes.c_char_p * 2)(self.create(a).raw, pubkey.raw)
+        out = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_combine(self.ctx, out, ins, 2):
+            # the sum is the point at infinity
+            return None
+        return self.to_point(out)
+
+
+class OpenSSLBackend(object):
+    """ EC_POINT_mul is not faster than the comb table of ecc for k*G,
+    even with EC_GROUP_precompute_mult, so this backend has no
+    generator_mul and load_backends gives it the python one """
+
+    name = 'openssl'
+
+    NID_secp256k1 = 714
+
+    def __init__(self):
+        lib = load_library(['crypto', 'libcrypto', 'libeay32'])
+        if lib is None:
+            raise ImportError("OpenSSL not found")
+        vp = ctypes.c_void_p
+        lib.EC_GROUP_new_by_curve_name.argtypes = [ctypes.c_int]
+        lib.EC_GROUP_new_by_curve_name.restype = vp
+        lib.EC_POINT_new.argtypes = [vp]
+        lib.EC_POINT_new.restype = vp
+        lib.EC_POINT_free.argtypes = [vp]
+        lib.EC_POINT_mul.argtypes = [vp, vp, vp, vp, vp, vp]
+        lib.EC_POINT_is_at_infinity.argtypes = [vp, vp]
+        lib.EC_POINT_set_affine_coordinates_GFp.argtypes = [vp, vp, vp, vp, vp]
+        lib.EC_POINT_get_affine_coordinates_GFp.argtypes = [vp, vp, vp, vp, vp]
+        lib.BN_CTX_new.restype = vp
+        lib.BN_CTX_free.argtypes = [vp]
+        lib.BN_new.restype = vp
+        lib.BN_free.argtypes = [vp]
+        lib.BN_bin2bn.argtypes = [ctypes.c_char_p, ctypes.c_int, vp]
+        lib.BN_bin2bn.restype = vp
+        lib.BN_bn2bin.argtypes = [vp, ctypes.c_char_p]
+        lib.BN_num_bits.argtypes = [vp]
+        self.lib = lib
+        self.group = lib.EC_GROUP_new_by_curve_name(self.NID_secp256k1)
+        if not self.group:
+            raise ImportError("OpenSSL does not support secp256k1")
+
+    def bn(self, k):
+        return self.lib.BN_bin2bn(number_to_bytes(k), 32, None)
+
+    def bn_to_number(self, bn):
+        size = (self.lib.BN_num_bits(bn) + 7) // 8
+        out = ctypes.create_string_buffer(size)
+        self.lib.BN_bn2bin(bn, out)
+        return bytes_to_number(out.raw) if size else 0
+
+    def mul_add(self, a, b, q):
+        lib = self.lib
+        # a BN_CTX cannot be shared between threads
+        ctx = lib.BN_CTX_new()
+        bns = []
+        points = []
+        try:
+            r = lib.EC_POINT_new(self.group)
+            points.append(r)
+            n = None
+            if a:
+                n = self.bn(a)
+                bns.append(n)
+            Q = m = None
+            if b:
+                x, y = self.bn(q[0]), self.bn(q[1])
+                bns.extend([x, y])
+                Q = lib.EC_POINT_new(self.group)
+                points.append(Q)
+                if not lib.EC_POINT_set_affine_coordinates_GFp(self.group, Q, x, y, ctx):
+                    raise ValueError("invalid point")
+                m = self.bn(b)
+                bns.append(m)
+            if not lib.EC_POINT_mul(self.group, r, n, Q, m, ctx):
+                raise ValueError("EC_POINT_mul failed")
+            if lib.EC_POINT_is_at_infinity(self.group, r):
+                return None
+            x, y = lib.BN_new(), lib.BN_new()
+            bns.extend([x, y])
+            lib.EC_POINT_get_affine_coordinates_GFp(self.group, r, x, y, ctx)
+            return self.bn_to_number(x), self.bn_to_number(y)
+        finally:
+            for bn in bns:
+                lib.BN_free(bn)
+            for point in points:
+                lib.EC_POINT_free(point)
+            lib.BN_CTX_free(ctx)
+
+
+_backends = None
+
+def load_backends(G, N, generator_mul):
+    """ the native backends that can be loaded and give the right results,
+    fastest first. G and N are the generator and the order of the curve,
+    generator_mul the python k*G """
+    global _backends
+    if _backends is None:
+        _backends = []
+        for klass in [Secp256k1Backend, OpenSSLBackend]:
+            try:
+                b = klass()
+                if not hasattr(b, 'generator_mul'):
+                    b.generator_mul = generator_mul
+                # guard against an unexpected library ABI
+                assert b.generator_mul(3) == generator_mul(3)
+                assert b.mul_add(2, 5, G) == generator_mul(7)
+                minus_g = b.mul_add(0, N - 1, G)
+                assert minus_g[0] == G[0] and minus_g[1] != G[1]
+                assert b.mul_add(5, N - 5, G) is None
+            except Exception as e:
+                print_error("ecc backend not available:", klass.name, e)
+                continue
+            _backends.append(b)
+    return _backends
@@ -18,13 +18,13 @@
 
 
 import random, ast, re, errno, os
-import threading, traceback, sys, time, json, Queue
+import threading, traceback, sys, time, json, Queue, select, collections
 import socks
 import socket
 import ssl
 
 from version import ELECTRUM_VERSION, PROTOCOL_VERSION
-from util import print_error, print_msg
+from util import print_error, print_msg, LineBuffer
 from simple_config import SimpleConfig
 
 
@@ -93,6 +93,7 @@ class Interface(threading.Thread):
         self.connect_event = threading.Event()
 
         self.subscriptions = {}
+        self.subscribed = {}  # (method, params) -> callback, to dispatch notifications
         self.lock = threading.Lock()
 
         self.rtime = 0
@@ -106,6 +107,17 @@ class Interface(threading.Thread):
         self.message_id = 0
         self.unanswered_requests = {}
 
+        # tcp sockets are read and written by the poller thread. at most
+        # max_requests_in_flight requests are written without an answer
+        self.send_lock = threading.Lock()
+        self.send_queue = collections.deque()
+        self.out_chunks = []
+        self.write_chunk = None
+        self.in_flight = set()
+        self.max_requests_in_flight = self.config.get('max_requests_in_flight', 500)
+        self.lines = LineBuffer()
+        self.last_recv = self.last_ping = 0
+
         # parse server
         self.server = server
         try:
@@ -138,6 +150,11 @@ class Interface(threading.Thread):
 
         msg_id = c.get('id')
         error = c.get('error')
+
+        if msg_id is not None and self.protocol in 'st':
+            with self.send_lock:
+                self.in_flight.discard(msg_id)
+                self.release_requests()
         
         if error:
             print_error("received error:", c)
@@ -172,14 +189,11 @@ class Interface(threading.Thread):
                 params = [addr]
 
             with self.lock:
-                for k,v in self.subscriptions.items():
-                    if (method, params) in v:
-                        callback = k
-                        break
-                else:
-                    print_error( "received unexpected notification", method, params)
-                    print_error( self.subscriptions )
-                    return
+                callback = self.subscribed.get((method, tuple(params)))
+            if callback is None:
+                print_error( "received unexpected notification", method, params)
+                print_error( self.subscriptions )
+                return
 
 
         callback(self, {'method':method, 'params':params, 'result':result, 'id':msg_id})
@@ -407,62 +421,81 @@ class Interface(threading.Thread):
                 print_error("saving certificate for", self.host)
                 os.rename(temporary_path, cert_path)
 
-        s.settimeout(60)
+        s.setblocking(0)
         self.s = s
+        self.last_recv = time.time()
         self.is_connected = True
         print_error("connected to", self.host, self.port)
 
 
-    def run_tcp(self):
-        try:
-            #if self.use_ssl: self.s.do_handshake()
-            out = ''
-            while self.is_connected:
-                try: 
-                    timeout = False
-                    msg = self.s.recv(1024)
-                except socket.timeout:
-                    timeout = True
-                except ssl.SSLError:
-                    timeout = True
-                except socket.error, err:
-                    if err.errno == 60:
-                        timeout = True
-                    elif err.errno in [11, 10035]:
-                        print_error("socket errno", err.errno)
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        traceback.print_exc(file=sys.stdout)
-                        raise
+    def fileno(self):
+        return self.s.fileno()
 
-                if timeout:
-                    # ping the server with server.version, as a real ping does not exist yet
-                    self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])], self.on_version)
-                    continue
 
-                out += msg
-                self.bytes_received += len(msg)
-                if msg == '': 
-                    self.is_connected = False
-
-                while True:
-                    s = out.find('\n')
-                    if s==-1: break
-                    c = out[0:s]
-                    out = out[s+1:]
-                    c = json.loads(c)
+    def on_readable(self):
+        """ read what the socket has, return False if the connection was closed """
+        while True:
+            try:
+                msg = self.s.recv(65536)
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return True
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+                    return True
+                raise
+
+            if msg == '':
+                return False
+
+            self.last_recv = time.time()
+            self.bytes_received += len(msg)
+            for c in self.lines.feed(msg):
+                c = json.loads(c)
+                if type(c) is list:
+                    for item in c:
+                        self.queue_json_response(item)
+                else:
                     self.queue_json_response(c)
 
-        except Exception:
-            traceback.print_exc(file=sys.stdout)
 
-        self.is_connected = False
+    def wants_write(self):
+        return self.write_chunk is not None or bool(self.out_chunks)
+
+
+    def on_writable(self):
+        with self.send_lock:
+            if self.write_chunk is None:
+                if not self.out_chunks:
+                    return
+                self.write_chunk = ''.join(self.out_chunks)
+                self.out_chunks = []
+            chunk = self.write_chunk
+        try:
+            n = self.s.send(chunk)
+        except ssl.SSLError, e:
+            # an ssl write must be retried with the same buffer
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        with self.send_lock:
+            self.write_chunk = chunk[n:] if n < len(chunk) else None
+
+
+    def on_idle(self):
+        # ping the server with server.version, as a real ping does not exist yet
+        self.last_ping = time.time()
+        self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])], self.on_version)
 
 
     def send_tcp(self, messages, callback):
-        """return the ids of the requests that we sent"""
-        out = ''
+        """return the ids of the requests that we queued"""
+        requests = []
         ids = []
         for m in messages:
             method, params = m 
@@ -471,25 +504,27 @@ class Interface(threading.Thread):
             ids.append(self.message_id)
             if self.debug:
                 print "-->", request
+            requests.append( (self.message_id, request + '\n') )
             self.message_id += 1
-            out += request + '\n'
-        while out:
-            try:
-                sent = self.s.send( out )
-                out = out[sent:]
-            except socket.error,e:
-                if e[0] in (errno.EWOULDBLOCK,errno.EAGAIN):
-                    print_error( "EAGAIN: retrying")
-                    time.sleep(0.1)
-                    continue
-                else:
-                    traceback.print_exc(file=sys.stdout)
-                    # this happens when we get disconnected
-                    print_error( "Not connected, cannot send" )
-                    return None
+        with self.send_lock:
+            self.send_queue.extend(requests)
+            self.release_requests()
+        get_poller().wakeup()
         return ids
 
 
+    def release_requests(self):
+        """ move queued requests to the output buffer, as far as the window allows. called with send_lock """
+        n = min(self.max_requests_in_flight - len(self.in_flight), len(self.send_queue))
+        if n <= 0:
+            return
+        out = []
+        for i in xrange(n):
+            _id, request = self.send_queue.popleft()
+            self.in_flight.add(_id)
+            out.append(request)
+        self.out_chunks.append(''.join(out))
+
 
 
 
@@ -508,6 +543,7 @@ class Interface(threading.Thread):
         for callback in self.subscriptions.keys():
             callback(self, None)
         self.subscriptions = {}
+        self.subscribed = {}
 
 
     def send(self, messages, callback):
@@ -523,7 +559,10 @@ class Interface(threading.Thread):
                 if self.subscriptions.get(callback) is None: 
                     self.subscriptions[callback] = []
                 for message in sub:
-                    if message not in self.subscriptions[callback]:
+                    m, v = message
+                    key = m, tuple(v)
+                    if self.subscribed.get(key) != callback:
+                        self.subscribed[key] = callback
                         self.subscriptions[callback].append(message)
 
         if not self.is_connected: 
@@ -563,8 +602,13 @@ class Interface(threading.Thread):
 
     def stop(self):
         if self.is_connected and self.protocol in 'st' and self.s:
-            self.s.shutdown(socket.SHUT_RDWR)
-            self.s.close()
+            # the poller closes the socket
+            self.is_connected = False
+            try:
+                self.s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            get_poller().wakeup()
 
         self.is_connected = False
 
@@ -585,11 +629,19 @@ class Interface(threading.Thread):
 
     def run(self):
         self.start_interface()
-        if self.is_connected:
+        if not self.is_connected:
+            self.change_status()
+        elif self.protocol in 'st':
+            # from now on the socket is served by the poller thread, which
+            # reports the disconnection
+            get_poller().add(self)
             self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])], self.on_version)
             self.change_status()
-            self.run_tcp() if self.protocol in 'st' else self.run_http()
-        self.change_status()
+        else:
+            self.send([('server.version', [ELECTRUM_VERSION, PROTOCOL_VERSION])], self.on_version)
+            self.change_status()
+            self.run_http()
+            self.change_status()
         
 
     def change_status(self):
@@ -597,7 +649,7 @@ class Interface(threading.Thread):
         self.queue.put(self)
 
 
-    def synchronous_get(self, requests, timeout=100000000):
+    def synchronous_get(self, requests, timeout=None):
         queue = Queue.Queue()
         ids = self.send(requests, lambda i,r: queue.put(r))
         id2 = ids[:]
@@ -614,6 +666,119 @@ class Interface(threading.Thread):
         return out
 
 
+def socket_pair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # windows. use the original socket class, start_tcp may have replaced it with a proxy
+    l = socks._orgsocket(socket.AF_INET, socket.SOCK_STREAM)
+    l.bind(('127.0.0.1', 0))
+    l.listen(1)
+    a = socks._orgsocket(socket.AF_INET, socket.SOCK_STREAM)
+    a.connect(l.getsockname())
+    b, addr = l.accept()
+    l.close()
+    return a, b
+
+
+class InterfacePoller(threading.Thread):
+    """ reads and writes the sockets of all tcp interfaces in a single thread """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.interfaces = set()
+        self.wakeup_r, self.wakeup_w = socket_pair()
+        self.wakeup_r.setblocking(0)
+        self.wakeup_w.setblocking(0)
+        self.idle_timeout = 60
+
+    def add(self, i):
+        with self.lock:
+            self.interfaces.add(i)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send('x')
+        except socket.error:
+            # the pipe is full, the poller will wake up anyway
+            pass
+
+    def close(self, i):
+        with self.lock:
+            self.interfaces.discard(i)
+        i.is_connected = False
+        try:
+            i.s.close()
+        except Exception:
+            pass
+        print_error("disconnected from", i.server)
+        i.change_status()
+
+    def run(self):
+        while True:
+            with self.lock:
+                interfaces = list(self.interfaces)
+            for i in interfaces:
+                if not i.is_connected:
+                    self.close(i)
+            interfaces = [i for i in interfaces if i.is_connected]
+
+            w = [i for i in interfaces if i.wants_write()]
+            try:
+                readable, writable, _ = select.select([self.wakeup_r] + interfaces, w, [], 1)
+            except (select.error, socket.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                # a socket was closed under us
+                time.sleep(0.1)
+                continue
+
+            if self.wakeup_r in readable:
+                readable.remove(self.wakeup_r)
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+
+            for i in writable:
+                try:
+                    i.on_writable()
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    i.is_connected = False
+
+            for i in readable:
+                if not i.is_connected:
+                    continue
+                try:
+                    if not i.on_readable():
+                        i.is_connected = False
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    i.is_connected = False
+
+            now = time.time()
+            for i in interfaces:
+                if i.is_connected and now - max(i.last_recv, i.last_ping) > self.idle_timeout:
+                    i.on_idle()
+
+
+poller = None
+poller_lock = threading.Lock()
+
+def get_poller():
+    global poller
+    with poller_lock:
+        if poller is None:
+            poller = InterfacePoller()
+            poller.start()
+    return poller
+
+
+
 if __name__ == "__main__":
 
     check_certificates()
@@ -123,9 +123,11 @@ class Network(threading.Thread):
         with self.lock:
             if self.subscriptions.get(callback) is None: 
                 self.subscriptions[callback] = []
-            for message in messages:
-                if message not in self.subscriptions[callback]:
-                    self.subscriptions[callback].append(message)
+            known = set((m, tuple(v)) for m, v in self.subscriptions[callback])
+            for m, v in messages:
+                if (m, tuple(v)) not in known:
+                    known.add((m, tuple(v)))
+                    self.subscriptions[callback].append((m, v))
 
         if self.is_connected():
             self.interface.send( messages, callback )
@@ -314,6 +316,7 @@ class Network(threading.Thread):
             else:
                 print_error('no height for main interface')
         
+        self.trigger_callback('blockchain_height')
         self.trigger_callback('updated')
 
 
@@ -392,12 +395,14 @@ class Network(threading.Thread):
         with self.lock: return self.running
 
     
-    def synchronous_get(self, requests, timeout=100000000):
-        return self.interface.synchronous_get(requests)
+    def synchronous_get(self, requests, timeout=None):
+        return self.interface.synchronous_get(requests, timeout)
 
 
     def get_header(self, tx_height):
-        return self.blockchain.read_header(tx_height)
+        header = self.blockchain.read_header(tx_height)
+        if header:
+            return header.as_dict()
 
     def get_local_height(self):
         return self.blockchain.height()
@@ -19,6 +19,11 @@
 import hashlib
 import hmac
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def scrypt_1024_1_1_80(header):
     if not isinstance(header, str) or len(header) != 80:
         raise ValueError('header must be an 80-byte string')
@@ -245,6 +250,97 @@ def _xor_salsa8_2(X):
 
 
 
+
+# salsa20/8 state in diagonal order, so that each step of a quarter-round
+# works on one row of four independent words
+_DIAGONAL = [0, 5, 10, 15, 4, 9, 14, 3, 8, 13, 2, 7, 12, 1, 6, 11]
+_UNDIAGONAL = [_DIAGONAL.index(i) for i in xrange(16)]
+
+# below this many headers, the numpy overhead makes lock-step slower
+# than hashing the headers one by one
+MIN_LANES = 32
+
+def scrypt_1024_1_1_80_batch(headers, lanes=512):
+    """ hash a list of 80-byte headers. With numpy, salsa20/8 runs on
+    up to 'lanes' headers in lock-step (128 KB of scratchpad per lane);
+    without it, or for fewer than MIN_LANES headers, this is the same
+    as mapping scrypt_1024_1_1_80. """
+    out = []
+    for i in xrange(0, len(headers), lanes):
+        group = headers[i:i+lanes]
+        if numpy is None or len(group) < MIN_LANES:
+            out += map(scrypt_1024_1_1_80, group)
+        else:
+            out += _scrypt_1024_1_1_80_lanes(group)
+    return out
+
+def _scrypt_1024_1_1_80_lanes(headers):
+    n = len(headers)
+    macs = []
+    # one column per header
+    X = numpy.empty((32, n), dtype=numpy.uint32)
+    for j, header in enumerate(headers):
+        if not isinstance(header, str) or len(header) != 80:
+            raise ValueError('header must be an 80-byte string')
+        mac = hmac.new(header, digestmod=hashlib.sha256)
+        B = ''
+        for i in xrange(4):
+            m = mac.copy()
+            m.update(header + '\0\0\0' + chr(i + 1))
+            B += m.digest()
+        X[:, j] = numpy.frombuffer(B, dtype='<u4')
+        macs.append(mac)
+
+    V = numpy.empty((1024, 32, n), dtype=numpy.uint32)
+    for i in xrange(1024):
+        V[i] = X
+        _xor_salsa8_lanes(X)
+
+    columns = numpy.arange(n)
+    for i in xrange(1024):
+        k = X[16] & 1023
+        X ^= V[k, :, columns].T
+        _xor_salsa8_lanes(X)
+
+    out = []
+    for j, mac in enumerate(macs):
+        mac.update(X[:, j].astype('<u4').tostring() + '\0\0\0\x01')
+        out.append(mac.digest())
+    return out
+
+def _xor_salsa8_lanes(X):
+    X[0:16] ^= X[16:32]
+    X[0:16] += _salsa8_core_lanes(X[0:16])
+    X[16:32] ^= X[0:16]
+    X[16:32] += _salsa8_core_lanes(X[16:32])
+
+def _salsa8_core_lanes(B):
+    x = B[_DIAGONAL]
+    a, b, c, d = x[0:4], x[4:8], x[8:12], x[12:16]
+    s = numpy.empty_like(a)
+    u = numpy.empty_like(a)
+    for j in xrange(4):
+        # columns
+        _quarter_round_lanes(a, b, c, d, s, u)
+        # rows: rotate b, c, d so that the rows line up with a
+        b[:] = numpy.roll(b, 1, 0)
+        c[:] = numpy.roll(c, 2, 0)
+        d[:] = numpy.roll(d, -1, 0)
+        _quarter_round_lanes(a, d, c, b, s, u)
+        b[:] = numpy.roll(b, -1, 0)
+        c[:] = numpy.roll(c, 2, 0)
+        d[:] = numpy.roll(d, 1, 0)
+    return x[_UNDIAGONAL]
+
+def _quarter_round_lanes(a, b, c, d, s, u):
+    for t, p, q, r in ((b, a, d, 7), (c, b, a, 9), (d, c, b, 13), (a, d, c, 18)):
+        numpy.add(p, q, s)
+        numpy.left_shift(s, r, u)
+        numpy.right_shift(s, 32 - r, s)
+        u |= s
+        t ^= u
+
+
 if __name__ == '__main__':
 
     vectors = [
@@ -264,3 +360,17 @@ if __name__ == '__main__':
     dt = (default_timer() - t0) / len(vectors)
     print "%.1f ms/hash" % (dt*1000)
     print "%.2f hash/s" % (1.0 / dt)
+
+    # the batch engine must be bit-exact with the reference implementation
+    headers = [header.decode('hex') for header, hash in vectors]
+    headers += [scrypt_1024_1_1_80(h) + h[32:] for h in headers]
+    headers = (headers * MIN_LANES)[:MIN_LANES]
+    t0 = default_timer()
+    hashes = scrypt_1024_1_1_80_batch(headers)
+    dt = (default_timer() - t0) / len(headers)
+    for (header, hash), h in zip(vectors, hashes):
+        assert h == hash.decode('hex')
+    for header, h in zip(headers, hashes):
+        assert h == scrypt_1024_1_1_80(header)
+
+    print "batch (%s): %.1f ms/hash" % ("numpy" if numpy else "fallback", dt*1000)
@@ -66,16 +66,18 @@ class WalletSynchronizer(threading.Thread):
 
         print_error("synchronizer: connected to", self.network.main_server())
 
-        requested_tx = []
-        missing_tx = []
+        requested_tx = set()
+        missing_tx = set()
         requested_histories = {}
+        missing_histories = []
+        callback = lambda i,r: self.queue.put(r)
 
         # request any missing transactions
         for history in self.wallet.history.values():
             if history == ['*']: continue
             for tx_hash, tx_height in history:
-                if self.wallet.transactions.get(tx_hash) is None and (tx_hash, tx_height) not in missing_tx:
-                    missing_tx.append( (tx_hash, tx_height) )
+                if tx_hash not in self.wallet.transactions and (tx_hash, tx_height) not in missing_tx:
+                    missing_tx.add( (tx_hash, tx_height) )
 
         if missing_tx:
             print_error("missing tx", missing_tx)
@@ -91,18 +93,27 @@ class WalletSynchronizer(threading.Thread):
             if new_addresses:
                 self.subscribe_to_addresses(new_addresses)
 
-            # request missing transactions
-            for tx_hash, tx_height in missing_tx:
-                if (tx_hash, tx_height) not in requested_tx:
-                    self.network.send([ ('blockchain.transaction.get',[tx_hash, tx_height]) ], lambda i,r: self.queue.put(r))
-                    requested_tx.append( (tx_hash, tx_height) )
-            missing_tx = []
+            # request missing histories and transactions, in a single batch
+            # once the responses received so far have been processed
+            if (missing_histories or missing_tx) and self.queue.empty():
+                messages = []
+                for addr in missing_histories:
+                    messages.append( ('blockchain.address.get_history', [addr]) )
+                for tx_hash, tx_height in missing_tx:
+                    if (tx_hash, tx_height) not in requested_tx:
+                        messages.append( ('blockchain.transaction.get',[tx_hash, tx_height]) )
+                        requested_tx.add( (tx_hash, tx_height) )
+                self.network.send(messages, callback)
+                missing_histories = []
+                missing_tx = set()
 
             # detect if situation has changed
             if self.network.is_up_to_date() and self.queue.empty():
                 if not self.wallet.is_up_to_date():
                     self.wallet.set_up_to_date(True)
                     self.was_updated = True
+                    # idle: write what was received during the sync
+                    self.wallet.storage.flush()
             else:
                 if self.wallet.is_up_to_date():
                     self.wallet.set_up_to_date(False)
@@ -138,7 +149,7 @@ class WalletSynchronizer(threading.Thread):
                 addr = params[0]
                 if self.wallet.get_status(self.wallet.get_history(addr)) != result:
                     if requested_histories.get(addr) is None:
-                        self.network.send([('blockchain.address.get_history', [addr])], lambda i,r:self.queue.put(r))
+                        missing_histories.append(addr)
                         requested_histories[addr] = result
 
             elif method == 'blockchain.address.get_history':
@@ -170,9 +181,9 @@ class WalletSynchronizer(threading.Thread):
 
                     # request transactions that we don't have 
                     for tx_hash, tx_height in hist:
-                        if self.wallet.transactions.get(tx_hash) is None:
+                        if tx_hash not in self.wallet.transactions:
                             if (tx_hash, tx_height) not in requested_tx and (tx_hash, tx_height) not in missing_tx:
-                                missing_tx.append( (tx_hash, tx_height) )
+                                missing_tx.add( (tx_hash, tx_height) )
 
             elif method == 'blockchain.transaction.get':
                 tx_hash = params[0]
@@ -0,0 +1,123 @@
+import pickle
+import threading
+import unittest
+
+from lib import account, bitcoin
+from lib.util import LRUCache
+from lib.bitcoin import deserialize_xkey, CKD_pub
+
+
+def make_xpub(seed, path):
+    xprv, xpub = bitcoin.bip32_root(seed)
+    xprv, xpub = bitcoin.bip32_private_derivation(xprv, "m/", path)
+    return xpub
+
+def derive_pubkey(xpub, for_change, n):
+    """ the public key derived from the master key, without the caches """
+    _, _, _, c, cK = deserialize_xkey(xpub)
+    for i in [for_change, n]:
+        cK, c = CKD_pub(cK, c, i)
+    return cK.encode('hex')
+
+
+class TestBIP32Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.xpub = make_xpub('000102030405060708090a0b0c0d0e0f', "m/0'")
+        self.xpub2 = make_xpub('ff'*16, "m/1'")
+
+    def test_pubkeys(self):
+        a = account.BIP32_Account({'xpub': self.xpub})
+        for i in range(2):
+            # the second time from the caches
+            for for_change in [0, 1]:
+                for n in range(10):
+                    self.assertEqual(a.get_pubkey(for_change, n), derive_pubkey(self.xpub, for_change, n))
+        self.assertEqual(sorted(a.branch_nodes.keys()), [(self.xpub, 0), (self.xpub, 1)])
+
+    def test_small_cache(self):
+        a = account.BIP32_Account({'xpub': self.xpub})
+        a.pubkeys = LRUCache(3)
+        for n in range(10) + range(10):
+            self.assertEqual(a.get_pubkey(0, n), derive_pubkey(self.xpub, 0, n))
+
+    def test_2of2(self):
+        a = account.BIP32_Account_2of2({'xpub': self.xpub, 'xpub2': self.xpub2})
+        for n in range(3):
+            expected = sorted([derive_pubkey(self.xpub, 0, n), derive_pubkey(self.xpub2, 0, n)])
+            self.assertEqual(a.get_pubkeys((0, n)), expected)
+            self.assertEqual(a.get_pubkeys((0, n)), expected)
+
+    def test_threads(self):
+        a = account.BIP32_Account({'xpub': self.xpub})
+        errors = []
+        def work(k):
+            try:
+                for n in range(100):
+                    a.get_pubkey(k % 2, n % 20)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(a.get_pubkey(1, 7), derive_pubkey(self.xpub, 1, 7))
+
+    def test_pickle(self):
+        # accounts are sent to the derivation processes without their addresses
+        a = account.BIP32_Account({'xpub': self.xpub, '0': ['x']})
+        a.get_pubkey(0, 3)
+        b = pickle.loads(pickle.dumps(a))
+        self.assertEqual(b.addresses, [])
+        self.assertEqual(b.get_pubkey(0, 3), a.get_pubkey(0, 3))
+        self.assertEqual(b.get_pubkey(1, 4), derive_pubkey(self.xpub, 1, 4))
+
+
+
+class TestDerivation(unittest.TestCase):
+    """ addresses derived in blocks, in the calling process or in the
+    derivation pool, are the ones derived one at a time """
+
+    @classmethod
+    def setUpClass(cls):
+        xpub = make_xpub('000102030405060708090a0b0c0d0e0f', "m/0'")
+        xpub2 = make_xpub('ff'*16, "m/1'")
+        mpk = account.OldAccount.mpk_from_seed('0123456789abcdef0123456789abcdef')
+        cls.accounts = [account.BIP32_Account({'xpub': xpub}),
+                        account.BIP32_Account_2of2({'xpub': xpub, 'xpub2': xpub2}),
+                        account.OldAccount({'mpk': mpk})]
+        cls.serial = [[a.get_address(for_change, i) for for_change in [0, 1] for i in range(30)] for a in cls.accounts]
+
+    def setUp(self):
+        self.min_addresses = account.POOL_MIN_ADDRESSES
+        account.POOL_MIN_ADDRESSES = 10
+
+    def tearDown(self):
+        account.POOL_MIN_ADDRESSES = self.min_addresses
+        account.stop_derivation_pool()
+
+    def check(self):
+        for a, serial in zip(self.accounts, self.serial):
+            a.addresses = serial[:5]
+            a.change = []
+            self.assertEqual(a.get_address_range(0, 3, 7), serial[3:7])
+            self.assertEqual(a.create_new_addresses(0, 25), serial[5:30])
+            self.assertEqual(a.create_new_addresses(1, 30), serial[30:60])
+            self.assertEqual(a.addresses + a.change, serial)
+
+    def test_without_pool(self):
+        self.assertEqual(account.get_derivation_pool(), (None, 0))
+        self.check()
+
+    def test_pool(self):
+        account.start_derivation_pool(2)
+        self.assertEqual(account.get_derivation_pool()[1], 2)
+        self.check()
+        account.stop_derivation_pool()
+        self.assertEqual(account.get_derivation_pool(), (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import random
+import unittest
+
+from ecdsa.curves import SECP256k1
+from ecdsa.keys import SigningKey
+
+from lib import account, bitcoin
+from lib.bitcoin import *
+
+
+B58_CHARS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+def reference_b58encode(v):
+    # one digit at a time, like the code the chunked version replaced
+    n = 0
+    for c in v:
+        n = n * 256 + ord(c)
+    result = ''
+    while n:
+        n, mod = divmod(n, 58)
+        result = B58_CHARS[mod] + result
+    return '1' * (len(v) - len(v.lstrip('\0'))) + result
+
+def reference_b58decode(v, length):
+    n = 0
+    for c in v:
+        n = n * 58 + B58_CHARS.index(c)
+    result = ''
+    while n:
+        n, mod = divmod(n, 256)
+        result = chr(mod) + result
+    result = '\0' * (len(v) - len(v.lstrip('1'))) + result
+    if length is not None and len(result) != length:
+        return None
+    return result
+
+
+class TestKeys(unittest.TestCase):
+    """ the expected values were computed with the python-ecdsa
+    implementation used before lib/ecc.py """
+
+    def test_bip32(self):
+        xprv, xpub = bip32_root('000102030405060708090a0b0c0d0e0f')
+        xprv, xpub = bip32_private_derivation(xprv, "m/", "m/0'/5")
+        self.assertEqual(xprv, "xprv9wTYmMFdV23NDR3tvHCEMdEpusPdqU2FJqbziPAgjVHzPTG2FvaUkhS37w4uUsXDHFXpH6EzQ8M3MBuRBtZ9rS2SwyDNKtzDFQzTrzdgQkW")
+        self.assertEqual(xpub, "xpub6ASuArnXKPbfRu8N2JjEimBZTuE8Evk6g4XbWmaJHppyGFbAoTtjJVkWyC7NzkZNJjuF4r8KZdxRBPEsDG8KupvdknNydxWAB9W81SkpGJ3")
+        self.assertEqual(bip32_public_derivation(xpub, "m/", "m/1/7"), "xpub6EVqaA35jqfeeLUQz41qpABrw7xRaFvvpqpxvrzUbZktVBbz3FsYXkceNUp6zVAA2axuZMRtaaaiS8VBv8ffZ5dFWSRfhJE3DucaNDXBeRm")
+        # public and private derivations agree
+        xprv2, xpub2 = bip32_private_derivation(xprv, "m/", "m/1/7")
+        self.assertEqual(xpub2, bip32_public_derivation(xpub, "m/", "m/1/7"))
+
+    def test_old_account(self):
+        a = account.OldAccount({'mpk': account.OldAccount.mpk_from_seed('0123456789abcdef0123456789abcdef')})
+        self.assertEqual(a.mpk.encode('hex'), "7a4a6acb200cb895e5c518fe1d5c094de578cf4e86daf61e4e283a22456551cf3a25f28e9ed6316de40e5cb6e33313e80898e1f3e0011e84dcaeb6c6e260328a")
+        self.assertEqual(a.get_pubkey(0, 3), "048d0d4d6dfcd436d04b57215c9d5cf70cb8fb1244fbd143b824cfa0b9d4c07f5753f578813d3021bd9759aea7037d6d999c6aa20cec1277be85ee6beb6f15fa90")
+        self.assertEqual(a.get_pubkey(1, 9), "046d66a06d657bf62cef1f141d2acbf6327734978c5bac891f78a0aeea3f9bdd06c3a639e4f2ec633b1477431e80e1fd4c90dc467a6a80a9cb7803ae806546c113")
+
+    def test_pubkeys(self):
+        self.assertEqual([x.encode('hex') for x in get_pubkeys_from_secret(('22'*32).decode('hex'))], [
+            "466d7fcae563e5cb09a0d1870bb580344804617879a14949cf22285f1bae3f276728176c3c6431f8eeda4538dc37c865e2784f3a9e77d044f33e407797e1278a",
+            "02466d7fcae563e5cb09a0d1870bb580344804617879a14949cf22285f1bae3f27"])
+        for i in range(10):
+            secret = os.urandom(32)
+            key = SigningKey.from_string(secret, curve=SECP256k1)
+            uncompressed, compressed = get_pubkeys_from_secret(secret)
+            self.assertEqual(uncompressed, key.get_verifying_key().to_string())
+            self.assertEqual(public_key_from_private_key(SecretToASecret(secret)), '04' + uncompressed.encode('hex'))
+
+    def test_message_signature(self):
+        sec = SecretToASecret(('11'*32).decode('hex'), True)
+        addr = address_from_private_key(sec)
+        self.assertEqual(addr, "VZg39gnYxrfh5mNZ8ivC86B85r8Ron95sz")
+        self.assertEqual(public_key_from_private_key(sec), "034f355bdcb7cc0af728ef3cceb9615d90684bb5b2ca5f859ab0f0b704075871aa")
+        signature = regenerate_key(sec).sign_message('hello', True, addr)
+        self.assertEqual(signature, "IFRhvAUjab3orC4dV5gsm1L4pPda9XZGWSucxCkN3EJkbEB8oVBeCo8/xwtO52i9KP0icUHWvmL/lTiQYvlQ2cA=")
+        self.assertTrue(verify_message(addr, signature, 'hello'))
+        self.assertFalse(verify_message(addr, signature, 'hello!'))
+
+    def test_random_messages(self):
+        for compressed in [True, False]:
+            for i in range(5):
+                sec = SecretToASecret(os.urandom(32), compressed)
+                addr = address_from_private_key(sec)
+                message = os.urandom(20).encode('hex')
+                self.assertTrue(verify_message(addr, regenerate_key(sec).sign_message(message, compressed, addr), message))
+
+
+
+class TestBase58(unittest.TestCase):
+
+    def test_reference(self):
+        rnd = random.Random(25)
+        for i in range(2000):
+            v = ''.join(chr(rnd.randrange(256)) for j in range(rnd.choice([0, 1, 2, 5, 21, 25, 37, 78, 82, 100])))
+            if rnd.random() < .3:
+                v = '\0' * rnd.randint(1, 3) + v
+            e = b58encode(v)
+            self.assertEqual(e, reference_b58encode(v))
+            self.assertEqual(b58decode(e, None), v)
+            for length in [None, len(v), len(v) - 1, len(v) + 1]:
+                self.assertEqual(b58decode(e, length), reference_b58decode(e, length), (v.encode('hex'), length))
+
+    def test_invalid(self):
+        addr = hash_160_to_bc_address(os.urandom(20))
+        for v in [addr + '0', addr[:-1] + 'O', addr + 'l', 'I']:
+            self.assertEqual(b58decode(v, None), None)
+            self.assertFalse(is_address(v))
+        self.assertEqual(b58decode(addr, 24), None)
+        self.assertEqual(DecodeBase58Check('1111'), None)
+
+    def test_address_cache(self):
+        for addrtype in [0, 5, 70, 255]:
+            h160 = os.urandom(20)
+            addr = hash_160_to_bc_address(h160, addrtype)
+            self.assertEqual(addr, reference_b58encode(chr(addrtype) + h160 + Hash(chr(addrtype) + h160)[:4]))
+            for i in range(2):
+                # computed, then from the caches
+                self.assertEqual(hash_160_to_bc_address(h160, addrtype), addr)
+                self.assertEqual(bc_address_to_hash_160(addr), (addrtype, h160))
+                bitcoin._address_cache.clear()
+            self.assertTrue(is_address(addr))
+            self.assertFalse(is_address(addr[:-1] + ('z' if addr[-1] != 'z' else 'y')))
+
+    def test_keys(self):
+        xprv, xpub = bip32_root('000102030405060708090a0b0c0d0e0f')
+        self.assertEqual(EncodeBase58Check(DecodeBase58Check(xpub)), xpub)
+        self.assertEqual(deserialize_xkey(xpub)[3], deserialize_xkey(xprv)[3])
+        sec = SecretToASecret('\1'*32, True)
+        # with the compression flag
+        self.assertEqual(ASecretToSecret(sec), '\1'*33)
+        self.assertEqual(ASecretToSecret(SecretToASecret('\1'*32)), '\1'*32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,445 @@
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib import blockchain
+from lib.blockchain import Blockchain, Header, HeaderStore, checkpoints_from_headers
+from lib.bitcoin import Hash, hash_encode
+
+
+def make_headers(n, prev_hash='\0'*32, start=0, bits=0x1e0ffff0, spacing=150):
+    """ n raw headers that link to each other, starting at height start """
+    headers = []
+    for h in range(start, start + n):
+        raw = struct.pack('<I', 1) + prev_hash + os.urandom(32) + struct.pack('<III', 1400000000 + spacing*h, bits, h)
+        headers.append(raw)
+        prev_hash = Hash(raw)
+    return headers
+
+
+class Network(object):
+
+    def __init__(self, interfaces=[]):
+        self.interfaces = dict((i.server, i) for i in interfaces)
+
+
+class Job(object):
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.timeout = None
+
+    def get(self, timeout=None):
+        self.timeout = timeout
+        return self.f(*self.args)
+
+
+class LostJob(Job):
+    """ the job of a worker that died """
+
+    def get(self, timeout=None):
+        self.timeout = timeout
+        raise multiprocessing.TimeoutError()
+
+
+class Pool(object):
+    """ runs the jobs in the calling thread """
+
+    job = Job
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, f, args):
+        job = self.job(f, args)
+        self.jobs.append(job)
+        return job
+
+
+class Config(dict):
+
+    def __init__(self, path, **kwargs):
+        dict.__init__(self, **kwargs)
+        self.path = path
+
+
+class Interface(object):
+    """ a server that answers at once from a list of raw headers """
+
+    is_connected = True
+    server = 'test'
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.requests = []
+
+    def send(self, messages, callback):
+        self.requests.append(messages)
+        for method, params in messages:
+            k = params[0]
+            if method == 'blockchain.block.get_header':
+                result = Header(self.chain[k], k).as_dict()
+            else:
+                result = ''.join(self.chain[k*2016:(k+1)*2016]).encode('hex')
+            callback(self, {'method': method, 'params': params, 'result': result})
+
+
+class BadInterface(Interface):
+    """ a server that sends chunks that do not verify """
+
+    def send(self, messages, callback):
+        self.requests.append(messages)
+        for method, params in messages:
+            callback(self, {'method': method, 'params': params, 'result': os.urandom(2016*80).encode('hex')})
+
+
+class ErrorInterface(Interface):
+
+    def send(self, messages, callback):
+        self.requests.append(messages)
+        for method, params in messages:
+            callback(self, {'method': method, 'params': params, 'error': 'error'})
+
+
+class DeadInterface(Interface):
+    """ a server that never answers """
+
+    def send(self, messages, callback):
+        self.requests.append(messages)
+
+
+class BlockchainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = Config(self.dir)
+        self.blockchains = []
+
+    def tearDown(self):
+        for b in self.blockchains:
+            b.stop()
+        shutil.rmtree(self.dir)
+
+    def make_blockchain(self, headers, network=None):
+        with open(os.path.join(self.dir, 'blockchain_headers'), 'wb') as f:
+            f.write(''.join(headers))
+        b = Blockchain(self.config, network)
+        b.running = True
+        b.set_local_height()
+        self.blockchains.append(b)
+        return b
+
+
+class TestHeaderStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'blockchain_headers')
+        self.headers = make_headers(100)
+        self.store = HeaderStore(self.path, Header, cache_size=10)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_missing_file(self):
+        self.assertEqual(self.store.height(), None)
+        self.assertEqual(self.store.read(0), None)
+
+    def test_read(self):
+        with open(self.path, 'wb') as f:
+            f.write(''.join(self.headers))
+        self.assertEqual(self.store.height(), 99)
+        for h in [0, 50, 99, 50]:
+            header = self.store.read(h)
+            self.assertEqual((header.raw, header.block_height), (self.headers[h], h))
+        self.assertEqual(self.store.read(100), None)
+        self.assertEqual(self.store.read(-1), None)
+
+    def test_write(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(self.store.height(), -1)
+        self.assertEqual(self.store.write(0, ''.join(self.headers[:60])), 59)
+        self.assertEqual(self.store.read(59).raw, self.headers[59])
+        # appending, and overwriting headers that are in the cache
+        self.assertEqual(self.store.write(50, ''.join(self.headers[50:])), 99)
+        other = make_headers(5, start=20)
+        for h in range(15, 30):
+            self.store.read(h)
+        self.assertEqual(self.store.write(20, ''.join(other)), 99)
+        expected = self.headers[:20] + other + self.headers[25:]
+        self.assertEqual([self.store.read(h).raw for h in range(100)], expected)
+        self.store.close()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), ''.join(expected))
+
+
+class TestHeader(unittest.TestCase):
+
+    def header_from_string(self, s):
+        """ the header dicts that Header replaces """
+        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
+        return {'version': hex_to_int(s[0:4]), 'prev_block_hash': hash_encode(s[4:36]),
+                'merkle_root': hash_encode(s[36:68]), 'timestamp': hex_to_int(s[68:72]),
+                'bits': hex_to_int(s[72:76]), 'nonce': hex_to_int(s[76:80])}
+
+    def test_fields(self):
+        for h, raw in enumerate(make_headers(10)):
+            header = Header(raw, h)
+            d = dict(self.header_from_string(raw), block_height=h)
+            self.assertEqual(header.as_dict(), d)
+            for key, value in d.items():
+                self.assertEqual(header.get(key), value)
+            self.assertEqual(header.get('foo', 1), 1)
+            self.assertEqual(header.hash(), hash_encode(Hash(raw)))
+
+    def test_from_dict(self):
+        for h, raw in enumerate(make_headers(10)):
+            d = dict(self.header_from_string(raw), block_height=h)
+            header = Header.from_dict(d)
+            self.assertEqual((header.raw, header.block_height), (raw, h))
+        self.assertEqual(Header(raw).as_dict(), self.header_from_string(raw))
+
+    def test_blockchain_helpers(self):
+        b = object.__new__(Blockchain)
+        raw = make_headers(1)[0]
+        d = self.header_from_string(raw)
+        for header in [d, Header(raw)]:
+            self.assertEqual(b.header_to_string(header), raw.encode('hex'))
+            self.assertEqual(b.hash_header(header), hash_encode(Hash(raw)))
+        self.assertEqual(b.header_from_string(raw).as_dict(), d)
+
+
+def reference_target(read_header, index):
+    """ the retarget computation that the table of targets caches """
+    max_target = 0x00000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+    if index == 0: return 0x1e0ffff0, 0x00000FFFF0000000000000000000000000000000000000000000000000000000
+    first = read_header(0 if index == 1 else (index-1)*2016-1)
+    last = read_header(index*2016-1)
+    nActualTimespan = last.get('timestamp') - first.get('timestamp')
+    nTargetTimespan = 84*60*60
+    nActualTimespan = max(nActualTimespan, nTargetTimespan/4)
+    nActualTimespan = min(nActualTimespan, nTargetTimespan*4)
+    bits = last.get('bits')
+    MM = 256*256*256
+    a = bits%MM
+    if a < 0x8000:
+        a *= 256
+    target = (a) * pow(2, 8 * (bits/MM - 3))
+    new_target = min( max_target, (target * nActualTimespan)/nTargetTimespan )
+    c = ("%064X"%new_target)[2:]
+    i = 31
+    while c[0:2]=="00":
+        c = c[2:]
+        i -= 1
+    c = int('0x'+c[0:6],16)
+    if c >= 0x800000:
+        c /= 256
+        i += 1
+    return c + MM * i, new_target
+
+
+class TestTargets(BlockchainTest):
+
+    def test_compute_target(self):
+        for bits in [0x1e0ffff0, 0x1d00ffff, 0x1c0a1b2c, 0x1b04864c, 0x1e00ffff, 0x1e0fffff]:
+            for spacing in [1, 37, 150, 151, 600, 5000]:
+                headers = dict((h, Header(raw, h)) for h, raw in
+                               zip([0, 2015, 4031], make_headers(3, bits=bits, spacing=spacing)))
+                headers[2015].raw = headers[2015].raw[:68] + struct.pack('<I', 1400000000 + spacing*2015) + headers[2015].raw[72:]
+                headers[4031].raw = headers[4031].raw[:68] + struct.pack('<I', 1400000000 + spacing*4031) + headers[4031].raw[72:]
+                b = object.__new__(Blockchain)
+                b.read_header = headers.get
+                for index in [0, 1, 2]:
+                    self.assertEqual(b.compute_target(index), reference_target(headers.get, index), (hex(bits), spacing, index))
+
+    def test_table(self):
+        headers = make_headers(2016, spacing=100)
+        headers += make_headers(2016 + 10, Hash(headers[-1]), 2016, spacing=200)
+        b = self.make_blockchain(headers)
+        self.assertEqual(len(b.targets), 3)
+        for index in range(3):
+            self.assertEqual(b.get_target(index), reference_target(b.read_header, index))
+        # the table is saved, and kept on restart while the headers match
+        b.stop()
+        b = self.make_blockchain(headers)
+        self.assertEqual(b.targets, [tuple(t) for t in b.targets])
+        self.assertEqual([b.get_target(index) for index in range(3)],
+                         [reference_target(b.read_header, index) for index in range(3)])
+
+    def test_invalidation(self):
+        headers = make_headers(2*2016 + 10)
+        b = self.make_blockchain(headers)
+        self.assertEqual(len(b.targets), 3)
+        # a reorg below the end of the second period replaces its target
+        other = make_headers(100, Hash(headers[3999]), 4000, spacing=50)
+        b.save_chunk(1, ''.join(headers[2016:4000] + other[:32]))
+        self.assertEqual(len(b.targets), 3)
+        self.assertEqual(b.targets[2][2], Header(other[31]).hash())
+        self.assertEqual(b.get_target(2), reference_target(b.read_header, 2))
+        before = dict(enumerate(map(Header, headers)))
+        self.assertNotEqual(b.get_target(2), reference_target(before.get, 2))
+        b.save_chunk(1, ''.join(headers[2016:4032]))
+        self.assertEqual(b.targets[2][2], Header(headers[4031]).hash())
+        # headers changed while the client was not running
+        b.stop()
+        with open(b.path(), 'r+b') as f:
+            f.seek(4031*80)
+            f.write(other[31])
+        b = Blockchain(self.config, None)
+        self.blockchains.append(b)
+        self.assertEqual(len(b.targets), 3)
+        self.assertEqual(b.targets[2][2], Header(other[31]).hash())
+
+
+class TestGetChain(BlockchainTest):
+
+    def test_fork_point(self):
+        local = make_headers(5000)
+        b = self.make_blockchain(local)
+        for fork, top in [(4999, 5000), (4998, 5001), (3000, 5003), (4990, 5030), (100, 4999), (0, 4100)]:
+            i = Interface(local[:fork + 1] + make_headers(top - fork, Hash(local[fork]), fork + 1))
+            self.assertEqual(b.find_fork_point(i, min(top - 1, b.height())), fork)
+            chain = b.get_chain(i, Header(i.chain[top], top).as_dict())
+            self.assertEqual([h.raw for h in chain], i.chain[fork + 1:top + 1])
+            self.assertEqual([h.block_height for h in chain], range(fork + 1, top + 1))
+
+    def test_fork_point_round_trips(self):
+        local = make_headers(5000)
+        b = self.make_blockchain(local)
+        i = Interface(local[:1235] + make_headers(3800, Hash(local[1234]), 1235))
+        self.assertEqual(b.find_fork_point(i, 4999), 1234)
+        # one batch of exponential probes, then a few bisection batches
+        self.assertTrue(len(i.requests) <= 6, len(i.requests))
+
+    def test_segment(self):
+        headers = make_headers(3*2016 + 10)
+        b = self.make_blockchain([])
+        i = Interface(headers)
+        for start, end in [(0, 10), (5, 4), (100, 2016*3 + 9), (2015, 2017)]:
+            segment = b.get_segment(i, start, end)
+            self.assertEqual([h.raw for h in segment], headers[start:end + 1])
+            self.assertEqual([h.block_height for h in segment], range(start, end + 1))
+
+
+
+class PoWTest(BlockchainTest):
+
+    def setUp(self):
+        BlockchainTest.setUp(self)
+        # a proof of work that can be met here: sha256d under any target
+        self.getPoWHashes = blockchain.getPoWHashes
+        self.get_target = Blockchain.get_target
+        blockchain.getPoWHashes = lambda headers: map(Hash, headers)
+        Blockchain.get_target = lambda b, index, chain=[]: (0x1e0ffff0, 2**256)
+
+    def tearDown(self):
+        blockchain.getPoWHashes = self.getPoWHashes
+        Blockchain.get_target = self.get_target
+        BlockchainTest.tearDown(self)
+
+
+class TestCheckpoints(PoWTest):
+
+    def setUp(self):
+        PoWTest.setUp(self)
+        self.headers = make_headers(2*2016 + 5)
+
+    def test_checkpoints(self):
+        checkpoints = checkpoints_from_headers(''.join(self.headers))
+        self.assertEqual(checkpoints, [(h, hash_encode(Hash(self.headers[h])), 0x1e0ffff0) for h in [2015, 4031]])
+
+    def test_proof_of_work(self):
+        Blockchain.get_target = lambda b, index, chain=[]: (0x1e0ffff0, 2**256 if index == 0 else 0)
+        self.assertRaises(Exception, checkpoints_from_headers, ''.join(self.headers))
+
+    def test_bad_chunk(self):
+        checkpoints = checkpoints_from_headers(''.join(self.headers))
+        b = self.make_blockchain([])
+        b.set_checkpoints(checkpoints)
+        # below a checkpoint, the PoW is not checked, but a chunk that does
+        # not lead to the checkpoint is rejected
+        Blockchain.get_target = lambda b, index, chain=[]: (0x1e0ffff0, 0)
+        other = make_headers(2016)
+        self.assertRaises(AssertionError, b.verify_chunk, 0, ''.join(other).encode('hex'))
+        self.assertEqual(b.height(), -1)
+        b.verify_chunk(0, ''.join(self.headers[:2016]).encode('hex'))
+        forged = self.headers[2016:4031] + make_headers(1, Hash(self.headers[4030]), 4031)
+        self.assertRaises(AssertionError, b.verify_chunk, 1, ''.join(forged).encode('hex'))
+        b.verify_chunk(1, ''.join(self.headers[2016:4032]).encode('hex'))
+        self.assertEqual(b.height(), 4031)
+
+    def test_headers_file(self):
+        # a downloaded headers file is kept as far as checkpoints anchor it
+        checkpoints = checkpoints_from_headers(''.join(self.headers))
+        b = self.make_blockchain(self.headers)
+        b.set_checkpoints(checkpoints)
+        b.check_headers_file()
+        self.assertEqual(os.path.getsize(b.path()), 4032*80)
+        bad = self.headers[:3000] + make_headers(1, Hash(self.headers[2999]), 3000) + self.headers[3001:]
+        with open(b.path(), 'wb') as f:
+            f.write(''.join(bad))
+        b.check_headers_file()
+        self.assertEqual(os.path.getsize(b.path()), 2016*80)
+
+
+
+class TestChunkDownload(PoWTest):
+
+    def setUp(self):
+        PoWTest.setUp(self)
+        self.headers = make_headers(3*2016 + 5)
+        self.saved_pool = blockchain._pool, blockchain._pool_size
+
+    def tearDown(self):
+        blockchain._pool, blockchain._pool_size = self.saved_pool
+        PoWTest.tearDown(self)
+
+    def download(self, interfaces, local=0):
+        b = self.make_blockchain(self.headers[:local], Network(interfaces))
+        self.assertTrue(b.get_and_verify_chunks(interfaces[0], None, len(self.headers) - 1))
+        self.assertEqual(b.height(), len(self.headers) - 1)
+        with open(b.path(), 'rb') as f:
+            self.assertEqual(f.read(), ''.join(self.headers))
+        return b
+
+    def test_without_pool(self):
+        blockchain._pool, blockchain._pool_size = None, 0
+        self.download([Interface(self.headers)])
+
+    def test_pool(self):
+        pool = Pool()
+        blockchain._pool, blockchain._pool_size = pool, 2
+        self.config['verify_timeout'] = 7
+        self.download([Interface(self.headers)], 2016 + 10)
+        # the chunk that was partly there and the ones above it
+        self.assertEqual(len(pool.jobs), 3)
+        self.assertEqual([job.timeout for job in pool.jobs], [7, 7, 7])
+
+    def test_servers(self):
+        blockchain._pool, blockchain._pool_size = None, 0
+        self.config['chunk_timeout'] = 1
+        interfaces = [Interface(self.headers)]
+        for klass, name in [(BadInterface, 'bad'), (ErrorInterface, 'error'), (DeadInterface, 'dead'), (Interface, 'good')]:
+            i = klass(self.headers)
+            i.server = name
+            interfaces.append(i)
+        self.download(interfaces)
+        # requests are spread over the servers, chunks that failed on one
+        # are served by another
+        self.assertTrue(all(i.requests for i in interfaces))
+
+    def test_lost_job(self):
+        pool = Pool()
+        pool.job = LostJob
+        blockchain._pool, blockchain._pool_size = pool, 2
+        self.download([Interface(self.headers)])
+        self.assertEqual(len(pool.jobs), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
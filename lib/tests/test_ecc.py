@@ -0,0 +1,107 @@
+import hashlib
+import os
+import unittest
+
+from ecdsa import rfc6979
+from ecdsa.curves import SECP256k1
+from ecdsa.ecdsa import generator_secp256k1
+from ecdsa.ellipticcurve import Point, INFINITY
+from ecdsa.keys import SigningKey
+
+from lib import ecc
+
+
+# (secret exponent, message, rfc6979 nonce), from the secp256k1 vectors of python-ecdsa
+RFC6979_VECTORS = [
+    (0x9d0219792467d7d37b4d43298a7d0c05, "sample",
+     0x8fa1f95d514760e498f28957b824ee6ec39ed64826ff4fecc2b5739ec45b91cd),
+    (0xcca9fbcc1b41e5a95d369eaa6ddcff73b61a4efaa279cfc6567e8daa39cbaf50, "sample",
+     0x2df40ca70e639d89528a6b670d9d48d9165fdc0febc0974056bdce192b8e16a3),
+    (0x1, "Satoshi Nakamoto",
+     0x8f8a276c19f4149656b280621e358cce24f5f52542772691ee69063b74f15d15),
+    (0x1, "All those moments will be lost in time, like tears in rain. Time to die...",
+     0x38aa22d72376b4dbc472e06c3ba403ee0a394da63fc58d88686c611aba98d6b3),
+    (0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364140, "Satoshi Nakamoto",
+     0x33a19b60e25fb6f4435af53a3d42d493644827367e6453928554f43e49aa6f90),
+]
+
+
+def rand_scalar():
+    return int(os.urandom(32).encode('hex'), 16) % ecc.N
+
+
+def ecdsa_mul(k, q=None):
+    """ k*q with python-ecdsa, q defaults to the generator """
+    point = generator_secp256k1 if q is None else Point(generator_secp256k1.curve(), q[0], q[1], ecc.N)
+    r = point * k
+    return None if r == INFINITY else (r.x(), r.y())
+
+
+class TestBackends(unittest.TestCase):
+    """ every backend that can be loaded here is compared with python-ecdsa """
+
+    def setUp(self):
+        self.saved = ecc.backend
+
+    def tearDown(self):
+        ecc.backend = self.saved
+
+    def backends(self):
+        for b in ecc.get_backends():
+            ecc.set_backend(b.name)
+            yield b
+
+    def test_generator_mul(self):
+        scalars = [1, 2, 3, ecc.N - 1, ecc.N - 2, 2**128, 2**255 % ecc.N] + [rand_scalar() for i in range(10)]
+        for b in self.backends():
+            for k in scalars:
+                self.assertEqual(b.generator_mul(k), ecdsa_mul(k), (b.name, k))
+
+    def test_mul_add(self):
+        for b in self.backends():
+            for i in range(10):
+                a, k = rand_scalar(), rand_scalar()
+                q = ecdsa_mul(rand_scalar())
+                s = generator_secp256k1 * a + Point(generator_secp256k1.curve(), q[0], q[1], ecc.N) * k
+                self.assertEqual(b.mul_add(a, k, q), (s.x(), s.y()), b.name)
+                self.assertEqual(b.mul_add(0, k, q), ecdsa_mul(k, q), b.name)
+
+    def test_infinity(self):
+        for b in self.backends():
+            self.assertEqual(b.mul_add(5, ecc.N - 5, ecc.G), None, b.name)
+            self.assertEqual(b.mul_add(0, ecc.N - 1, ecc.G), ecc.negate(ecc.G), b.name)
+            self.assertEqual(ecc.mul_add(0, 0, ecc.G), None, b.name)
+
+    def test_rfc6979_vectors(self):
+        for secexp, message, k in RFC6979_VECTORS:
+            digest = hashlib.sha256(message).digest()
+            self.assertEqual(rfc6979.generate_k(generator_secp256k1, secexp, hashlib.sha256, digest), k)
+            key = SigningKey.from_secret_exponent(secexp, curve=SECP256k1)
+            expected = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256, sigencode=lambda r, s, order: (r, s))
+            self.assertEqual(expected[0], ecdsa_mul(k)[0] % ecc.N)
+            q = ecdsa_mul(secexp)
+            for b in self.backends():
+                self.assertEqual(ecc.sign_digest(secexp, digest), expected, b.name)
+                self.assertTrue(ecc.verify_digest(q, digest, *expected), b.name)
+                self.assertFalse(ecc.verify_digest(q, digest, expected[0], expected[1] + 1), b.name)
+
+    def test_random_signatures(self):
+        for i in range(5):
+            secexp = rand_scalar()
+            digest = os.urandom(32)
+            key = SigningKey.from_secret_exponent(secexp, curve=SECP256k1)
+            expected = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256, sigencode=lambda r, s, order: (r, s))
+            for b in self.backends():
+                self.assertEqual(ecc.sign_digest(secexp, digest), expected, b.name)
+                self.assertTrue(key.get_verifying_key().verify_digest(expected, digest, sigdecode=lambda sig, order: sig))
+                self.assertTrue(ecc.verify_digest(ecdsa_mul(secexp), digest, *expected), b.name)
+
+    def test_serialization(self):
+        for i in range(5):
+            q = ecdsa_mul(rand_scalar())
+            for compressed in [True, False]:
+                self.assertEqual(ecc.ser_to_point(ecc.point_to_ser(q, compressed)), q)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import json
+import Queue
+import socket
+import threading
+import time
+import unittest
+
+from lib import interface
+
+
+class Server(threading.Thread):
+    """ a local stratum server that answers each request with its params.
+    subscriptions are also answered with a notification """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.connections = []
+        self.max_outstanding = 0
+
+    def address(self):
+        return '127.0.0.1:%d:t' % self.socket.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                c, addr = self.socket.accept()
+            except socket.error:
+                return
+            self.connections.append(c)
+            t = threading.Thread(target=self.serve, args=(c,))
+            t.daemon = True
+            t.start()
+
+    def serve(self, c):
+        data = ''
+        while True:
+            try:
+                d = c.recv(65536)
+            except socket.error:
+                return
+            if not d:
+                return
+            data += d
+            lines = data.split('\n')
+            data = lines.pop()
+            requests = [json.loads(line) for line in lines]
+            self.max_outstanding = max(self.max_outstanding, len(requests))
+            # answer after a while, so that requests pile up on the client
+            time.sleep(0.01)
+            out = ''
+            for r in requests:
+                out += json.dumps({'id': r['id'], 'result': r['params']}) + '\n'
+                if r['method'].endswith('.subscribe'):
+                    out += json.dumps({'id': None, 'method': r['method'], 'params': r['params'] + ['status']}) + '\n'
+            try:
+                c.sendall(out)
+            except socket.error:
+                return
+
+    def close(self):
+        self.socket.close()
+        for c in self.connections:
+            c.close()
+
+
+class InterfaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        self.server.start()
+        self.interfaces = []
+
+    def tearDown(self):
+        for i in self.interfaces:
+            i.stop()
+        self.server.close()
+
+    def connect(self, config={}, queue=None):
+        i = interface.Interface(self.server.address(), config)
+        i.start(queue, wait=True)
+        self.assertTrue(i.is_connected)
+        self.interfaces.append(i)
+        return i
+
+    def wait(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < end)
+            time.sleep(0.01)
+
+
+class TestPipelining(InterfaceTest):
+
+    def test_window(self):
+        i = self.connect({'max_requests_in_flight': 50})
+        q = Queue.Queue()
+        n = 1000
+        i.send([('blockchain.address.get_history', [str(k)]) for k in range(n)], lambda _, r: q.put(r))
+        i.send([('blockchain.address.subscribe', [str(k)]) for k in range(n)], lambda _, r: q.put(r))
+        responses = [q.get(timeout=10) for k in range(3*n)]
+        self.assertTrue(self.server.max_outstanding <= 50)
+        history = [r['params'][0] for r in responses if r.get('method') == 'blockchain.address.get_history']
+        self.assertEqual(sorted(history), sorted(str(k) for k in range(n)))
+        # each notification goes to the callback of its subscription
+        notifications = [(r['params'][0], r['result']) for r in responses if r.get('id') is None]
+        self.assertEqual(sorted(notifications), sorted((str(k), 'status') for k in range(n)))
+        self.wait(lambda: i.is_up_to_date() and not i.in_flight and not i.send_queue)
+
+    def test_synchronous_get(self):
+        i = self.connect()
+        self.assertEqual(i.synchronous_get([('a.b', [k]) for k in range(3)], 5), [[0], [1], [2]])
+
+
+
+class TestPoller(InterfaceTest):
+
+    def test_interfaces(self):
+        status = Queue.Queue()
+        interfaces = [self.connect({}, status) for k in range(4)]
+        self.assertEqual([status.get(timeout=5) for k in range(4)], interfaces)
+        threads = threading.active_count()
+        results = [i.synchronous_get([('a.b', [k]) for k in range(3)], 5) for i in interfaces]
+        self.assertEqual(results, [[[0], [1], [2]]] * 4)
+        # all served by the poller, without a thread per interface
+        self.assertTrue(threading.active_count() <= threads)
+        self.assertTrue(set(interfaces) <= interface.get_poller().interfaces)
+
+    def test_disconnection(self):
+        status = Queue.Queue()
+        a = self.connect({}, status)
+        b = self.connect({}, status)
+        self.assertEqual(set([status.get(timeout=5), status.get(timeout=5)]), set([a, b]))
+        # closed by the server
+        self.wait(lambda: len(self.server.connections) == 2)
+        c = [c for c in self.server.connections if c.getpeername() == a.s.getsockname()][0]
+        c.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(status.get(timeout=5) is a)
+        self.assertFalse(a.is_connected)
+        self.assertFalse(a in interface.get_poller().interfaces)
+        # stopped by the client
+        b.stop()
+        self.assertTrue(status.get(timeout=5) is b)
+        self.assertFalse(b in interface.get_poller().interfaces)
+
+
+if __name__ == '__main__':
+    unittest.main()
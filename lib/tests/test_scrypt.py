@@ -0,0 +1,49 @@
+import os
+import unittest
+
+from lib import scrypt
+from lib.scrypt import scrypt_1024_1_1_80, scrypt_1024_1_1_80_batch
+
+
+VECTORS = [
+    ("00"*80, "161d0876f3b93b1048cda1bdeaa7332ee210f7131b42013cb43913a6553a4b69"),
+    ("ff"*80, "5253069c14ecedf978745486375ee37415e977f55cdbedac31ebee8bf33dd127"),
+    ("010000000000000000000000000000000000000000000000000000000000000000000000d9ced4ed1130f7b7faad9be25323ffafa33232a17c3edf6cfd97bee6bafbdd97b9aa8e4ef0ff0f1ecd513f7c", "001e67b013726fd7382e9acb69165b4b6316227fb3156b5b414ba6340c050000"),
+    ("01000000ae178934851bfa0e83ccb6a3fc4bfddff3641e104b6c4680c31509074e699be2bd672d8d2199ef37a59678f92443083e3b85edef8b45c71759371f823bab59a97126614f44d5001d45920180", "01796dae1f78a72dfb09356db6f027cd884ba0201e6365b72aa54b3b00000000"),
+    ("020000008f49e5fd7ef50db9a2a1bff5d3e93717a096329a8ac802a248463ef366ceea1099b1fd0db4ce8f4728251711f759081d0b5b4da015fb78421d8ffbfda1105a2abda1db521b64101b00e60cd0", "461ae94540dc88c9bffbf42bb47e46a2416280adbeeb1d883c18090000000000"),
+]
+
+
+class TestScrypt(unittest.TestCase):
+
+    def test_vectors(self):
+        for header, h in VECTORS:
+            self.assertEqual(scrypt_1024_1_1_80(header.decode('hex')), h.decode('hex'))
+
+    def test_bad_header(self):
+        self.assertRaises(ValueError, scrypt_1024_1_1_80, '\0'*79)
+        self.assertRaises(ValueError, scrypt_1024_1_1_80_batch, ['\0'*81] * scrypt.MIN_LANES)
+
+    def test_small_batch(self):
+        headers = [header.decode('hex') for header, h in VECTORS]
+        self.assertEqual(scrypt_1024_1_1_80_batch(headers), [h.decode('hex') for header, h in VECTORS])
+        self.assertEqual(scrypt_1024_1_1_80_batch([]), [])
+
+    @unittest.skipIf(scrypt.numpy is None, "numpy is not available")
+    def test_lanes(self):
+        # the lock-step engine is bit-exact with the reference implementation
+        headers = [header.decode('hex') for header, h in VECTORS] + [os.urandom(80) for i in range(3)]
+        self.assertEqual(scrypt._scrypt_1024_1_1_80_lanes(headers), map(scrypt_1024_1_1_80, headers))
+
+    @unittest.skipIf(scrypt.numpy is None, "numpy is not available")
+    def test_large_batch(self):
+        # one group in lock-step, the remainder one by one
+        headers = [os.urandom(80) for i in range(scrypt.MIN_LANES + 2)]
+        hashes = scrypt_1024_1_1_80_batch(headers, lanes=scrypt.MIN_LANES)
+        self.assertEqual(hashes[:4], map(scrypt_1024_1_1_80, headers[:4]))
+        self.assertEqual(hashes[-2:], map(scrypt_1024_1_1_80, headers[-2:]))
+        self.assertEqual(len(hashes), len(headers))
+
+
+if __name__ == '__main__':
+    unittest.main()
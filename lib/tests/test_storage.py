@@ -0,0 +1,271 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from lib import wallet
+from lib.wallet import WalletStorage, SqliteWalletStorage
+
+
+# values of the kinds a wallet stores, json alone would not keep them
+VALUES = {
+    'seed_version': 4,
+    'use_encryption': False,
+    'labels': {'a': u'caf\xe9', 'b': 'x'},
+    'tx_index': {'h1': (((None, None, '(pubkey)', True),), (('addr', 5),))},
+    'addr_history': {'addr': [('h1', 10)], 'other': ['*']},
+    'next_addresses': {0: ['addr'], '1': []},
+    'transactions': {'h1': '0100', 'h2': '0200'},
+}
+
+
+class StorageTest(unittest.TestCase):
+
+    engine = 'file'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'wallet')
+        self.storages = []
+
+    def tearDown(self):
+        for s in self.storages:
+            s.close()
+        shutil.rmtree(self.dir)
+
+    def open_storage(self, path=None, engine=None):
+        s = WalletStorage({'wallet_path': path or self.path, 'wallet_storage': engine or self.engine})
+        self.storages.append(s)
+        return s
+
+    def reopen(self, s):
+        s.close()
+        return self.open_storage()
+
+    def fill(self, s):
+        for key, value in VALUES.items():
+            s.put(key, value)
+        return s
+
+
+class TestFileStorage(StorageTest):
+
+    def journal(self):
+        path = self.path + '.journal'
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.readlines()
+
+    def snapshot(self):
+        s = self.fill(self.open_storage())
+        s.write()
+        return s
+
+    def test_values(self):
+        for value in VALUES.values() + [{1: (2, [3, (u'4',)])}, ((), {}), [u'caf\xe9']]:
+            self.assertEqual(wallet.load_value(wallet.dump_value(value)), value)
+
+    def test_round_trip(self):
+        s = self.reopen(self.fill(self.open_storage()))
+        for key, value in VALUES.items():
+            self.assertEqual(s.get(key), value)
+        self.assertEqual(set(s.keys()), set(VALUES.keys()))
+
+    def test_journal(self):
+        s = self.snapshot()
+        self.assertEqual(self.journal(), [])
+        s.put('labels', dict(VALUES['labels'], c='z'))
+        s.put('next_addresses', {0: ['addr']})
+        s.put('use_encryption', None)
+        # only the changed items are appended
+        self.assertEqual(len(self.journal()), 3)
+        s = self.reopen(s)
+        self.assertEqual(s.get('labels'), dict(VALUES['labels'], c='z'))
+        self.assertEqual(s.get('next_addresses'), {0: ['addr']})
+        self.assertEqual(s.get('use_encryption'), None)
+        s.put('labels', VALUES['labels'])
+        self.assertEqual(len(self.journal()), 4)
+
+    def test_truncated_journal(self):
+        s = self.snapshot()
+        s.put('seed_version', 5)
+        s.put('labels', {'a': 'y'})
+        s.close()
+        lines = self.journal()
+        with open(self.path + '.journal', 'w') as f:
+            f.write(lines[0] + lines[1][:-5])
+        s = self.open_storage()
+        # the complete lines are kept and a clean snapshot is written
+        self.assertEqual(s.get('seed_version'), 5)
+        self.assertEqual(s.get('labels'), VALUES['labels'])
+        self.assertEqual(self.journal(), [])
+        self.assertEqual(self.reopen(s).get('seed_version'), 5)
+
+    def test_snapshot(self):
+        s = self.snapshot()
+        for i in range(2000):
+            s.put('labels', dict(VALUES['labels'], n=str(i) * 40))
+        # the journal was folded into the wallet file on the way
+        self.assertTrue(len(''.join(self.journal())) <= max(os.path.getsize(self.path), 1 << 16))
+        s = self.reopen(s)
+        self.assertEqual(s.get('labels'), dict(VALUES['labels'], n='1999' * 40))
+        s.write()
+        self.assertEqual(self.journal(), [])
+        self.assertEqual(self.reopen(s).get('tx_index'), VALUES['tx_index'])
+
+    def test_literal_file(self):
+        with open(self.path, 'w') as f:
+            f.write(repr({'seed_version': 4, 'next_addresses': {0: ['addr']}}))
+        s = self.open_storage()
+        self.assertEqual(s.get('next_addresses'), {0: ['addr']})
+        s.put('seed_version', 5)
+        s = self.reopen(s)
+        self.assertEqual(s.get('seed_version'), 5)
+
+    def test_copy_to(self):
+        s = self.fill(self.open_storage())
+        s.put('labels', {'a': 'y'})
+        path = os.path.join(self.dir, 'copy')
+        s.copy_to(path, {'seed_version': 5, 'use_encryption': None})
+        c = self.open_storage(path)
+        self.assertEqual(c.get('seed_version'), 5)
+        self.assertEqual(c.get('use_encryption'), None)
+        self.assertEqual(c.get('labels'), {'a': 'y'})
+        self.assertEqual(self.reopen(s).get('seed_version'), 4)
+
+
+class TestSqliteStorage(StorageTest):
+
+    engine = 'sqlite'
+
+    def test_engine(self):
+        self.assertTrue(isinstance(self.fill(self.open_storage()), SqliteWalletStorage))
+        self.assertTrue(wallet.is_sqlite_file(self.path))
+
+    def test_round_trip(self):
+        s = self.reopen(self.fill(self.open_storage()))
+        for key, value in VALUES.items():
+            self.assertEqual(s.get(key), value)
+        self.assertEqual(set(s.keys()), set(VALUES.keys()))
+
+    def test_changes_are_saved(self):
+        s = self.fill(self.open_storage())
+        s.put('labels', {'a': 'y'})
+        s.put('use_encryption', None)
+        s = self.reopen(s)
+        self.assertEqual(s.get('labels'), {'a': 'y'})
+        self.assertEqual(s.get('use_encryption'), None)
+
+    def test_items(self):
+        s = self.reopen(self.fill(self.open_storage()))
+        # transactions are not loaded by get_item and put_item
+        self.assertEqual(s.get_item('transactions', 'h1'), '0100')
+        s.put_item('transactions', 'h3', '0300')
+        s.put_item('transactions', 'h1', None)
+        self.assertFalse('transactions' in s.loaded)
+        self.assertEqual(sorted(s.get_subkeys('transactions')), ['h2', 'h3'])
+        s.flush()
+        s = self.reopen(s)
+        self.assertEqual(s.get('transactions'), {'h2': '0200', 'h3': '0300'})
+
+    def test_deferred(self):
+        s = self.fill(self.open_storage())
+        s.put_deferred('labels', {'c': 'z'})
+        s.flush()
+        self.assertEqual(self.reopen(s).get('labels'), {'c': 'z'})
+
+    def test_get_during_load(self):
+        self.reopen(self.fill(self.open_storage())).close()
+        s = self.open_storage()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(s.get('labels')))
+        load_rows = s.load_rows
+        def slow_load_rows(key):
+            # another thread asks for the key while it is being loaded
+            if key == 'labels' and not reader.is_alive() and not result:
+                reader.start()
+                time.sleep(0.2)
+            load_rows(key)
+        s.load_rows = slow_load_rows
+        self.assertEqual(s.get('labels'), VALUES['labels'])
+        reader.join()
+        self.assertEqual(result, [VALUES['labels']])
+
+    def test_copy_to(self):
+        s = self.fill(self.open_storage())
+        s.put_item('transactions', 'h3', '0300')
+        path = os.path.join(self.dir, 'copy')
+        s.copy_to(path, {'seed_version': 5, 'labels': None})
+        c = self.open_storage(path)
+        self.assertEqual(c.get('seed_version'), 5)
+        self.assertEqual(c.get('labels'), None)
+        self.assertEqual(c.get('transactions'), dict(VALUES['transactions'], h3='0300'))
+        self.assertEqual(s.get('seed_version'), 4)
+
+    def test_conversion(self):
+        self.fill(self.open_storage(engine='file')).close()
+        s = self.open_storage()
+        self.assertTrue(isinstance(s, SqliteWalletStorage))
+        for key, value in VALUES.items():
+            self.assertEqual(s.get(key), value)
+        s.close()
+        s = self.open_storage(engine='file')
+        self.assertFalse(isinstance(s, SqliteWalletStorage))
+        for key, value in VALUES.items():
+            self.assertEqual(s.get(key), value)
+
+
+
+class TestDeferredWrites(StorageTest):
+    """ put_deferred and put_item are written by the flush timer, by
+    flush() or by the next put(), in both engines """
+
+    def open_deferred(self, engine, delay=60):
+        s = WalletStorage({'wallet_path': self.path + engine, 'wallet_storage': engine, 'wallet_flush_delay': delay})
+        self.storages.append(s)
+        s.put('seed_version', 4)
+        return s
+
+    def on_disk(self, s, key):
+        engine = 'sqlite' if isinstance(s, SqliteWalletStorage) else 'file'
+        return self.open_storage(s.path, engine).get(key)
+
+    def test_flush(self):
+        for engine in ['file', 'sqlite']:
+            s = self.open_deferred(engine)
+            s.put_deferred('labels', {'a': 'x'})
+            s.put_item('transactions', 'h1', '0100')
+            self.assertEqual(self.on_disk(s, 'labels'), None)
+            self.assertEqual(s.get('labels'), {'a': 'x'})
+            s.flush()
+            self.assertEqual(s.flush_timer, None)
+            self.assertEqual(self.on_disk(s, 'labels'), {'a': 'x'})
+            self.assertEqual(self.on_disk(s, 'transactions'), {'h1': '0100'})
+
+    def test_put(self):
+        for engine in ['file', 'sqlite']:
+            s = self.open_deferred(engine)
+            s.put_deferred('labels', {'a': 'x'})
+            s.put('use_encryption', False)
+            self.assertEqual(self.on_disk(s, 'labels'), {'a': 'x'})
+            self.assertEqual(self.on_disk(s, 'use_encryption'), False)
+
+    def test_timer(self):
+        for engine in ['file', 'sqlite']:
+            s = self.open_deferred(engine, 0.1)
+            s.put_deferred('labels', {'a': 'x'})
+            timer = s.flush_timer
+            s.put_deferred('addr_history', {'addr': []})
+            # one timer for all the pending changes
+            self.assertTrue(s.flush_timer is timer)
+            timer.join()
+            self.assertEqual(s.flush_timer, None)
+            self.assertEqual(self.on_disk(s, 'labels'), {'a': 'x'})
+            self.assertEqual(self.on_disk(s, 'addr_history'), {'addr': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import json
+import os
+import random
+import unittest
+
+from lib.util import LineBuffer
+
+
+class TestLineBuffer(unittest.TestCase):
+
+    def test_split(self):
+        lb = LineBuffer()
+        self.assertEqual(lb.feed(''), [])
+        self.assertEqual(lb.feed('a\n\nb'), ['a', ''])
+        self.assertEqual(lb.feed('c'), [])
+        self.assertEqual(lb.feed('d\ne\n'), ['bcd', 'e'])
+        self.assertEqual(lb.chunks, [])
+
+    def test_reads(self):
+        # the same lines whatever the size of the reads
+        messages = [json.dumps({'id': k, 'result': os.urandom(random.choice([10, 1000, 2016*80])).encode('hex')}) for k in range(20)]
+        stream = ''.join(m + '\n' for m in messages)
+        for size in [1, 7, 1024, 65536, len(stream)]:
+            lb = LineBuffer()
+            lines = []
+            for i in range(0, len(stream), size):
+                lines += lb.feed(stream[i:i+size])
+            self.assertEqual(lines, messages, size)
+            self.assertEqual(lb.chunks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
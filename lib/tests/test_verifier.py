@@ -0,0 +1,133 @@
+import threading
+import time
+import unittest
+
+from lib import daemon
+from lib.bitcoin import Hash, hash_encode, hash_decode
+from lib.verifier import TxVerifier
+
+
+class Storage(object):
+
+    def get(self, key, default=None):
+        return default
+
+    def put_deferred(self, key, value):
+        pass
+
+
+class Blockchain(object):
+    height = 100
+
+
+class Network(object):
+    """ blocks of two transactions, the ones we ask about are first """
+
+    def __init__(self):
+        self.blockchain = Blockchain()
+        self.callbacks = {}
+        self.batches = []
+        self.headers = {}
+
+    def add_block(self, height, tx_hash):
+        sibling = hash_encode(Hash(tx_hash))
+        self.headers[height] = {'merkle_root': hash_encode(Hash(hash_decode(tx_hash) + hash_decode(sibling))), 'timestamp': height}
+        return sibling
+
+    def register_callback(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def trigger_callback(self, event):
+        for callback in self.callbacks.get(event, []):
+            callback()
+
+    def get_local_height(self):
+        return self.blockchain.height
+
+    def get_header(self, height):
+        return self.headers.get(height)
+
+    def send(self, messages, callback):
+        self.batches.append(len(messages))
+        for method, (tx_hash, height) in messages:
+            result = {'block_height': height, 'pos': 0, 'merkle': [hash_encode(Hash(tx_hash))]}
+            callback(None, {'method': method, 'params': [tx_hash, height], 'result': result})
+        return True
+
+
+class VerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.network = Network()
+        self.txs = {}
+        for k in range(200):
+            tx_hash = hash_encode(Hash(str(k)))
+            self.network.add_block(50 + k, tx_hash)
+            self.txs[tx_hash] = 50 + k
+        self.verifiers = []
+
+    def tearDown(self):
+        for v in self.verifiers:
+            v.stop()
+            v.join()
+
+    def start_verifier(self, network):
+        v = TxVerifier(network, Storage())
+        for tx_hash, height in self.txs.items():
+            v.add(tx_hash, height)
+        self.verifiers.append(v)
+        return v
+
+    def wait(self, condition, timeout=5):
+        end = time.time() + timeout
+        while not condition():
+            self.assertTrue(time.time() < end)
+            time.sleep(0.01)
+
+
+class TestVerifier(VerifierTest):
+
+    def test_height_events(self):
+        v = self.start_verifier(self.network)
+        v.poll_interval = 60
+        v.start()
+        # one batch for the transactions below the local height
+        self.wait(lambda: len(v.verified_tx) == 51)
+        self.assertEqual(self.network.batches, [51])
+        self.network.blockchain.height = 1000
+        self.network.trigger_callback('blockchain_height')
+        self.wait(lambda: len(v.verified_tx) == 200)
+        self.assertEqual(self.network.batches, [51, 149])
+        self.assertEqual(v.pending, [])
+        self.assertEqual(v.requested, set())
+        for tx_hash, height in self.txs.items():
+            self.assertEqual(v.get_txpos(tx_hash), (height, 0))
+
+    def test_undo(self):
+        self.network.blockchain.height = 1000
+        v = self.start_verifier(self.network)
+        v.start()
+        self.wait(lambda: len(v.verified_tx) == 200)
+        updates = v.updates
+        v.undo_verifications(240)
+        self.wait(lambda: len(v.verified_tx) == 200)
+        self.assertEqual(self.network.batches, [200, 10])
+        self.assertTrue(v.updates > updates)
+
+    def test_daemon_proxy(self):
+        # the daemon does not forward height events, the verifier polls
+        proxy = daemon.NetworkProxy.__new__(daemon.NetworkProxy)
+        proxy.lock = threading.Lock()
+        proxy.callbacks = {}
+        self.network.register_callback = proxy.register_callback
+        self.network.trigger_callback = lambda event: None
+        v = self.start_verifier(self.network)
+        v.poll_interval = 0.1
+        v.start()
+        self.wait(lambda: len(v.verified_tx) == 51)
+        self.network.blockchain.height = 1000
+        self.wait(lambda: len(v.verified_tx) == 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,345 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib import wallet
+from lib.transaction import Transaction
+from lib.bitcoin import Hash, hash_encode, bc_address_to_hash_160, SecretToASecret
+
+
+def push(h):
+    return '%02x' % (len(h)/2) + h
+
+def p2pkh(addr):
+    return '76a914' + bc_address_to_hash_160(addr)[1].encode('hex') + '88ac'
+
+def make_tx(inputs, outputs):
+    """ raw transaction and hash from (prevout_hash, prevout_n, script) and (script, value) """
+    s = '01000000' + '%02x' % len(inputs)
+    for prevout_hash, prevout_n, script in inputs:
+        s += prevout_hash.decode('hex')[::-1].encode('hex') + struct.pack('<I', prevout_n).encode('hex')
+        s += '%02x' % (len(script)/2) + script + 'ffffffff'
+    s += '%02x' % len(outputs)
+    for script, value in outputs:
+        s += struct.pack('<q', value).encode('hex') + '%02x' % (len(script)/2) + script
+    s += '00000000'
+    return s, hash_encode(Hash(s.decode('hex')))
+
+
+class Network(object):
+    pending_transactions_for_notifications = []
+
+
+class TestWalletOpen(unittest.TestCase):
+
+    engine = 'file'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {'wallet_path': os.path.join(self.dir, 'wallet'), 'wallet_storage': self.engine}
+        w = wallet.OldWallet(wallet.WalletStorage(self.config))
+        w.add_seed("0123456789abcdef0123456789abcdef", None)
+        w.create_master_keys(None)
+        w.create_accounts(None)
+        w.synchronize()
+        w.network = Network()
+        a = w.addresses(True)
+        pubkey = dict((addr, w.get_public_keys(addr)[0]) for addr in a)
+        sig = '30'*70 + '01'
+        # the second output of tx1 and the second input of tx2 are pay-to-pubkey
+        raw1, self.h1 = make_tx([('11'*32, 0, push(sig) + push(pubkey[a[3]]))],
+                                [(p2pkh(a[0]), 5*10**8), (push(pubkey[a[1]]) + 'ac', 3*10**8)])
+        raw2, self.h2 = make_tx([(self.h1, 0, push(sig) + push(pubkey[a[0]])), (self.h1, 1, push(sig))],
+                                [(p2pkh(a[2]), 2*10**8), (p2pkh(a[3]), 10**8)])
+        history = {a[0]: [(self.h1, 10), (self.h2, 0)], a[1]: [(self.h1, 10), (self.h2, 0)],
+                   a[2]: [(self.h2, 0)], a[3]: [(self.h1, 10), (self.h2, 0)]}
+        for addr, hist in history.items():
+            w.receive_history_callback(addr, hist)
+        # tx2 is dropped until the address of its pay-to-pubkey input is known
+        w.receive_tx_callback(self.h2, Transaction(raw2), 0)
+        w.receive_tx_callback(self.h1, Transaction(raw1), 10)
+        w.receive_tx_callback(self.h2, Transaction(raw2), 0)
+        self.addresses = a
+        self.balances = dict((addr, w.get_addr_balance(addr)) for addr in a)
+        self.close_wallet(w)
+
+        self.decoded = 0
+        self.deserialize = Transaction.deserialize
+        def deserialize(tx):
+            self.decoded += 1
+            return self.deserialize(tx)
+        Transaction.deserialize = deserialize
+        self.wallets = []
+
+    def tearDown(self):
+        Transaction.deserialize = self.deserialize
+        for w in self.wallets:
+            self.close_wallet(w)
+        shutil.rmtree(self.dir)
+
+    def open_wallet(self):
+        self.decoded = 0
+        w = wallet.OldWallet(wallet.WalletStorage(self.config))
+        w.network = Network()
+        self.wallets.append(w)
+        return w
+
+    def close_wallet(self, w):
+        w.storage.close()
+
+    def test_open_does_not_decode(self):
+        w = self.open_wallet()
+        self.assertEqual(self.decoded, 0)
+        self.assertEqual(dict((addr, w.get_addr_balance(addr)) for addr in self.addresses), self.balances)
+        self.assertEqual(w.transactions[self.h2].inputs[1]['address'], self.addresses[1])
+
+    def test_legacy_wallet_is_indexed_once(self):
+        # wallets written before tx_index existed
+        storage = wallet.WalletStorage(self.config)
+        storage.put('tx_index', None)
+        storage.close()
+
+        w = self.open_wallet()
+        self.assertEqual(self.decoded, 2)
+        self.close_wallet(w)
+
+        w = self.open_wallet()
+        self.assertEqual(self.decoded, 0)
+        self.assertEqual(dict((addr, w.get_addr_balance(addr)) for addr in self.addresses), self.balances)
+        self.assertEqual(w.transactions[self.h2].inputs[1]['address'], self.addresses[1])
+
+    def test_removal_is_saved(self):
+        w = self.open_wallet()
+        w.remove_transaction(self.h2)
+        self.close_wallet(w)
+        w = self.open_wallet()
+        self.assertFalse(self.h2 in w.transactions)
+        self.assertFalse(self.h2 in w.tx_index)
+        self.assertEqual(self.decoded, 0)
+
+    def test_tx_addresses(self):
+        def scan(w):
+            # what check_new_tx used to compute from all the histories
+            d = {}
+            for addr, hist in w.history.items():
+                if hist == ['*']: continue
+                for tx_hash, height in hist:
+                    d.setdefault(tx_hash, set()).add(addr)
+            return d
+        w = self.open_wallet()
+        a = self.addresses
+        self.assertEqual(w.tx_addresses, scan(w))
+        self.assertEqual(w.tx_addresses[self.h1], set([a[0], a[1], a[3]]))
+        w.receive_history_callback(a[2], [])
+        self.assertEqual(w.tx_addresses, scan(w))
+        self.assertTrue(self.h2 in w.tx_addresses)
+        w.receive_history_callback(a[2], [(self.h2, 0)])
+        self.assertEqual(w.tx_addresses, scan(w))
+        self.assertTrue(w.check_new_tx(self.h2))
+        self.assertTrue(w.check_new_history(a[1], [(self.h1, 10)]))
+        self.assertFalse(w.check_new_history(a[2], [(self.h1, 10)]))
+
+    def test_history_cache(self):
+        class Verifier(object):
+            updates = 0
+            positions = {self.h1: (10, 0), self.h2: (1e12, 0)}
+            def get_txpos(self, tx_hash):
+                return self.positions[tx_hash]
+            def get_confirmations(self, tx_hash):
+                return (1, 0) if self.positions[tx_hash][0] < 1e12 else (0, 0)
+        def uncached(w, account):
+            # the history computed from the decoded transactions, without the cache
+            history = sorted(w.transactions.items(), key=lambda x: w.verifier.get_txpos(x[0]))
+            values = [(tx_hash, w.get_tx_value(tx, account)) for tx_hash, tx in history]
+            c, u = w.get_account_balance(account)
+            balance = c + u - sum(v[2] for tx_hash, v in values if v[2] is not None)
+            result = [('', 1000, 0, balance, None, balance, None)] if balance else []
+            for tx_hash, (is_relevant, is_mine, value, fee) in values:
+                if not is_relevant: continue
+                if value is not None: balance += value
+                conf, timestamp = w.verifier.get_confirmations(tx_hash)
+                result.append((tx_hash, conf, is_mine, value, fee, balance, timestamp))
+            return result
+        w = self.open_wallet()
+        w.verifier = Verifier()
+        accounts = [None] + w.accounts.keys()
+        for account in accounts:
+            self.assertEqual(w.get_tx_history(account), uncached(w, account))
+            self.assertTrue(w.get_tx_history_items(account)[1] is w.get_tx_history_items(account)[1])
+        # both transactions are now in the same block, in the other order
+        w.verifier.positions = {self.h1: (12, 1), self.h2: (12, 0)}
+        w.verifier.updates += 1
+        for account in accounts:
+            self.assertEqual(w.get_tx_history(account), uncached(w, account))
+        w.remove_transaction(self.h2)
+        for account in accounts:
+            self.assertEqual(w.get_tx_history(account), uncached(w, account))
+
+
+class TestSqliteWalletOpen(TestWalletOpen):
+
+    engine = 'sqlite'
+
+
+
+class WalletTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storages = []
+
+    def tearDown(self):
+        for s in self.storages:
+            s.close()
+        shutil.rmtree(self.dir)
+
+    def storage(self, name='wallet'):
+        s = wallet.WalletStorage({'wallet_path': os.path.join(self.dir, name)})
+        self.storages.append(s)
+        return s
+
+    def make_wallet(self, klass=wallet.OldWallet, seed="0123456789abcdef0123456789abcdef"):
+        w = klass(self.storage())
+        w.add_seed(seed, None)
+        w.create_master_keys(None)
+        w.create_accounts(None)
+        w.synchronize()
+        w.network = Network()
+        return w
+
+    def reopen(self, w, klass=wallet.OldWallet):
+        w.storage.close()
+        w = klass(self.storage())
+        w.network = Network()
+        return w
+
+
+class TestAddressIndex(WalletTest):
+
+    def check_index(self, w):
+        addresses = w.addresses(True)
+        self.assertEqual(set(w.address_index.keys()), set(addresses))
+        for addr in addresses:
+            self.assertTrue(w.is_mine(addr))
+            account_id, (for_change, n) = w.get_address_index(addr)
+            if account_id in w.accounts:
+                self.assertEqual(w.accounts[account_id].get_addresses(for_change)[n], addr)
+            else:
+                self.assertEqual(w.next_addresses[account_id], addr)
+
+    def test_deterministic(self):
+        w = self.make_wallet()
+        self.check_index(w)
+        self.assertFalse(w.is_mine('1BitcoinEaterAddressDontSendf59kuE'))
+        account_id = w.accounts.keys()[0]
+        w.create_new_address(account_id, 0)
+        w.create_new_addresses(account_id, 1, 3)
+        self.check_index(w)
+        w.save_accounts()
+        self.assertEqual(self.reopen(w).address_index, w.address_index)
+
+    def test_imported(self):
+        w = wallet.Imported_Wallet(self.storage())
+        addresses = [w.import_key(SecretToASecret(os.urandom(32), True), None) for i in range(3)]
+        self.check_index(w)
+        w.delete_imported_key(addresses[1])
+        self.assertFalse(w.is_mine(addresses[1]))
+        self.check_index(w)
+        self.assertRaises(Exception, w.get_address_index, addresses[1])
+
+
+class TestGapLimit(WalletTest):
+
+    def test_synchronize(self):
+        class Network(object):
+            def get_local_height(self):
+                return 1000
+        w = self.make_wallet()
+        w.network = Network()
+        a = w.accounts.values()[0]
+        self.assertEqual(w.synchronize(), [])
+        w.history[a.addresses[2]] = [('aa'*32, 10)]
+        # too recent to count as used
+        w.history[a.change[0]] = [('bb'*32, 999)]
+        n, m = len(a.addresses), len(a.change)
+        new = w.synchronize()
+        self.assertEqual(len(a.addresses), 3 + w.gap_limit)
+        self.assertEqual(len(a.change), m)
+        self.assertEqual(set(new), set(a.addresses[n:]))
+        for addr in new:
+            self.assertEqual(w.history[addr], [])
+        self.assertEqual(w.synchronize(), [])
+        w.gap_limit = 50
+        w.synchronize()
+        self.assertEqual(len(a.addresses), 3 + 50)
+        for i, addr in enumerate(a.addresses):
+            self.assertEqual(addr, a.get_address(0, i))
+            self.assertEqual(w.get_address_index(addr)[1], (0, i))
+
+
+class TestBalances(WalletTest):
+    """ balances and unspent outputs are kept up to date as transactions
+    arrive, they must match a computation from scratch """
+
+    def setUp(self):
+        WalletTest.setUp(self)
+        self.w = self.make_wallet()
+        self.mine = self.w.addresses(True)
+        self.pubkeys = dict((addr, self.w.get_public_keys(addr)[0]) for addr in self.mine)
+        self.txs = []         # (tx_hash, height, inputs, outputs) with (address, value) outputs
+        self.history = dict((addr, []) for addr in self.mine)
+
+    def add_tx(self, spend, outputs, height):
+        """ a transaction spending the outputs in spend, with an external input if spend is empty """
+        sig = '30'*70 + '01'
+        ins = [(h, n, push(sig) + push(self.pubkeys[addr])) for h, n, addr in spend] or [(os.urandom(32).encode('hex'), 0, push(sig))]
+        raw, tx_hash = make_tx(ins, [(p2pkh(addr), value) for addr, value in outputs])
+        self.txs.append((tx_hash, height, spend, outputs))
+        for addr in set([a for h, n, a in spend] + [a for a, v in outputs]):
+            if addr in self.history:
+                self.history[addr] = self.history[addr] + [(tx_hash, height)]
+                self.w.receive_history_callback(addr, self.history[addr])
+        self.w.receive_tx_callback(tx_hash, Transaction(raw), height)
+        return tx_hash
+
+    def expected(self):
+        """ balances and unspent outputs computed from the list of transactions """
+        spent = set((h, n) for tx_hash, height, spend, outputs in self.txs for h, n, addr in spend)
+        values = dict(((tx_hash, n), (addr, value)) for tx_hash, height, spend, outputs in self.txs for n, (addr, value) in enumerate(outputs))
+        balances = dict((addr, [0, 0]) for addr in self.mine)
+        for tx_hash, height, spend, outputs in self.txs:
+            for addr in balances:
+                v = sum(value for a, value in outputs if a == addr) - sum(values[(h, n)][1] for h, n, a in spend if a == addr)
+                balances[addr][0 if height > 0 else 1] += v
+        coins = set((tx_hash, n) for (tx_hash, n), (addr, value) in values.items() if addr in balances and (tx_hash, n) not in spent)
+        return dict((addr, tuple(b)) for addr, b in balances.items()), coins
+
+    def check(self, w):
+        balances, coins = self.expected()
+        self.assertEqual(dict((addr, w.get_addr_balance(addr)) for addr in self.mine), balances)
+        self.assertEqual(set((c['prevout_hash'], c['prevout_n']) for c in w.get_unspent_coins()), coins)
+        total = [sum(b[0] for b in balances.values()), sum(b[1] for b in balances.values())]
+        self.assertEqual(w.get_balance(), tuple(total))
+        self.assertEqual(w.get_balance(self.mine), tuple(total))
+        for account_id in w.accounts:
+            self.assertEqual(w.get_account_balance(account_id), w.get_balance(w.get_account_addresses(account_id)))
+
+    def test_random(self):
+        rnd = random.Random(1)
+        unspent = []
+        for step in range(40):
+            spend = [unspent.pop(rnd.randrange(len(unspent))) for i in range(min(len(unspent), rnd.randint(0, 2)))]
+            outputs = [(rnd.choice(self.mine + ['1BitcoinEaterAddressDontSendf59kuE']), rnd.randint(1, 10**8)) for i in range(rnd.randint(1, 3))]
+            tx_hash = self.add_tx(spend, outputs, rnd.choice([0, step + 1]))
+            unspent += [(tx_hash, n, addr) for n, (addr, value) in enumerate(outputs) if addr in self.history]
+            if step % 10 == 9:
+                self.check(self.w)
+        self.w.storage.flush()
+        self.check(self.reopen(self.w))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -376,15 +376,75 @@ def get_address_from_output_script(bytes):
     return False, "(None)"
 
 
+def get_index_value(inputs, outputs, addresses, prevout_values):
+    """ balance of a transaction for addresses, from its inputs as
+    (prevout_hash, prevout_n, address, ...) and its outputs as (address, value) """
+    is_relevant = False
+    is_send = False
+    is_pruned = False
+    is_partial = False
+    v_in = v_out = v_out_mine = 0
+
+    for item in inputs:
+        addr = item[2]
+        if addr in addresses:
+            is_send = True
+            is_relevant = True
+            key = item[0]  + ':%d'%item[1]
+            value = prevout_values.get( key )
+            if value is None:
+                is_pruned = True
+            else:
+                v_in += value
+        else:
+            is_partial = True
+
+    if not is_send: is_partial = False
+                
+    for item in outputs:
+        addr, value = item
+        v_out += value
+        if addr in addresses:
+            v_out_mine += value
+            is_relevant = True
+
+    if is_pruned:
+        # some inputs are mine:
+        fee = None
+        if is_send:
+            v = v_out_mine - v_out
+        else:
+            # no input is mine
+            v = v_out_mine
+
+    else:
+        v = v_out_mine - v_in
+
+        if is_partial:
+            # some inputs are mine, but not all
+            fee = None
+            is_send = v < 0
+        else:
+            # all inputs are mine
+            fee = v_out - v_in
+
+    return is_relevant, is_send, v, fee
+
+
 class Transaction:
     
-    def __init__(self, raw):
+    def __init__(self, raw, decode=True):
         self.raw = raw
-        self.deserialize()
-        self.inputs = self.d['inputs']
-        self.outputs = self.d['outputs']
-        self.outputs = map(lambda x: (x['address'],x['value']), self.outputs)
-        self.locktime = self.d['lockTime']
+        self.input_addresses = {}   # addresses found for pay-to-pubkey inputs
+        if decode:
+            self.deserialize()
+
+    def __getattr__(self, name):
+        # transactions created with decode=False are decoded when first looked into
+        if name in ['d', 'inputs', 'outputs', 'locktime']:
+            self.deserialize()
+            return self.__dict__[name]
+        raise AttributeError(name)
 
     def __str__(self):
         return self.raw
@@ -579,12 +639,9 @@ class Transaction:
                 if pubkey in keypairs.keys():
                     # add signature
                     sec = keypairs[pubkey]
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+                    secexp = string_to_number( ASecretToSecret(sec)[0:32] )
+                    r, s = ecc.sign_digest( secexp, for_sig )
+                    sig = ecdsa.util.sigencode_der( r, s, ecc.N )
                     self.add_signature(i, pubkey, sig.encode('hex'))
 
 
@@ -608,7 +665,12 @@ class Transaction:
         for i in xrange(n_vout):
             d['outputs'].append(self.parse_output(vds, i))
         d['lockTime'] = vds.read_uint32()
+        for i, address in self.input_addresses.items():
+            d['inputs'][i]['address'] = address
         self.d = d
+        self.__dict__.setdefault('inputs', d['inputs'])
+        self.__dict__.setdefault('outputs', map(lambda x: (x['address'],x['value']), d['outputs']))
+        self.locktime = d['lockTime']
         return self.d
     
 
@@ -651,13 +713,18 @@ class Transaction:
 
 
     def add_extra_addresses(self, txlist):
-        for i in self.inputs:
+        for n, i in enumerate(self.inputs):
             if i.get("address") == "(pubkey)":
                 prev_tx = txlist.get(i.get('prevout_hash'))
                 if prev_tx:
                     address, value = prev_tx.outputs[i.get('prevout_n')]
                     print_error("found pay-to-pubkey address:", address)
-                    i["address"] = address
+                    self.set_input_address(n, address)
+
+    def set_input_address(self, n, address):
+        self.input_addresses[n] = address
+        if 'inputs' in self.__dict__:
+            self.inputs[n]['address'] = address
 
 
     def has_address(self, addr):
@@ -675,56 +742,8 @@ class Transaction:
 
     def get_value(self, addresses, prevout_values):
         # return the balance for that tx
-        is_relevant = False
-        is_send = False
-        is_pruned = False
-        is_partial = False
-        v_in = v_out = v_out_mine = 0
-
-        for item in self.inputs:
-            addr = item.get('address')
-            if addr in addresses:
-                is_send = True
-                is_relevant = True
-                key = item['prevout_hash']  + ':%d'%item['prevout_n']
-                value = prevout_values.get( key )
-                if value is None:
-                    is_pruned = True
-                else:
-                    v_in += value
-            else:
-                is_partial = True
-
-        if not is_send: is_partial = False
-                    
-        for item in self.outputs:
-            addr, value = item
-            v_out += value
-            if addr in addresses:
-                v_out_mine += value
-                is_relevant = True
-
-        if is_pruned:
-            # some inputs are mine:
-            fee = None
-            if is_send:
-                v = v_out_mine - v_out
-            else:
-                # no input is mine
-                v = v_out_mine
-
-        else:
-            v = v_out_mine - v_in
-
-            if is_partial:
-                # some inputs are mine, but not all
-                fee = None
-                is_send = v < 0
-            else:
-                # all inputs are mine
-                fee = v_out - v_in
-
-        return is_relevant, is_send, v, fee
+        inputs = [(i.get('prevout_hash'), i.get('prevout_n'), i.get('address')) for i in self.inputs]
+        return get_index_value(inputs, self.outputs, addresses, prevout_values)
 
 
     def get_input_info(self):
@@ -1,6 +1,7 @@
 import os, sys, re, json
 import platform
 import shutil
+import collections
 from datetime import datetime
 is_verbose = False
 
@@ -13,6 +14,61 @@ class MyEncoder(json.JSONEncoder):
         return super(MyEncoder, self).default(obj)
 
 
+class LRUCache(object):
+    """ bounded dict that drops the least recently used items first """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+
+class LineBuffer(object):
+    """ splits a stream of data into newline terminated lines """
+
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, data):
+        """ return the lines completed by data """
+        if '\n' not in data:
+            if data:
+                self.chunks.append(data)
+            return []
+        lines = data.split('\n')
+        if self.chunks:
+            self.chunks.append(lines[0])
+            lines[0] = ''.join(self.chunks)
+        rest = lines.pop()
+        self.chunks = [rest] if rest else []
+        return lines
+
+
 def set_verbosity(b):
     global is_verbose
     is_verbose = b
@@ -17,7 +17,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
+import threading, time, Queue, os, sys, shutil, heapq
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
 
@@ -35,9 +35,16 @@ class TxVerifier(threading.Thread):
         self.transactions    = {}                                 # requested verifications (with height sent by the requestor)
         self.verified_tx     = storage.get('verified_tx3',{})      # height, timestamp of verified transactions
         self.merkle_roots    = storage.get('merkle_roots',{})      # hashed by me
+        self.updates         = 0                                   # incremented when the position of a transaction may change
+        self.pending         = []                                  # heap of (height, tx_hash) waiting for headers
+        self.requested       = set()                               # merkle branches we are waiting for
         self.lock = threading.Lock()
         self.running = False
-        self.queue = Queue.Queue()
+        self.queue = Queue.Queue()                                 # responses, None when there may be something to request
+        # new headers wake us up. the daemon proxy does not forward them,
+        # so we also look for something to request every poll_interval
+        self.poll_interval = 10
+        self.network.register_callback('blockchain_height', lambda: self.queue.put(None))
 
 
     def get_confirmations(self, tx):
@@ -84,11 +91,17 @@ class TxVerifier(threading.Thread):
         """ add a transaction to the list of monitored transactions. """
         assert tx_height > 0
         with self.lock:
-            if tx_hash not in self.transactions.keys():
-                self.transactions[tx_hash] = tx_height
+            if tx_hash in self.transactions:
+                return
+            self.transactions[tx_hash] = tx_height
+            self.updates += 1
+            if tx_hash not in self.verified_tx:
+                heapq.heappush(self.pending, (tx_height, tx_hash))
+        self.queue.put(None)
 
     def stop(self):
         with self.lock: self.running = False
+        self.queue.put(None)
 
     def is_running(self):
         with self.lock: return self.running
@@ -96,27 +109,18 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
 
+        self.request_merkle()
         while self.is_running():
-            # request missing tx
-            for tx_hash, tx_height in self.transactions.items():
-                if tx_hash not in self.verified_tx:
-                    # do not request merkle branch before headers are available
-                    if tx_height > self.network.blockchain.height():
-                        continue
-                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
-                        if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], lambda i,r: self.queue.put(r)):
-                            print_error('requesting merkle', tx_hash)
-                            requested_merkle.append(tx_hash)
-
             try:
-                r = self.queue.get(timeout=1)
+                r = self.queue.get(timeout=self.poll_interval)
             except Queue.Empty:
+                r = None
+            if r is None:
+                # new transactions or new headers
+                self.request_merkle()
                 continue
 
-            if not r: continue
-
             if r.get('error'):
                 print_error('Verifier received an error:', r)
                 continue
@@ -129,7 +133,34 @@ class TxVerifier(threading.Thread):
             if method == 'blockchain.transaction.get_merkle':
                 tx_hash = params[0]
                 self.verify_merkle(tx_hash, result)
-                requested_merkle.remove(tx_hash)
+                with self.lock:
+                    self.requested.discard(tx_hash)
+
+
+    def request_merkle(self):
+        """ request, in one batch, the merkle branches of the transactions whose block header we have """
+        height = self.network.get_local_height()
+        requests = []
+        with self.lock:
+            while self.pending and self.pending[0][0] <= height:
+                tx_height, tx_hash = heapq.heappop(self.pending)
+                if tx_hash in self.verified_tx or tx_hash in self.requested:
+                    continue
+                if self.merkle_roots.get(tx_hash) is not None:
+                    continue
+                requests.append( ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) )
+                self.requested.add(tx_hash)
+
+        if not requests:
+            return
+        if self.network.send(requests, lambda i,r: self.queue.put(r)):
+            print_error('requesting merkle', len(requests))
+        else:
+            # not connected, try again with the next header
+            with self.lock:
+                for method, (tx_hash, tx_height) in requests:
+                    self.requested.discard(tx_hash)
+                    heapq.heappush(self.pending, (tx_height, tx_hash))
 
 
     def verify_merkle(self, tx_hash, result):
@@ -143,8 +174,9 @@ class TxVerifier(threading.Thread):
         timestamp = header.get('timestamp')
         with self.lock:
             self.verified_tx[tx_hash] = (tx_height, timestamp, pos)
+            self.updates += 1
         print_error("verified %s"%tx_hash)
-        self.storage.put('verified_tx3', self.verified_tx, True)
+        self.storage.put_deferred('verified_tx3', self.verified_tx)
         self.network.trigger_callback('updated')
 
 
@@ -166,5 +198,9 @@ class TxVerifier(threading.Thread):
                 print_error("redoing", tx_hash)
                 with self.lock:
                     self.verified_tx.pop(tx_hash)
+                    self.updates += 1
                     if tx_hash in self.merkle_roots:
                         self.merkle_roots.pop(tx_hash)
+                    if tx_hash in self.transactions:
+                        heapq.heappush(self.pending, (self.transactions[tx_hash], tx_hash))
+        self.queue.put(None)
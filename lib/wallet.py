@@ -30,11 +30,17 @@ import aes
 import Queue
 import time
 import math
-
-from util import print_msg, print_error, format_satoshis
+import json
+import atexit
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from util import print_msg, print_error, format_satoshis, LRUCache
 from bitcoin import *
 from account import *
-from transaction import Transaction
+from transaction import Transaction, get_index_value
 from plugins import run_hook
 import bitcoin
 from synchronizer import WalletSynchronizer
@@ -50,20 +56,112 @@ IMPORTED_ACCOUNT = '/x'
 from version import *
 
 
-class WalletStorage:
+def encode_value(x):
+    """ json keeps neither tuples nor non-string dict keys, tag them """
+    t = type(x)
+    if t is dict:
+        if all(type(k) in (str, unicode) for k in x):
+            return dict((k, encode_value(v)) for k, v in x.items())
+        return {'__dict__': [[encode_value(k), encode_value(v)] for k, v in x.items()]}
+    if t is tuple:
+        return {'__tuple__': [encode_value(v) for v in x]}
+    if t is list:
+        return [encode_value(v) for v in x]
+    return x
+
+def decode_string(x):
+    # ascii strings come back as str, like with the old repr format
+    try:
+        return x.encode('ascii')
+    except UnicodeEncodeError:
+        return x
+
+def decode_item(x):
+    t = type(x)
+    if t is unicode:
+        return decode_string(x)
+    if t is list:
+        return [decode_item(v) for v in x]
+    # dicts were already decoded by decode_dict
+    return x
+
+def decode_dict(d):
+    if len(d) == 1:
+        if '__tuple__' in d:
+            return tuple(decode_item(v) for v in d['__tuple__'])
+        if '__dict__' in d:
+            return dict((decode_item(k), decode_item(v)) for k, v in d['__dict__'])
+    return dict((decode_string(k), decode_item(v)) for k, v in d.iteritems())
+
+def dump_value(x):
+    return json.dumps(encode_value(x), separators=(',',':'))
+
+def load_value(s):
+    return decode_item(json.loads(s, object_hook=decode_dict))
+
+def is_immutable(x):
+    t = type(x)
+    if t is tuple:
+        return all(is_immutable(v) for v in x)
+    return t in (str, unicode, int, long, float, bool, type(None))
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == "SQLite format 3\0"
+    except IOError:
+        return False
+
+
+class WalletStorage(object):
+    """ the wallet file is a snapshot, changes are appended to a journal
+    next to it and folded into a new snapshot once the journal has grown
+    as large as the snapshot """
+
+    def __new__(klass, config):
+        if klass is WalletStorage:
+            # the format of an existing wallet is kept unless the
+            # 'wallet_storage' option asks for the other one
+            path = klass.init_path(config)
+            engine = config.get('wallet_storage')
+            if path and os.path.exists(path):
+                current = 'sqlite' if is_sqlite_file(path) else 'file'
+                if engine and engine != current:
+                    convert_wallet_storage(path, engine)
+                    current = engine
+                engine = current
+            if engine == 'sqlite':
+                klass = SqliteWalletStorage
+        return object.__new__(klass)
 
     def __init__(self, config):
         self.lock = threading.Lock()
         self.config = config
         self.data = {}
+        self.saved = {}        # what is on disk: key -> dumped value, or subkey -> (value, dumped value) for dicts
+        self.dirty = set()     # keys not written yet
+        self.flush_delay = config.get('wallet_flush_delay', 5)
+        self.flush_timer = None
+        atexit.register(self.flush)
+        self.file_size = 0
+        self.journal_size = 0
         self.file_exists = False
-        self.path = self.init_path(config)
+        self._path = self.init_path(config)
         print_error( "wallet path", self.path )
         if self.path:
             self.read(self.path)
 
 
-    def init_path(self, config):
+    @property
+    def path(self):
+        # the journal and the database belong to this path, use copy_to
+        # to save the wallet somewhere else
+        return self._path
+
+
+    @staticmethod
+    def init_path(config):
         """Set the path of the wallet."""
 
         # command line -w option
@@ -91,6 +189,10 @@ class WalletStorage:
         return new_path
 
 
+    def journal_path(self):
+        return self.path + '.journal'
+
+
     def read(self, path):
         """Read the contents of the wallet file."""
         try:
@@ -99,13 +201,46 @@ class WalletStorage:
         except IOError:
             return
         try:
-            d = ast.literal_eval( data )  #parse raw data from reading wallet file
-        except Exception:
-            raise IOError("Cannot read wallet file.")
+            d = load_value(data)
+        except ValueError:
+            try:
+                # wallet files written as a python literal
+                d = ast.literal_eval( data )
+            except Exception:
+                raise IOError("Cannot read wallet file.")
 
         self.data = d
+        self.file_size = len(data)
         self.file_exists = True
 
+        try:
+            with open(self.journal_path(), "r") as f:
+                lines = f.readlines()
+        except IOError:
+            return
+        for line in lines:
+            try:
+                entry = load_value(line)
+            except ValueError:
+                # interrupted while appending, start over from a clean snapshot
+                print_error("wallet journal truncated")
+                self.write_snapshot()
+                return
+            self.apply(entry)
+            self.journal_size += len(line)
+
+
+    def apply(self, entry):
+        # [key], [key, value], [key, subkey, value] or [key, subkey, null, null] to remove subkey
+        if len(entry) == 1:
+            self.data.pop(entry[0], None)
+        elif len(entry) == 2:
+            self.data[entry[0]] = entry[1]
+        elif len(entry) == 3:
+            self.data.setdefault(entry[0], {})[entry[1]] = entry[2]
+        else:
+            self.data.get(entry[0], {}).pop(entry[1], None)
+
 
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -116,27 +251,526 @@ class WalletStorage:
     def put(self, key, value, save = True):
 
         with self.lock:
+            self.set(key, value)
+            if save: 
+                self.save(True)
+
+    def put_deferred(self, key, value):
+        """ like put, for state that can be fetched again from the network:
+        it is written within flush_delay seconds or by flush() """
+        with self.lock:
+            self.set(key, value)
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        # called with the lock held
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def get_subkeys(self, key):
+        """ keys of the dict stored under key """
+        with self.lock:
+            return self.data.get(key, {}).keys()
+
+    def get_item(self, key, subkey):
+        with self.lock:
+            return self.data.get(key, {}).get(subkey)
+
+    def put_item(self, key, subkey, value):
+        """ set one item of the dict stored under key, or remove it if
+        value is None. it is written like put_deferred """
+        with self.lock:
+            d = self.data.setdefault(key, {})
             if value is not None:
-                self.data[key] = value
+                d[subkey] = value
             else:
-                self.data.pop(key)
-            if save: 
-                self.write()
+                d.pop(subkey, None)
+            self.dirty.add(key)
+            self.schedule_flush()
+
+    def flush(self):
+        with self.lock:
+            timer = self.flush_timer
+            self.flush_timer = None
+            if timer:
+                timer.cancel()
+            if self.dirty:
+                self.save()
+        if timer and timer is not threading.current_thread():
+            timer.join()
+
+    def set(self, key, value):
+        if value is not None:
+            self.data[key] = value
+        else:
+            self.data.pop(key)
+        self.dirty.add(key)
+
+    def diff(self, key):
+        """ changes since key was saved, as journal entries made of dumped values """
+        k = dump_value(key)
+        value = self.data.get(key)
+        if value is None:
+            self.saved.pop(key, None)
+            return [(k,)]
+
+        old = self.saved.get(key)
+        if type(value) is dict and type(old) is dict:
+            lines = []
+            for subkey, v in value.items():
+                o = old.get(subkey)
+                if o is not None and o[0] is v and is_immutable(v):
+                    continue
+                s = dump_value(v)
+                old[subkey] = v, s
+                if o is None or o[1] != s:
+                    lines.append((k, dump_value(subkey), s))
+            for subkey in old.keys():
+                if subkey not in value:
+                    old.pop(subkey)
+                    lines.append((k, dump_value(subkey), 'null', 'null'))
+            return lines
+
+        s = self.dump(key)
+        if s == old:
+            return []
+        return [(k, s)]
+
+    def dump(self, key):
+        """ dumped value of key, remembered as what is on disk """
+        value = self.data[key]
+        if type(value) is not dict:
+            s = dump_value(value)
+            self.saved[key] = s
+            return s
+        items = dict((subkey, (v, dump_value(v))) for subkey, v in value.items())
+        self.saved[key] = items
+        if all(type(subkey) in (str, unicode) for subkey in items):
+            return '{' + ','.join('%s:%s'%(dump_value(subkey), s) for subkey, (v, s) in items.items()) + '}'
+        return '{"__dict__":[' + ','.join('[%s,%s]'%(dump_value(subkey), s) for subkey, (v, s) in items.items()) + ']}'
+
+    def save(self, sync=False):
+        if not self.file_exists:
+            self.write_snapshot()
+            return
+        lines = []
+        for key in self.dirty:
+            lines += ['[%s]'%','.join(entry) for entry in self.diff(key)]
+        self.dirty.clear()
+        if not lines:
+            return
+        s = '\n'.join(lines) + '\n'
+        with open(self.journal_path(), "a") as f:
+            f.write(s)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        self.journal_size += len(s)
+        if self.journal_size > max(self.file_size, 1 << 16):
+            self.write_snapshot()
+        else:
+            self.set_permissions(self.journal_path())
 
     def write(self):
-        s = repr(self.data)
-        f = open(self.path,"w")
-        f.write( s )
-        f.close()
+        """ write a new snapshot and drop the journal """
+        with self.lock:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # called with the lock held
+        self.saved = {}
+        s = '{' + ','.join('%s:%s'%(dump_value(key), self.dump(key)) for key in self.data.keys()) + '}'
+        self.write_file(self.path, s)
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+        self.file_size = len(s)
+        self.journal_size = 0
+        self.dirty.clear()
+        self.file_exists = True
+
+    def write_file(self, path, s):
+        temp_path = path + '.tmp'
+        with open(temp_path, "w") as f:
+            f.write( s )
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+        self.set_permissions(path)
+
+    def copy_to(self, path, changes={}):
+        """ save the wallet as a new file at path, with the values in
+        changes. this storage and its file are not modified """
+        assert path != self.path
+        with self.lock:
+            data = dict(self.data)
+            data.update(changes)
+            s = '{' + ','.join('%s:%s'%(dump_value(key), dump_value(value)) for key, value in data.items() if value is not None) + '}'
+        remove_wallet_files(path)
+        self.write_file(path, s)
+
+    def set_permissions(self, path):
         if 'ANDROID_DATA' not in os.environ:
             import stat
-            os.chmod(self.path,stat.S_IREAD | stat.S_IWRITE)
+            os.chmod(path,stat.S_IREAD | stat.S_IWRITE)
 
+    def keys(self):
+        return self.data.keys()
 
+    def close(self):
+        self.flush()
+
+
+class SqliteWalletStorage(WalletStorage):
+    """ wallet kept in an sqlite database. the large dicts of the wallet
+    have a table each, with one row per item, other keys are rows of the
+    misc table. keys are read from the database when they are first asked
+    for, and only the rows that changed are written. single items of a
+    table can be read and written without loading the whole table """
+
+    tables = {
+        'transactions': 'transactions',
+        'addr_history': 'addr_history',
+        'verified_tx3': 'verified_tx',
+        'labels': 'labels',
+        'accounts': 'accounts',
+        'tx_index': 'tx_index',
+        }
+
+    def __init__(self, config):
+        if sqlite3 is None:
+            raise IOError("sqlite3 is not available")
+        self.lock = threading.Lock()
+        self.config = config
+        self.data = {}
+        self.saved = {}
+        self.dirty = set()
+        self.flush_delay = config.get('wallet_flush_delay', 5)
+        self.flush_timer = None
+        atexit.register(self.flush)
+        self.loaded = set()
+        self.item_changes = {}     # key -> subkey -> value (None to remove), for tables not loaded
+        self.db = None
+        self._path = self.init_path(config)
+        print_error( "wallet path", self.path )
+        self.file_exists = bool(self.path) and os.path.exists(self.path)
+        if self.file_exists:
+            self.open()
+
+
+    def open(self):
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for table in ['misc'] + self.tables.values():
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)"%table)
+        self.file_exists = True
+        self.set_permissions(self.path)
+
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+
+    def keys(self):
+        keys = set(self.data.keys())
+        if self.db:
+            with self.lock:
+                for k, in self.db.execute("SELECT key FROM misc"):
+                    keys.add(load_value(k))
+                for key, table in self.tables.items():
+                    if self.db.execute("SELECT 1 FROM %s LIMIT 1"%table).fetchone():
+                        keys.add(key)
+        return list(keys)
+
+
+    def load(self, key):
+        # called with the lock held. get() looks at loaded without the
+        # lock, so key is added once its value is in place
+        self.load_rows(key)
+        changes = self.item_changes.pop(key, None)
+        if changes:
+            d = self.data.setdefault(key, {})
+            for subkey, value in changes.items():
+                if value is not None:
+                    d[subkey] = value
+                else:
+                    d.pop(subkey, None)
+        self.loaded.add(key)
+
+
+    def load_rows(self, key):
+        if not self.db:
+            return
+        table = self.tables.get(key)
+        if table:
+            rows = self.db.execute("SELECT key, value FROM %s"%table).fetchall()
+            if rows:
+                items = {}
+                value = {}
+                for k, s in rows:
+                    v = load_value(s)
+                    items[load_value(k)] = v, s
+                    value[load_value(k)] = v
+                self.data[key] = value
+                self.saved[key] = items
+                return
+        row = self.db.execute("SELECT value FROM misc WHERE key=?", (dump_value(key),)).fetchone()
+        if row:
+            self.data[key] = load_value(row[0])
+            self.saved[key] = row[0]
+
+
+    def get(self, key, default=None):
+        if key not in self.loaded:
+            with self.lock:
+                if key not in self.loaded:
+                    self.load(key)
+        return WalletStorage.get(self, key, default)
+
+
+    def get_subkeys(self, key):
+        table = self.tables.get(key)
+        with self.lock:
+            if key in self.loaded or not table:
+                if key not in self.loaded:
+                    self.load(key)
+                return self.data.get(key, {}).keys()
+            subkeys = set()
+            if self.db:
+                subkeys.update(load_value(k) for k, in self.db.execute("SELECT key FROM %s"%table))
+            for subkey, value in self.item_changes.get(key, {}).items():
+                if value is not None:
+                    subkeys.add(subkey)
+                else:
+                    subkeys.discard(subkey)
+            return list(subkeys)
+
+
+    def get_item(self, key, subkey):
+        table = self.tables.get(key)
+        with self.lock:
+            if key in self.loaded or not table:
+                if key not in self.loaded:
+                    self.load(key)
+                return self.data.get(key, {}).get(subkey)
+            changes = self.item_changes.get(key, {})
+            if subkey in changes:
+                return changes[subkey]
+            if not self.db:
+                return None
+            row = self.db.execute("SELECT value FROM %s WHERE key=?"%table, (dump_value(subkey),)).fetchone()
+            return load_value(row[0]) if row else None
+
+
+    def put_item(self, key, subkey, value):
+        with self.lock:
+            if key in self.loaded or not self.tables.get(key):
+                if key not in self.loaded:
+                    self.load(key)
+                d = self.data.setdefault(key, {})
+                if value is not None:
+                    d[subkey] = value
+                else:
+                    d.pop(subkey, None)
+            else:
+                self.item_changes.setdefault(key, {})[subkey] = value
+            self.dirty.add(key)
+            self.schedule_flush()
+
+
+    def set(self, key, value):
+        if key not in self.loaded:
+            # what is in the database is needed to write only the changes
+            self.load(key)
+        if value is not None:
+            self.data[key] = value
+        else:
+            self.data.pop(key, None)
+        self.dirty.add(key)
+
+
+    def save(self, sync=False):
+        if not self.db:
+            self.open()
+        if sync:
+            self.db.execute("PRAGMA synchronous=FULL")
+        with self.db:
+            for key, changes in self.item_changes.items():
+                table = self.tables[key]
+                for subkey, value in changes.items():
+                    if value is not None:
+                        self.db.execute("INSERT OR REPLACE INTO %s VALUES (?,?)"%table, (dump_value(subkey), dump_value(value)))
+                    else:
+                        self.db.execute("DELETE FROM %s WHERE key=?"%table, (dump_value(subkey),))
+            self.item_changes = {}
+            for key in self.dirty:
+                if key in self.loaded:
+                    self.save_key(key)
+        if sync:
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.dirty.clear()
+
+
+    def save_key(self, key):
+        value = self.data.get(key)
+        table = self.tables.get(key)
+        k = dump_value(key)
+        if table and type(value) is dict:
+            if type(self.saved.get(key)) is not dict:
+                self.db.execute("DELETE FROM misc WHERE key=?", (k,))
+                self.saved[key] = {}
+            for entry in self.diff(key):
+                if len(entry) == 3:
+                    self.db.execute("INSERT OR REPLACE INTO %s VALUES (?,?)"%table, entry[1:])
+                else:
+                    self.db.execute("DELETE FROM %s WHERE key=?"%table, entry[1:2])
+            return
+
+        if table and type(self.saved.get(key)) is dict:
+            self.db.execute("DELETE FROM %s"%table)
+            self.saved.pop(key)
+        if value is None:
+            self.db.execute("DELETE FROM misc WHERE key=?", (k,))
+            self.saved.pop(key, None)
+            return
+        s = dump_value(value)
+        if s != self.saved.get(key):
+            self.db.execute("INSERT OR REPLACE INTO misc VALUES (?,?)", (k, s))
+            self.saved[key] = s
+
+
+    def write(self):
+        """ write everything and fold the sqlite log into the database file """
+        with self.lock:
+            for key in self.data.keys():
+                self.dirty.add(key)
+            self.save()
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+    def copy_to(self, path, changes={}):
+        assert path != self.path
+        remove_wallet_files(path)
+        target = SqliteWalletStorage({'wallet_path':path})
+        with self.lock:
+            keys = set(self.data.keys() + self.tables.keys() + changes.keys())
+            if self.db:
+                keys.update(load_value(k) for k, in self.db.execute("SELECT key FROM misc"))
+            for key in keys:
+                if key not in self.loaded:
+                    self.load(key)
+                value = changes.get(key, self.data.get(key))
+                if value is not None:
+                    target.set(key, value)
+            target.save()
+        target.close()
+
+
+
+def remove_wallet_files(path):
+    """ remove a wallet file and the files of its storage engine """
+    for p in [path, path + '.journal', path + '-wal', path + '-shm']:
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def convert_wallet_storage(path, engine):
+    """ rewrite the wallet at path with the given storage engine """
+    print_error("converting wallet to", engine)
+    source = WalletStorage({'wallet_path':path})
+    temp_path = path + '.convert'
+    for p in [temp_path, temp_path + '.journal']:
+        if os.path.exists(p):
+            os.remove(p)
+    target = (SqliteWalletStorage if engine == 'sqlite' else WalletStorage)({'wallet_path':temp_path})
+    for key in source.keys():
+        target.put(key, source.get(key), False)
+    target.write()
+    target.close()
+    source.close()
+    if os.name == 'nt':
+        os.remove(path)
+    os.rename(temp_path, path)
+    for p in [path + '.journal', path + '-wal', path + '-shm']:
+        if os.path.exists(p):
+            os.remove(p)
+
+
+
+class TransactionStore(object):
+    """ the raw transactions of a wallet, by hash. they are read from the
+    storage when asked for, and a bounded number of them is kept """
+
+    def __init__(self, storage, on_load):
+        self.storage = storage
+        self.on_load = on_load         # called with (tx_hash, tx) when a transaction is read
+        self.hashes = set(storage.get_subkeys('transactions'))
+        self.cache = LRUCache(1000)
+        self.lock = threading.Lock()
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def keys(self):
+        return list(self.hashes)
+
+    def items(self):
+        return [(tx_hash, self[tx_hash]) for tx_hash in self.keys()]
+
+    def values(self):
+        return [self[tx_hash] for tx_hash in self.keys()]
+
+    def get(self, tx_hash, default=None):
+        if tx_hash not in self.hashes:
+            return default
+        with self.lock:
+            tx = self.cache.get(tx_hash)
+        if tx is None:
+            raw = self.storage.get_item('transactions', tx_hash)
+            if raw is None:
+                return default
+            tx = Transaction(raw, decode=False)
+            self.on_load(tx_hash, tx)
+            with self.lock:
+                self.cache.put(tx_hash, tx)
+        return tx
+
+    def get_cached(self, tx_hash):
+        with self.lock:
+            return self.cache.get(tx_hash)
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.hashes.add(tx_hash)
+            self.cache.put(tx_hash, tx)
+        self.storage.put_item('transactions', tx_hash, str(tx))
+
+    def pop(self, tx_hash):
+        with self.lock:
+            self.hashes.discard(tx_hash)
+            self.cache.pop(tx_hash)
+        self.storage.put_item('transactions', tx_hash, None)
 
-    
 
-        
 
 class Abstract_Wallet:
 
@@ -170,27 +804,54 @@ class Abstract_Wallet:
 
         self.load_accounts()
 
-        self.transactions = {}
-        tx_list = self.storage.get('transactions',{})
-        for k,v in tx_list.items():
-            try:
-                tx = Transaction(v)
-            except Exception:
-                print_msg("Warning: Cannot deserialize transactions. skipping")
-                continue
-
-            self.add_extra_addresses(tx)
-            self.transactions[k] = tx
+        # transactions are read and decoded on demand, what the wallet
+        # needs to know about them is kept in tx_index
+        self.tx_index = self.storage.get('tx_index', {})
+        self.transactions = TransactionStore(self.storage, self.restore_input_addresses)
+        index_changed = False
+        for k in self.transactions.keys():
+            if k not in self.tx_index:
+                index_changed = True
+                try:
+                    self.index_tx(k, self.transactions[k])
+                except Exception:
+                    print_msg("Warning: Cannot deserialize transactions. skipping")
+                    self.transactions.pop(k)
+
+        for h in self.tx_index.keys():
+            if h not in self.transactions:
+                index_changed = True
+                self.tx_index.pop(h)
+
+        self.pubkey_inputs = {}      # outpoint -> (tx_hash, n) of pay-to-pubkey inputs whose address is not known
+        for h in self.transactions.keys():
+            if self.add_extra_addresses(h):
+                index_changed = True
+
+        self.tx_addresses = {}       # tx_hash -> set of addresses whose history references it
+        for addr, hist in self.history.items():
+            self.index_history(addr, hist)
 
-        for h,tx in self.transactions.items():
-            if not self.check_new_tx(h, tx):
+        for h in self.transactions.keys():
+            if not self.check_new_tx(h):
                 print_error("removing unreferenced tx", h)
+                index_changed = True
                 self.transactions.pop(h)
+                self.tx_index.pop(h)
+
+        # so that the next open does not decode the transactions again
+        if index_changed:
+            self.save_transactions()
 
 
         # not saved
         self.prevout_values = {}     # my own transaction outputs
-        self.spent_outputs = []
+        self.spent_outputs = {}      # outpoint -> hash of the spending tx
+        self.utxos = {}              # address -> outpoint -> (height, tx_hash, n, is_coinbase)
+        self.addr_balances = {}      # address -> (confirmed, unconfirmed)
+        self.account_balances = None # account_id -> [confirmed, unconfirmed], None for the whole wallet
+        self.unsynchronized = set()  # addresses with transactions we do not have yet
+        self.tx_history_cache = {}   # account -> (verifier updates, total value, history items)
 
         # spv
         self.verifier = None
@@ -204,18 +865,94 @@ class Abstract_Wallet:
         self.transaction_lock = threading.Lock()
         self.tx_event = threading.Event()
 
-        for tx_hash, tx in self.transactions.items():
+        for tx_hash in self.tx_index.keys():
             self.update_tx_outputs(tx_hash)
+        for addr in self.history.keys():
+            self.update_addr_balance(addr)
+
+
+    def index_tx(self, tx_hash, tx):
+        """ (prevout_hash, prevout_n, address, is_pubkey) of the inputs and (address, value) of the outputs """
+        inputs = tuple((i.get('prevout_hash'), i.get('prevout_n'), i.get('address'), i.get('address') == "(pubkey)") for i in tx.inputs)
+        outputs = tuple(tuple(o) for o in tx.outputs)
+        self.tx_index[tx_hash] = inputs, outputs
+
+
+    def index_history(self, addr, hist):
+        if hist == ['*']: return
+        for tx_hash, height in hist:
+            self.tx_addresses.setdefault(tx_hash, set()).add(addr)
+
+
+    def unindex_history(self, addr, hist):
+        if hist == ['*']: return
+        for tx_hash, height in hist:
+            s = self.tx_addresses.get(tx_hash)
+            if s is None: continue
+            s.discard(addr)
+            if not s:
+                self.tx_addresses.pop(tx_hash)
 
 
-    def add_extra_addresses(self, tx):
-        h = tx.hash()
-        # find the address corresponding to pay-to-pubkey inputs
-        tx.add_extra_addresses(self.transactions)
-        for o in tx.d.get('outputs'):
-            if o.get('is_pubkey'):
-                for tx2 in self.transactions.values():
-                    tx2.add_extra_addresses({h:tx})
+    def set_history(self, addr, hist):
+        """ replace the history of addr, keeping tx_addresses up to date """
+        self.unindex_history(addr, self.history.get(addr, []))
+        self.history[addr] = hist
+        self.index_history(addr, hist)
+
+
+    def add_extra_addresses(self, tx_hash):
+        """ find the address corresponding to pay-to-pubkey inputs, returns the transactions that changed """
+        changed = []
+        inputs, outputs = self.tx_index[tx_hash]
+        for n, (prevout_hash, prevout_n, address, is_pubkey) in enumerate(inputs):
+            if not is_pubkey or address != "(pubkey)":
+                # addresses found earlier are set by restore_input_addresses
+                continue
+            prev = self.tx_index.get(prevout_hash)
+            if prev:
+                self.set_input_address(tx_hash, n, prev[1][prevout_n][0])
+                changed.append(tx_hash)
+            else:
+                self.pubkey_inputs[prevout_hash + ':%d'%prevout_n] = tx_hash, n
+
+        for i, (address, value) in enumerate(outputs):
+            spender = self.pubkey_inputs.pop(tx_hash + ':%d'%i, None)
+            if spender and spender[0] in self.transactions:
+                self.set_input_address(spender[0], spender[1], address)
+                changed.append(spender[0])
+        return changed
+
+
+    def set_input_address(self, tx_hash, n, address):
+        print_error("found pay-to-pubkey address:", address)
+        inputs, outputs = self.tx_index[tx_hash]
+        prevout_hash, prevout_n, _, is_pubkey = inputs[n]
+        inputs = inputs[:n] + ((prevout_hash, prevout_n, address, is_pubkey),) + inputs[n+1:]
+        self.tx_index[tx_hash] = inputs, outputs
+        self.save_transactions()
+        tx = self.transactions.get_cached(tx_hash)
+        if tx:
+            tx.set_input_address(n, address)
+
+
+    def restore_input_addresses(self, tx_hash, tx):
+        """ set the pay-to-pubkey input addresses found earlier on a transaction read from storage """
+        inputs, outputs = self.tx_index.get(tx_hash, ((), ()))
+        for n, (prevout_hash, prevout_n, address, is_pubkey) in enumerate(inputs):
+            if is_pubkey and address != "(pubkey)":
+                tx.set_input_address(n, address)
+
+
+    def tx_has_address(self, tx_hash, addr):
+        inputs, outputs = self.tx_index[tx_hash]
+        for item in inputs:
+            if item[2] == addr:
+                return True
+        for item in outputs:
+            if item[0] == addr:
+                return True
+        return False
 
 
     def get_action(self):
@@ -244,6 +981,45 @@ class Abstract_Wallet:
                 self.accounts[k] = PendingAccount(v)
             else:
                 print_error("cannot load account", v)
+        self.build_address_index()
+
+
+    def build_address_index(self):
+        """ address -> (account_id, (for_change, n)) for every address of the wallet """
+        self.address_index = {}
+        self.account_balances = None
+        for k in self.accounts.keys():
+            self.index_account(k)
+        for k, addr in self.next_addresses.items():
+            self.address_index.setdefault(addr, (k, (0,0)))
+
+    def index_account(self, account_id):
+        self.account_balances = None
+        self.tx_history_cache = {}
+        for addr, v in self.address_index.items():
+            if v[0] == account_id:
+                self.address_index.pop(addr)
+        account = self.accounts.get(account_id)
+        if account is None:
+            return
+        for for_change in [0,1]:
+            for n, addr in enumerate(account.get_addresses(for_change)):
+                self.address_index[addr] = account_id, (for_change, n)
+
+    def create_new_address(self, account_id, for_change):
+        account = self.accounts[account_id]
+        address = account.create_new_address(for_change)
+        n = len(account.get_addresses(for_change)) - 1
+        self.address_index[address] = account_id, (for_change, n)
+        return address
+
+    def create_new_addresses(self, account_id, for_change, k):
+        account = self.accounts[account_id]
+        n = len(account.get_addresses(for_change))
+        new = account.create_new_addresses(for_change, k)
+        for i, address in enumerate(new):
+            self.address_index[address] = account_id, (for_change, n + i)
+        return new
 
 
     def synchronize(self):
@@ -284,6 +1060,7 @@ class Abstract_Wallet:
         if self.accounts.get(IMPORTED_ACCOUNT) is None:
             self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
         self.accounts[IMPORTED_ACCOUNT].add(address, pubkey, sec, password)
+        self.index_account(IMPORTED_ACCOUNT)
         self.save_accounts()
         
         if self.synchronizer:
@@ -296,6 +1073,7 @@ class Abstract_Wallet:
         account.remove(addr)
         if not account.get_addresses(0):
             self.accounts.pop(IMPORTED_ACCOUNT)
+        self.index_account(IMPORTED_ACCOUNT)
         self.save_accounts()
 
 
@@ -333,7 +1111,7 @@ class Abstract_Wallet:
 
 
     def is_mine(self, address):
-        return address in self.addresses(True) 
+        return address in self.address_index
 
 
     def is_change(self, address):
@@ -344,19 +1122,10 @@ class Abstract_Wallet:
 
 
     def get_address_index(self, address):
-
-        for account in self.accounts.keys():
-            for for_change in [0,1]:
-                addresses = self.accounts[account].get_addresses(for_change)
-                for addr in addresses:
-                    if address == addr:
-                        return account, (for_change, addresses.index(addr))
-
-        for k,v in self.next_addresses.items():
-            if v == address:
-                return k, (0,0)
-
-        raise Exception("Address not found", address)
+        try:
+            return self.address_index[address]
+        except KeyError:
+            raise Exception("Address not found", address)
 
 
     def getpubkeys(self, addr):
@@ -500,10 +1269,11 @@ class Abstract_Wallet:
 
 
     def fill_addressbook(self):
-        for tx_hash, tx in self.transactions.items():
-            is_relevant, is_send, _, _ = self.get_tx_value(tx)
+        domain = set(self.get_account_addresses(None))
+        for tx_hash, (inputs, outputs) in self.tx_index.items():
+            is_relevant, is_send, _, _ = get_index_value(inputs, outputs, domain, self.prevout_values)
             if is_send:
-                for addr, v in tx.outputs:
+                for addr, v in outputs:
                     if not self.is_mine(addr) and addr not in self.addressbook:
                         self.addressbook.append(addr)
         # redo labels
@@ -511,8 +1281,8 @@ class Abstract_Wallet:
 
     def get_num_tx(self, address):
         n = 0 
-        for tx in self.transactions.values():
-            if address in map(lambda x:x[0], tx.outputs): n += 1
+        for inputs, outputs in self.tx_index.values():
+            if address in map(lambda x:x[0], outputs): n += 1
         return n
 
 
@@ -523,54 +1293,84 @@ class Abstract_Wallet:
         
 
     def get_tx_value(self, tx, account=None):
-        domain = self.get_account_addresses(account)
+        domain = set(self.get_account_addresses(account))
         return tx.get_value(domain, self.prevout_values)
 
     
     def update_tx_outputs(self, tx_hash):
-        tx = self.transactions.get(tx_hash)
+        inputs, outputs = self.tx_index[tx_hash]
 
-        for i, (addr, value) in enumerate(tx.outputs):
+        for i, (addr, value) in enumerate(outputs):
             key = tx_hash+ ':%d'%i
             self.prevout_values[key] = value
 
-        for item in tx.inputs:
-            if self.is_mine(item.get('address')):
-                key = item['prevout_hash'] + ':%d'%item['prevout_n']
-                self.spent_outputs.append(key)
+        for prevout_hash, prevout_n, addr, is_pubkey in inputs:
+            if self.is_mine(addr):
+                key = prevout_hash + ':%d'%prevout_n
+                self.spent_outputs[key] = tx_hash
+
+
+    def get_tx_addresses(self, tx_hash):
+        """ wallet addresses whose balance depends on tx """
+        inputs, outputs = self.tx_index[tx_hash]
+        addresses = set(item[2] for item in inputs)
+        addresses.update(item[0] for item in outputs)
+        return [addr for addr in addresses if addr in self.history]
+
+
+    def remove_transaction(self, tx_hash):
+        addresses = self.get_tx_addresses(tx_hash)
+        inputs, outputs = self.tx_index.pop(tx_hash)
+        self.transactions.pop(tx_hash)
+        self.save_transactions()
+        for prevout_hash, prevout_n, addr, is_pubkey in inputs:
+            if prevout_hash is None: continue
+            key = prevout_hash + ':%d'%prevout_n
+            if self.spent_outputs.get(key) == tx_hash:
+                self.spent_outputs.pop(key)
+        for addr in addresses:
+            self.update_addr_balance(addr)
+        self.tx_history_cache = {}
 
 
-    def get_addr_balance(self, address):
-        #assert self.is_mine(address)
+    def update_addr_balance(self, address):
+        """ recompute the balance and the unspent outputs of an address from its history """
         h = self.history.get(address,[])
-        if h == ['*']: return 0,0
         c = u = 0
-        received_coins = []   # list of coins received at address
+        coins = {}
+        self.unsynchronized.discard(address)
+        if h == ['*']: h = []
 
+        received_coins = set()   # coins received at address
         for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
-            if not tx: continue
+            tx = self.tx_index.get(tx_hash)
+            if not tx:
+                self.unsynchronized.add(address)
+                continue
+            inputs, outputs = tx
 
-            for i, (addr, value) in enumerate(tx.outputs):
+            is_coinbase = inputs[0][0] == '0'*64
+            for i, (addr, value) in enumerate(outputs):
                 if addr == address:
                     key = tx_hash + ':%d'%i
-                    received_coins.append(key)
+                    received_coins.add(key)
+                    if key not in self.spent_outputs:
+                        coins[key] = tx_height, tx_hash, i, is_coinbase
 
         for tx_hash, tx_height in h:
-            tx = self.transactions.get(tx_hash)
+            tx = self.tx_index.get(tx_hash)
             if not tx: continue
+            inputs, outputs = tx
             v = 0
 
-            for item in tx.inputs:
-                addr = item.get('address')
+            for prevout_hash, prevout_n, addr, is_pubkey in inputs:
                 if addr == address:
-                    key = item['prevout_hash']  + ':%d'%item['prevout_n']
+                    key = prevout_hash + ':%d'%prevout_n
                     value = self.prevout_values.get( key )
                     if key in received_coins: 
                         v -= value
 
-            for i, (addr, value) in enumerate(tx.outputs):
-                key = tx_hash + ':%d'%i
+            for addr, value in outputs:
                 if addr == address:
                     v += value
 
@@ -578,7 +1378,23 @@ class Abstract_Wallet:
                 c += v
             else:
                 u += v
-        return c, u
+
+        if coins:
+            self.utxos[address] = coins
+        else:
+            self.utxos.pop(address, None)
+
+        old_c, old_u = self.addr_balances.get(address, (0,0))
+        self.addr_balances[address] = c, u
+        if self.account_balances is not None and address in self.address_index:
+            for k in [self.address_index[address][0], None]:
+                b = self.account_balances.setdefault(k, [0,0])
+                b[0] += c - old_c
+                b[1] += u - old_u
+
+
+    def get_addr_balance(self, address):
+        return self.addr_balances.get(address, (0,0))
 
 
     def get_account_name(self, k):
@@ -603,13 +1419,23 @@ class Abstract_Wallet:
 
 
     def get_account_balance(self, account):
-        return self.get_balance(self.get_account_addresses(account))
+        if self.account_balances is None:
+            self.account_balances = {None:[0,0]}
+            for addr, (c, u) in self.addr_balances.items():
+                if addr not in self.address_index: continue
+                for k in [self.address_index[addr][0], None]:
+                    b = self.account_balances.setdefault(k, [0,0])
+                    b[0] += c
+                    b[1] += u
+        if account is not None and account not in self.accounts:
+            return 0, 0
+        return tuple(self.account_balances.get(account, (0,0)))
 
     def get_frozen_balance(self):
         return self.get_balance(self.frozen_addresses)
         
     def get_balance(self, domain=None):
-        if domain is None: domain = self.addresses(True)
+        if domain is None: return self.get_account_balance(None)
         cc = uu = 0
         for addr in domain:
             c, u = self.get_addr_balance(addr)
@@ -620,23 +1446,15 @@ class Abstract_Wallet:
 
     def get_unspent_coins(self, domain=None):
         coins = []
-        if domain is None: domain = self.addresses(True)
+        if domain is None: domain = filter(self.is_mine, self.utxos.keys() + list(self.unsynchronized))
         for addr in domain:
-            h = self.history.get(addr, [])
-            if h == ['*']: continue
-            for tx_hash, tx_height in h:
-                tx = self.transactions.get(tx_hash)
-                if tx is None: raise Exception("Wallet not synchronized")
-                is_coinbase = tx.inputs[0].get('prevout_hash') == '0'*64
-                for o in tx.d.get('outputs'):
-                    output = o.copy()
-                    if output.get('address') != addr: continue
-                    key = tx_hash + ":%d" % output.get('prevout_n')
-                    if key in self.spent_outputs: continue
-                    output['prevout_hash'] = tx_hash
-                    output['height'] = tx_height
-                    output['coinbase'] = is_coinbase
-                    coins.append((tx_height, output))
+            if addr in self.unsynchronized: raise Exception("Wallet not synchronized")
+            for tx_height, tx_hash, n, is_coinbase in self.utxos.get(addr, {}).values():
+                output = self.transactions[tx_hash].d['outputs'][n].copy()
+                output['prevout_hash'] = tx_hash
+                output['height'] = tx_height
+                output['coinbase'] = is_coinbase
+                coins.append((tx_height, output))
 
         # sort by age
         if coins:
@@ -724,24 +1542,32 @@ class Abstract_Wallet:
     def receive_tx_callback(self, tx_hash, tx, tx_height):
 
         with self.transaction_lock:
-            self.add_extra_addresses(tx)
-            if not self.check_new_tx(tx_hash, tx):
+            self.index_tx(tx_hash, tx)
+            self.transactions[tx_hash] = tx
+            changed = self.add_extra_addresses(tx_hash)
+            if not self.check_new_tx(tx_hash):
                 # may happen due to pruning
                 print_error("received transaction that is no longer referenced in history", tx_hash)
+                self.transactions.pop(tx_hash)
+                self.tx_index.pop(tx_hash)
+                self.save_transactions()
                 return
-            self.transactions[tx_hash] = tx
             self.network.pending_transactions_for_notifications.append(tx)
             self.save_transactions()
             if self.verifier and tx_height>0: 
                 self.verifier.add(tx_hash, tx_height)
             self.update_tx_outputs(tx_hash)
+            for h in changed:
+                if h != tx_hash:
+                    self.update_tx_outputs(h)
+            for addr in self.get_tx_addresses(tx_hash):
+                self.update_addr_balance(addr)
+            self.tx_history_cache = {}
 
 
     def save_transactions(self):
-        tx = {}
-        for k,v in self.transactions.items():
-            tx[k] = str(v)
-        self.storage.put('transactions', tx, True)
+        # raw transactions are written by self.transactions
+        self.storage.put_deferred('tx_index', self.tx_index)
 
     def receive_history_callback(self, addr, hist):
 
@@ -749,8 +1575,12 @@ class Abstract_Wallet:
             raise Exception("error: received history for %s is not consistent with known transactions"%addr)
             
         with self.lock:
-            self.history[addr] = hist
-            self.storage.put('addr_history', self.history, True)
+            self.set_history(addr, hist)
+            self.storage.put_deferred('addr_history', self.history)
+
+        with self.transaction_lock:
+            self.update_addr_balance(addr)
+            self.tx_history_cache = {}
 
         if hist != ['*']:
             for tx_hash, tx_height in hist:
@@ -764,34 +1594,49 @@ class Abstract_Wallet:
             return []
 
         with self.transaction_lock:
-            history = self.transactions.items()
-            history.sort(key = lambda x: self.verifier.get_txpos(x[0]))
-            result = []
-    
-            balance = 0
-            for tx_hash, tx in history:
-                is_relevant, is_mine, v, fee = self.get_tx_value(tx, account)
-                if v is not None: balance += v
-
             c, u = self.get_account_balance(account)
+            total, items = self.get_tx_history_items(account)
 
-            if balance != c+u:
-                result.append( ('', 1000, 0, c+u-balance, None, c+u-balance, None ) )
+        result = []
+        # transactions we do not know about
+        balance = c + u - total
+        if balance:
+            result.append( ('', 1000, 0, balance, None, balance, None ) )
 
-            balance = c + u - balance
-            for tx_hash, tx in history:
-                is_relevant, is_mine, value, fee = self.get_tx_value(tx, account)
-                if not is_relevant:
-                    continue
-                if value is not None:
-                    balance += value
-
-                conf, timestamp = self.verifier.get_confirmations(tx_hash) if self.verifier else (None, None)
-                result.append( (tx_hash, conf, is_mine, value, fee, balance, timestamp) )
+        for tx_hash, is_mine, value, fee, tx_balance in items:
+            conf, timestamp = self.verifier.get_confirmations(tx_hash)
+            result.append( (tx_hash, conf, is_mine, value, fee, balance + tx_balance, timestamp) )
 
         return result
 
 
+    def get_tx_history_items(self, account):
+        """ total value of the transactions of account, and the relevant ones in block order
+            with their running balance. cached until a transaction, a history or a verification changes """
+        updates = self.verifier.updates
+        cached = self.tx_history_cache.get(account)
+        if cached and cached[0] == updates:
+            return cached[1:]
+
+        domain = set(self.get_account_addresses(account))
+        history = self.tx_index.items()
+        history.sort(key = lambda x: self.verifier.get_txpos(x[0]))
+        items = []
+        total = balance = 0
+        for tx_hash, (inputs, outputs) in history:
+            is_relevant, is_mine, value, fee = get_index_value(inputs, outputs, domain, self.prevout_values)
+            if value is not None:
+                total += value
+            if not is_relevant:
+                continue
+            if value is not None:
+                balance += value
+            items.append( (tx_hash, is_mine, value, fee, balance) )
+
+        self.tx_history_cache[account] = updates, total, items
+        return total, items
+
+
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash)
         is_default = (label == '') or (label is None)
@@ -955,10 +1800,10 @@ class Abstract_Wallet:
                     self.verifier.add(tx_hash, tx_height)
 
         # if we are on a pruning server, remove unverified transactions
-        vr = self.verifier.transactions.keys() + self.verifier.verified_tx.keys()
+        vr = set(self.verifier.transactions.keys()) | set(self.verifier.verified_tx.keys())
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
-                self.transactions.pop(tx_hash)
+                self.remove_transaction(tx_hash)
 
 
     def check_new_history(self, addr, hist):
@@ -966,25 +1811,18 @@ class Abstract_Wallet:
         # check that all tx in hist are relevant
         if hist != ['*']:
             for tx_hash, height in hist:
-                tx = self.transactions.get(tx_hash)
-                if not tx: continue
-                if not tx.has_address(addr):
+                if tx_hash not in self.tx_index: continue
+                if not self.tx_has_address(tx_hash, addr):
                     return False
 
         # check that we are not "orphaning" a transaction
         old_hist = self.history.get(addr,[])
         if old_hist == ['*']: return True
 
+        new_hist = set(map(lambda x:x[0], hist)) if hist != ['*'] else set()
         for tx_hash, height in old_hist:
-            if tx_hash in map(lambda x:x[0], hist): continue
-            found = False
-            for _addr, _hist in self.history.items():
-                if _addr == addr: continue
-                if _hist == ['*']: continue
-                _tx_hist = map(lambda x:x[0], _hist)
-                if tx_hash in _tx_hist:
-                    found = True
-                    break
+            if tx_hash in new_hist: continue
+            found = bool(self.tx_addresses.get(tx_hash, set()) - set([addr]))
 
             if not found:
                 tx = self.transactions.get(tx_hash)
@@ -1015,26 +1853,20 @@ class Abstract_Wallet:
                     self.verifier.add(tx_hash, height)
                 else:
                     print_error("removing orphaned tx from history", tx_hash)
-                    self.transactions.pop(tx_hash)
+                    self.remove_transaction(tx_hash)
 
         return True
 
 
-    def check_new_tx(self, tx_hash, tx):
+    def check_new_tx(self, tx_hash):
         # 1 check that tx is referenced in addr_history. 
-        addresses = []
-        for addr, hist in self.history.items():
-            if hist == ['*']:continue
-            for txh, height in hist:
-                if txh == tx_hash: 
-                    addresses.append(addr)
-
+        addresses = list(self.tx_addresses.get(tx_hash, []))
         if not addresses:
             return False
 
         # 2 check that referencing addresses are in the tx
         for addr in addresses:
-            if not tx.has_address(addr):
+            if not self.tx_has_address(tx_hash, addr):
                 return False
 
         return True
@@ -1057,6 +1889,7 @@ class Abstract_Wallet:
         if self.network:
             self.verifier.stop()
             self.synchronizer.stop()
+        self.storage.flush()
 
     def restore(self, cb):
         pass
@@ -1082,6 +1915,7 @@ class Imported_Wallet(Abstract_Wallet):
         a = self.accounts.get(IMPORTED_ACCOUNT)
         if not a:
             self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
+            self.index_account(IMPORTED_ACCOUNT)
         self.storage.put('wallet_type', 'imported', True)
 
 
@@ -1151,6 +1985,7 @@ class Deterministic_Wallet(Abstract_Wallet):
                 n = len(addresses) - k + value
                 addresses = addresses[0:n]
                 self.accounts[key][0] = addresses
+            self.build_address_index()
 
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit, True)
@@ -1198,26 +2033,23 @@ class Deterministic_Wallet(Abstract_Wallet):
         return age > 2
 
 
-    def synchronize_sequence(self, account, for_change):
+    def synchronize_sequence(self, account_id, for_change):
+        account = self.accounts[account_id]
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        new_addresses = []
-        while True:
-            addresses = account.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = account.create_new_address(for_change)
-                self.history[address] = []
-                new_addresses.append( address )
-                continue
-
-            if map( lambda a: self.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+        # count the unused addresses at the end of the sequence
+        gap = 0
+        for address in reversed(account.get_addresses(for_change)):
+            if gap == limit or self.address_is_old(address):
                 break
-            else:
-                address = account.create_new_address(for_change)
-                self.history[address] = []
-                new_addresses.append( address )
-
+            gap += 1
+        if gap == limit:
+            return []
+        # new addresses are unused, so one block fills the gap
+        new_addresses = self.create_new_addresses(account_id, for_change, limit - gap)
+        for address in new_addresses:
+            self.history[address] = []
         return new_addresses
-        
+
 
     def check_pending_accounts(self):
         for account_id, addr in self.next_addresses.items():
@@ -1229,23 +2061,23 @@ class Deterministic_Wallet(Abstract_Wallet):
                 self.next_addresses.pop(account_id)
 
 
-    def synchronize_account(self, account):
+    def synchronize_account(self, account_id):
         new = []
-        new += self.synchronize_sequence(account, 0)
-        new += self.synchronize_sequence(account, 1)
+        new += self.synchronize_sequence(account_id, 0)
+        new += self.synchronize_sequence(account_id, 1)
         return new
 
 
     def synchronize(self):
         self.check_pending_accounts()
         new = []
-        for account in self.accounts.values():
+        for account_id, account in self.accounts.items():
             if type(account) in [ImportedAccount, PendingAccount]:
                 continue
-            new += self.synchronize_account(account)
+            new += self.synchronize_account(account_id)
         if new:
             self.save_accounts()
-            self.storage.put('addr_history', self.history, True)
+            self.storage.put_deferred('addr_history', self.history)
         return new
 
 
@@ -1294,6 +2126,7 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def add_account(self, account_id, account):
         self.accounts[account_id] = account
+        self.index_account(account_id)
         self.save_accounts()
 
 
@@ -1304,12 +2137,14 @@ class Deterministic_Wallet(Abstract_Wallet):
     def delete_pending_account(self, k):
         assert self.account_is_pending(k)
         self.accounts.pop(k)
+        self.build_address_index()
         self.save_accounts()
 
     def create_pending_account(self, name, password):
         account_id, addr = self.next_account_address(password)
         self.set_label(account_id, name)
         self.accounts[account_id] = PendingAccount({'pending':addr})
+        self.index_account(account_id)
         self.save_accounts()
 
 
@@ -1418,6 +2253,7 @@ class NewWallet(Deterministic_Wallet):
             account = self.make_account(account_id, password)
             addr = account.first_address()
             self.next_addresses[account_id] = addr
+            self.address_index.setdefault(addr, (account_id, (0,0)))
             self.storage.put('next_addresses', self.next_addresses)
 
         return account_id, addr
@@ -1566,6 +2402,7 @@ class OldWallet(Deterministic_Wallet):
 
     def create_account(self, mpk):
         self.accounts[0] = OldAccount({'mpk':mpk, 0:[], 1:[]})
+        self.index_account(0)
         self.save_accounts()
 
     def create_watching_only_wallet(self, mpk):
@@ -69,8 +69,11 @@ setup(
         'electrum_vior.bitcoin',
         'electrum_vior.blockchain',
         'electrum_vior.bmp',
+        'electrum_vior.checkpoints',
         'electrum_vior.commands',
         'electrum_vior.daemon',
+        'electrum_vior.ecc',
+        'electrum_vior.ecc_native',
         'electrum_vior.i18n',
         'electrum_vior.interface',
         'electrum_vior.mnemonic',